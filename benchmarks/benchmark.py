@@ -4,14 +4,29 @@ import time
 import multiprocessing
 
 NUM_CALLS = 10000
+NUM_LARGE_CALLS = 100
+BATCH_SIZE = 100
+NUM_ROWS = 1000000
+LARGE_PAYLOAD = dict(('key%d' % i, range(100)) for i in xrange(1000))
+BLOB = bytearray(16 * 1024 ** 2)
 
 
 def run_sum_server():
     from gevent.server import StreamServer
-    from mprpc import RPCServer
+    from mprpc import RPCServer, cached
     class SumServer(RPCServer):
         def sum(self, x, y):
             return x + y
+        def echo(self, data):
+            return data
+        def rows(self, n):
+            for i in xrange(n):
+                yield (i, 'row%d' % i)
+        def large(self):
+            return LARGE_PAYLOAD
+        @cached()
+        def large_cached(self):
+            return LARGE_PAYLOAD
     server = StreamServer(('127.0.0.1', 6000), SumServer)
     server.serve_forever()
 
@@ -41,6 +56,55 @@ def call2():
     print 'call2: %d qps' % (NUM_CALLS / (time.time() - start))
 
 
+def call2_large():
+    from mprpc import PIKSimple
+    client = PIKSimple('127.0.0.1', 6000)
+    start = time.time()
+    [client.call('echo', LARGE_PAYLOAD) for _ in xrange(NUM_LARGE_CALLS)]
+    print 'call2_large: %d qps' % (NUM_LARGE_CALLS / (time.time() - start))
+
+
+def call3():
+    from mprpc import JSNSimple
+    client = JSNSimple('127.0.0.1', 6000)
+    start = time.time()
+    [client.call('sum', 1, 2) for _ in xrange(NUM_CALLS)]
+    print 'call3: %d qps' % (NUM_CALLS / (time.time() - start))
+
+
+def call_many():
+    from mprpc import RPCClient
+    client = RPCClient('127.0.0.1', 6000)
+    calls = [('sum', (1, 2))] * BATCH_SIZE
+    start = time.time()
+    [client.call_many(calls) for _ in xrange(NUM_CALLS / BATCH_SIZE)]
+    print 'call_many: %d qps' % (NUM_CALLS / (time.time() - start))
+
+
+def call_stream():
+    from mprpc import RPCClient
+    client = RPCClient('127.0.0.1', 6000, stream_window=1024)
+    start = time.time()
+    for _ in client.call_stream('rows', NUM_ROWS):
+        pass
+    print 'call_stream: %d rows/s' % (NUM_ROWS / (time.time() - start))
+
+
+def call_large():
+    from mprpc import RPCClient
+    client = RPCClient('127.0.0.1', 6000)
+    start = time.time()
+    [client.call('large') for _ in xrange(NUM_LARGE_CALLS)]
+    print 'call_large: %d qps' % (NUM_LARGE_CALLS / (time.time() - start))
+    start = time.time()
+    [client.call('large_cached') for _ in xrange(NUM_LARGE_CALLS)]
+    print 'call_large_cached: %d qps' % (NUM_LARGE_CALLS / (time.time() - start))
+    client = RPCClient('127.0.0.1', 6000, compress=True)
+    start = time.time()
+    [client.call('large_cached') for _ in xrange(NUM_LARGE_CALLS)]
+    print 'call_large_compressed: %d qps' % (NUM_LARGE_CALLS / (time.time() - start))
+
+
 def call_using_connection_pool():
     from mprpc import RPCPoolClient
     import gevent.pool
@@ -57,6 +121,27 @@ def call_using_connection_pool():
 
 
 
+def call_using_native_pool():
+    from mprpc import RPCClient
+    from mprpc.pool import ConnectionPool
+    import gevent.pool
+    pool = ConnectionPool(RPCClient, dict(host='127.0.0.1', port=6000), min_connections=20)
+    glet_pool = gevent.pool.Pool(20)
+    start = time.time()
+    [None for _ in glet_pool.imap_unordered(lambda n: pool.call('sum', 1, 2), xrange(NUM_CALLS))]
+    print 'call_using_native_pool: %d qps' % (NUM_CALLS / (time.time() - start))
+
+
+def call_buffers():
+    from mprpc import BUFSimple
+    client = BUFSimple('127.0.0.1', 6000)
+    start = time.time()
+    [client.call('echo', BLOB) for _ in xrange(NUM_LARGE_CALLS)]
+    elapsed = time.time() - start
+    print 'call_buffers: %d qps, %d MB/s' % (NUM_LARGE_CALLS / elapsed,
+                                            NUM_LARGE_CALLS * len(BLOB) / elapsed / 1024 ** 2)
+
+
 def call4():
     from mprpc import STRSimple
     client = STRSimple('127.0.0.1', 6000)
@@ -81,6 +166,12 @@ if __name__ == '__main__':
     call0()
     call1()
     call2()
+    call2_large()
+    call3()
+    call_many()
+    call_stream()
+    call_large()
+    call_buffers()
     call4()
     call5()
 
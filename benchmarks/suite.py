@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""Benchmark suite.
+
+Starts a local server, then runs an echo benchmark for each combination of
+mode, payload size, client concurrency and connection sharing. It prints the
+throughput, the latency percentiles and the memory in use, and writes them as
+JSON. With a baseline, the run fails when a result regresses beyond the
+tolerance::
+
+    % python benchmarks/suite.py --output baseline.json
+    % python benchmarks/suite.py --baseline baseline.json --tolerance 0.2
+
+In ``single`` runs, all workers share one connection. In ``pooled`` runs,
+each worker has its own connection. MSGPACK workers are greenlets sharing
+multiplexed :class:`RPCClient <mprpc.RPCClient>` connections. Other modes use
+blocking clients, so their workers are threads. The server listens on TCP and
+on a Unix domain socket, and ``--transports`` selects which ones are measured.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+
+MODES = ('MSGPACK', 'PICKLES', 'STRINGS', 'URIHTTP')
+SIZES = (16, 1024, 64 * 1024, 1024 ** 2, 4 * 1024 ** 2)
+CONCURRENCY = (1, 8)
+CONNECTIONS = ('single', 'pooled')
+TRANSPORTS = ('tcp', 'unix')
+WARMUP_CALLS = 10
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_server(host, port, unix_path):
+    import gevent
+    from gevent.server import StreamServer
+    from mprpc import RPCServer
+    from mprpc.transport import listen
+
+    def read_exactly(server, size):
+        chunks = []
+        while size:
+            chunk = server._system_read(min(size, 1024 ** 2))
+            if not chunk:
+                raise IOError('Connection closed')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    class BenchServer(RPCServer):
+        def echo(self, data):
+            return data
+
+        def strings_echo(self):
+            # STRINGS requests carry no arguments: the body starts with its
+            # size
+            return read_exactly(self, int(read_exactly(self, 8)))
+
+        def uri_echo(self, size):
+            return read_exactly(self, int(size))
+
+    servers = [StreamServer((host, port), BenchServer, backlog=1024)]
+    if unix_path:
+        servers.append(StreamServer(listen('unix://' + unix_path), BenchServer))
+    gevent.joinall([gevent.spawn(server.serve_forever) for server in servers], raise_error=True)
+
+
+def start_server(host, port, unix_path):
+    # The server imports mprpc from the checkout, as the clients do
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + filter(None, [env.get('PYTHONPATH')]))
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve',
+                                '--host', host, '--port', str(port), '--unix-path', unix_path], env=env)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection((host, port), 1).close()
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(unix_path)
+            finally:
+                sock.close()
+            return process
+        except socket.error:
+            if process.poll() is not None or time.time() > deadline:
+                if process.poll() is None:
+                    process.kill()
+                raise RuntimeError('The benchmark server failed to start')
+            time.sleep(0.1)
+
+
+def rss(pid=None):
+    """Returns the resident set size of a process in bytes, or None if it is
+    unknown."""
+    try:
+        with open('/proc/%s/status' % (pid or 'self')) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    if pid is None:
+        # Peak rather than current usage
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == 'darwin' else usage * 1024
+    return None
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def read_exactly(sock, size):
+    view = memoryview(bytearray(size))
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise IOError('Connection closed')
+        received += n
+    return view
+
+
+def make_call(mode, client, payload):
+    """Returns a function making one echo call with a client of the mode."""
+    size = len(payload)
+    if mode in ('MSGPACK', 'PICKLES'):
+        def call():
+            if len(client.call('echo', payload)) != size:
+                raise AssertionError('Short response')
+    elif mode == 'STRINGS':
+        def call():
+            read_exactly(client.call('strings_echo', '%08d' % size + payload), size)
+    else:
+        def call():
+            read_exactly(client.call('uri_echo', size=size, body=payload), size)
+    return call
+
+
+def measure(workers, spawn, duration):
+    """Runs workers for ``duration`` seconds and returns their latencies,
+    error count and the time they took."""
+    latencies = []
+    errors = [0]
+
+    def work(call):
+        now = time.time()
+        while now < deadline:
+            try:
+                call()
+            except Exception:
+                errors[0] += 1
+            end = time.time()
+            latencies.append(end - now)
+            now = end
+
+    for call in workers:
+        for _ in xrange(WARMUP_CALLS):
+            call()
+    started = time.time()
+    deadline = started + duration
+    spawn(work, workers)
+    return (latencies, errors[0], time.time() - started)
+
+
+def spawn_greenlets(work, workers):
+    import gevent
+    gevent.joinall([gevent.spawn(work, call) for call in workers], raise_error=True)
+
+
+def spawn_threads(work, workers):
+    threads = [threading.Thread(target=work, args=(call,)) for call in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def locked(call):
+    lock = threading.Lock()
+
+    def wrapper():
+        with lock:
+            call()
+    return wrapper
+
+
+def run_scenario(host, port, mode, size, concurrency, connections, duration, transport='tcp'):
+    import mprpc
+    from mprpc.pool import ConnectionPool
+
+    payload = 'x' * size
+    clients = []
+    if mode == 'MSGPACK':
+        if connections == 'single':
+            client = mprpc.RPCClient(host, port, multiplex=True)
+            clients.append(client)
+            workers = [make_call(mode, client, payload)] * concurrency
+        else:
+            pool = ConnectionPool(mprpc.RPCClient, dict(host=host, port=port),
+                                  min_connections=concurrency, max_connections=concurrency)
+            workers = [make_call(mode, pool, payload)] * concurrency
+        spawn = spawn_greenlets
+    else:
+        factory = {'PICKLES': mprpc.PIKSimple, 'STRINGS': mprpc.STRSimple, 'URIHTTP': mprpc.URISimple}[mode]
+        if connections == 'single':
+            clients.append(factory(host, port))
+            workers = [locked(make_call(mode, clients[0], payload))] * concurrency
+        else:
+            clients.extend(factory(host, port) for _ in xrange(concurrency))
+            workers = [make_call(mode, client, payload) for client in clients]
+        spawn = spawn_threads
+
+    (latencies, errors, elapsed) = measure(workers, spawn, duration)
+    for client in clients:
+        client.close()
+    if mode == 'MSGPACK' and connections == 'pooled':
+        pool.close()
+
+    latencies.sort()
+    calls = len(latencies)
+    name = '%s/%dB/c%d/%s' % (mode, size, concurrency, connections)
+    if transport != 'tcp':
+        name += '/' + transport
+    return dict(
+        name=name, mode=mode, size=size, concurrency=concurrency, connections=connections, transport=transport,
+        calls=calls, errors=errors, seconds=elapsed,
+        throughput=calls / elapsed, megabytes_per_second=calls * size / elapsed / 1024 ** 2,
+        latency=dict(mean=sum(latencies) / calls if calls else None, p50=percentile(latencies, 0.5),
+                     p99=percentile(latencies, 0.99), p999=percentile(latencies, 0.999),
+                     max=latencies[-1] if latencies else None))
+
+
+def compare(results, baseline, tolerance, latency_tolerance):
+    """Returns descriptions of the results whose throughput or p99 latency
+    regressed from the baseline by more than ``tolerance`` or
+    ``latency_tolerance``, as fractions."""
+    previous = dict((result['name'], result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        base = previous.get(result['name'])
+        if base is None:
+            continue
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append('%s: throughput %.0f/s, baseline %.0f/s' % (
+                result['name'], result['throughput'], base['throughput']))
+        if base['latency']['p99'] and result['latency']['p99'] > base['latency']['p99'] * (1 + latency_tolerance):
+            regressions.append('%s: p99 %.3f ms, baseline %.3f ms' % (
+                result['name'], result['latency']['p99'] * 1000, base['latency']['p99'] * 1000))
+        if result['errors'] > base['errors']:
+            regressions.append('%s: %d errors, baseline %d' % (result['name'], result['errors'], base['errors']))
+    return regressions
+
+
+def print_result(result):
+    latency = result['latency']
+    print '%-37s %9.0f calls/s %9.1f MB/s  p50 %7.3f  p99 %7.3f  p999 %7.3f ms  server %s' % (
+        result['name'], result['throughput'], result['megabytes_per_second'],
+        latency['p50'] * 1000, latency['p99'] * 1000, latency['p999'] * 1000,
+        '%d MB' % (result['server_rss'] / 1024 ** 2) if result['server_rss'] else '-')
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the mprpc benchmark suite.')
+    parser.add_argument('--host', default='127.0.0.1', help='Server host (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=6100, help='Server port (default: %(default)s)')
+    parser.add_argument('--external', action='store_true',
+                        help='Use a server already running the suite server, started with --serve')
+    parser.add_argument('--serve', action='store_true', help='Run the benchmark server only')
+    parser.add_argument('--modes', type=lambda value: value.upper().split(','), default=MODES,
+                        help='Comma-separated modes (default: %s)' % ','.join(MODES))
+    parser.add_argument('--sizes', type=int_list, default=SIZES,
+                        help='Comma-separated payload sizes in bytes (default: %s)' % ','.join(map(str, SIZES)))
+    parser.add_argument('--concurrency', type=int_list, default=CONCURRENCY,
+                        help='Comma-separated numbers of concurrent workers (default: %s)' %
+                        ','.join(map(str, CONCURRENCY)))
+    parser.add_argument('--connections', type=lambda value: value.split(','), default=CONNECTIONS,
+                        help='Comma-separated connection sharing, single and/or pooled (default: %(default)s)')
+    parser.add_argument('--transports', type=lambda value: value.split(','), default=TRANSPORTS,
+                        help='Comma-separated transports, tcp and/or unix (default: %s)' % ','.join(TRANSPORTS))
+    parser.add_argument('--unix-path', default='/tmp/mprpc-suite.sock',
+                        help='Unix domain socket of the server (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='Seconds each benchmark runs (default: %(default)s)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Throughput regression allowed from the baseline, as a fraction (default: %(default)s)')
+    parser.add_argument('--latency-tolerance', type=float, default=0.5,
+                        help='p99 latency regression allowed from the baseline, as a fraction (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        run_server(args.host, args.port, args.unix_path)
+        return 0
+
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    server = None if args.external else start_server(args.host, args.port, args.unix_path)
+    endpoints = dict(tcp=(args.host, args.port), unix=('unix://' + args.unix_path, None))
+    results = []
+    try:
+        for mode in args.modes:
+            for size in args.sizes:
+                for concurrency in args.concurrency:
+                    for connections in args.connections:
+                        for transport in args.transports:
+                            (host, port) = endpoints[transport]
+                            result = run_scenario(host, port, mode, size, concurrency,
+                                                  connections, args.duration, transport)
+                            result['server_rss'] = rss(server.pid) if server else None
+                            result['client_rss'] = rss()
+                            print_result(result)
+                            results.append(result)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    report = dict(environment=dict(python=platform.python_version(), implementation=platform.python_implementation(),
+                                   platform=platform.platform(), processor=platform.processor(),
+                                   time=time.strftime('%Y-%m-%dT%H:%M:%S')),
+                  results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.latency_tolerance)
+        if regressions:
+            print '\nRegressions from %s:' % args.baseline
+            for regression in regressions:
+                print '  ' + regression
+            return 1
+        print '\nNo regressions from %s' % args.baseline
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,13 +2,25 @@
 
 import time
 from gevent.server import StreamServer
-from mprpc import RPCServer
+from mprpc import RPCServer, cached
+
+LARGE_PAYLOAD = dict(('key%d' % i, range(100)) for i in xrange(1000))
 
 def run_sum_server():
 
     class SumServer(RPCServer):
         def sum(self, x, y):
             return x + y
+        def echo(self, data):
+            return data
+        def rows(self, n):
+            for i in xrange(n):
+                yield (i, 'row%d' % i)
+        def large(self):
+            return LARGE_PAYLOAD
+        @cached()
+        def large_cached(self):
+            return LARGE_PAYLOAD
         def bday(self):
             result=self._system_read(1000)
             #print 'result',result
@@ -8,11 +8,21 @@ try:
     from server import RPCServer
 except:
     pass
+try:
+    from pool import ConnectionPool
+    from cluster import RPCClusterClient
+except:
+    pass
+from codec import Codec, register_codec
+from decorators import cached, coalesce, export, invalidates, stream
 try:
     from client_simple import ClientRPC as RPCSimple
     from client_simple import ClientPIK as PIKSimple
     from client_simple import ClientSTR as STRSimple
     from client_simple import ClientURI as URISimple
+    from client_simple import ClientJSN as JSNSimple
+    from client_simple import ClientBUF as BUFSimple
+    from client_simple import ClientFIL as FILSimple
 except:
     pass
 
@@ -25,7 +35,8 @@ def get_client_class(
     if with_type is None or with_type=='client_normal':
         result=RPCClient(host,port)
     elif with_type=='client_pool':
-        raise
+        result=ConnectionPool(RPCClient,dict(host=host,port=port,timeout=timeout,
+                                             pack_encoding=pack_encoding,unpack_encoding=unpack_encoding))
     elif with_type=='client_simple':
         result=RPCSimple(host,port)
     elif with_type=='client_pickle':
@@ -34,6 +45,12 @@ def get_client_class(
         result=STRSimple(host,port)
     elif with_type=='client_urihttp':
         result=URISimple(host,port)
+    elif with_type=='client_json':
+        result=JSNSimple(host,port)
+    elif with_type=='client_buffers':
+        result=BUFSimple(host,port)
+    elif with_type=='client_fileobj':
+        result=FILSimple(host,port)
     else:
         raise
     return result
\ No newline at end of file
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Admission control of the RPC servers of a process.
+
+Admission control is off by default. Once :func:`enable` has been called,
+connections opened afterwards run at most ``max_in_flight`` requests at once,
+over all connections of the process, and up to ``max_queue`` more wait for
+their turn. Requests beyond that, and requests beyond ``per_connection`` on
+one connection, are answered right away with an error that clients raise as
+:class:`ServerBusyError <mprpc.exceptions.ServerBusyError>`. The request was
+not executed, so it can be retried, preferably on another server:
+
+.. code-block:: python
+
+    >>> import mprpc.admission
+    >>> mprpc.admission.enable(max_in_flight=256, max_queue=1024, queue_timeout=1.0)
+
+The limits apply to MessagePack requests, batches counting as one request,
+and to the codec, BUFFERS and FILEOBJ modes. A streamed response keeps its
+request's slot until the stream ends. STRINGS and URIHTTP methods read
+their request body themselves, so those requests cannot be turned away and
+are not limited. Neither are the reserved ``mprpc.stats`` and
+``mprpc.profile.*`` methods, so that a saturated server can be inspected.
+Queue depth and shed counts are included in the ``mprpc.stats`` output.
+"""
+
+try:
+    from gevent.lock import Semaphore
+except ImportError:
+    from gevent.coros import Semaphore
+
+_control = None
+
+
+class AdmissionControl(object):
+    """Limits the requests executed at once.
+
+    :param int max_in_flight: Requests executed at once.
+    :param int max_queue: (optional) Requests waiting for one of those to
+        finish. Further requests are rejected.
+    :param float queue_timeout: (optional) Seconds a request waits before
+        being rejected. By default, it waits as long as needed.
+    :param int per_connection: (optional) Requests admitted at once from one
+        connection, waiting or executing.
+    """
+
+    def __init__(self, max_in_flight, max_queue=0, queue_timeout=None, per_connection=None):
+        assert max_in_flight > 0, 'max_in_flight must be a positive value'
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.per_connection = per_connection
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.shed = 0
+        self._slots = Semaphore(max_in_flight)
+
+    def admit(self):
+        """Returns whether a request is admitted, without blocking. An
+        admitted request must then :meth:`acquire` a slot."""
+        if self.in_flight + self.queued >= self.max_in_flight + self.max_queue:
+            self.shed += 1
+            return False
+        self.queued += 1
+        return True
+
+    def acquire(self):
+        """Waits for a slot for an admitted request. Returns False if the
+        queue timeout expired first, in which case the request is shed."""
+        try:
+            ok = self._slots.acquire(timeout=self.queue_timeout)
+        finally:
+            self.queued -= 1
+        if not ok:
+            self.shed += 1
+            return False
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+    def info(self):
+        """Returns the limits and counters as a dict.
+
+        :rtype: dict
+        """
+        return dict(max_in_flight=self.max_in_flight, max_queue=self.max_queue, in_flight=self.in_flight,
+                    queued=self.queued, admitted=self.admitted, shed=self.shed)
+
+    def prometheus(self):
+        """Returns the counters in the Prometheus text exposition format.
+
+        :rtype: str
+        """
+        lines = []
+        for (name, kind, doc, value) in (
+                ('mprpc_in_flight_requests', 'gauge', 'Requests executing.', self.in_flight),
+                ('mprpc_queued_requests', 'gauge', 'Requests waiting to execute.', self.queued),
+                ('mprpc_admitted_requests_total', 'counter', 'Requests admitted.', self.admitted),
+                ('mprpc_shed_requests_total', 'counter', 'Requests rejected as busy.', self.shed)):
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %d' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def enable(max_in_flight, max_queue=0, queue_timeout=None, per_connection=None):
+    """Turns admission control on for the connections opened from now on.
+
+    Takes the arguments of :class:`AdmissionControl`.
+
+    :returns: The :class:`AdmissionControl`.
+    """
+    global _control
+    _control = AdmissionControl(max_in_flight, max_queue, queue_timeout, per_connection)
+    return _control
+
+
+def disable():
+    """Turns admission control off for the connections opened from now on."""
+    global _control
+    _control = None
+
+
+def get_control():
+    """Returns the admission control in use, or None when it is off."""
+    return _control
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import logging
+from types import GeneratorType
+
+import msgpack
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from .constants import MSGPACKRPC_REQUEST, MSGPACKRPC_RESPONSE, MSGPACKRPC_NOTIFY, MSGPACKRPC_BATCH, MSGPACKRPC_MAX_MSGID, METHOD_RECV_SIZE
+from .constants import MSGPACKRPC_CHUNK, MSGPACKRPC_CREDIT, MSGPACKRPC_CANCEL, SERVER_BUSY_ERROR
+from .decorators import get_dispatch_table
+from .exceptions import MethodNotFoundError, RPCProtocolError, RPCError, ServerBusyError
+from .transport import unix_path
+
+# Protocol callbacks are public attributes but never RPC methods
+_PROTOCOL_ATTRS = frozenset(dir(asyncio.Protocol))
+
+
+def _create_future(loop):
+    if hasattr(loop, 'create_future'):
+        return loop.create_future()
+    return asyncio.Future(loop=loop)
+
+
+def _is_awaitable(method, ret):
+    # Generator-based coroutines are told apart from streamed generators by
+    # the method that returned them
+    if isinstance(ret, asyncio.Future):
+        return True
+    if isinstance(ret, GeneratorType):
+        return asyncio.iscoroutinefunction(method)
+    return asyncio.iscoroutine(ret)
+
+
+class _Stream(object):
+    def __init__(self, items, credit):
+        self.items = items
+        self.credit = max(1, credit)
+
+
+class RPCServer(asyncio.Protocol):
+    """RPC server for asyncio event loops, including uvloop.
+
+    It speaks the same ``MSGPACK:`` framing as :class:`mprpc.RPCServer
+    <mprpc.server.RPCServer>`, so gevent and asyncio clients can call it
+    alike. Requests are executed as they arrive. A method may return a future
+    or a coroutine, in which case its response is sent once it is done, and
+    other requests on the connection keep being served meanwhile.
+    Notifications are executed alike, without a response.
+
+    Usage:
+        >>> import asyncio
+        >>> from mprpc.aio import RPCServer
+        >>>
+        >>> class SumServer(RPCServer):
+        ...     def sum(self, x, y):
+        ...         return x + y
+        ...
+        >>> loop = asyncio.get_event_loop()
+        >>> loop.run_until_complete(loop.create_server(SumServer, '127.0.0.1', 6000))
+        >>> loop.run_forever()
+
+    :param str pack_encoding: (optional) Character encoding used to pack data
+        using Messagepack.
+    :param str unpack_encoding: (optional) Character encoding used to unpack
+        data using Messagepack.
+    """
+
+    def __init__(self, pack_encoding='utf-8', unpack_encoding='utf-8'):
+        self._packer = msgpack.Packer(encoding=pack_encoding)
+        self._unpacker = msgpack.Unpacker(encoding=unpack_encoding, use_list=False)
+        self._transport = None
+        self._tag = b''
+        self._dispatch = get_dispatch_table(type(self), _PROTOCOL_ATTRS)
+        self._methods = {}
+        self._streams = {}
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def connection_lost(self, exc):
+        logging.debug('Client disconnected')
+        self._transport = None
+        for stream in self._streams.values():
+            if hasattr(stream.items, 'close'):
+                stream.items.close()
+        self._streams.clear()
+
+    def pause_writing(self):
+        # Stop taking requests while responses pile up in the transport
+        self._transport.pause_reading()
+
+    def resume_writing(self):
+        self._transport.resume_reading()
+
+    def data_received(self, data):
+        self._unpacker.feed(data)
+        try:
+            while self._transport is not None:
+                if len(self._tag) < METHOD_RECV_SIZE:
+                    self._tag += self._unpacker.read_bytes(METHOD_RECV_SIZE - len(self._tag))
+                    if len(self._tag) < METHOD_RECV_SIZE:
+                        break
+                    if self._tag != b'MSGPACK:':
+                        raise RPCProtocolError('Unsupported rpc type: %r' % self._tag)
+                try:
+                    req = next(self._unpacker)
+                except StopIteration:
+                    break
+                self._tag = b''
+                self._handle(req)
+        except Exception as e:
+            logging.error('Closing the connection: %s', e)
+            if self._transport is not None:
+                self._transport.close()
+
+    def test_connect(self, *args, **kwargs):
+        return '1'
+
+    def _lookup_method(self, method_name):
+        method = self._methods.get(method_name)
+        if method is None:
+            attr = self._dispatch.get(method_name)
+            if attr is None:
+                raise MethodNotFoundError('Method not found: %s' % method_name)
+            method = self._methods[method_name] = getattr(self, attr)
+        return method
+
+    def _handle(self, req):
+        if type(req) is not tuple or len(req) < 2:
+            raise RPCProtocolError('Invalid protocol')
+        if req[0] == MSGPACKRPC_BATCH:
+            self._batch(req)
+        elif req[0] in (MSGPACKRPC_CREDIT, MSGPACKRPC_CANCEL):
+            self._stream_control(req)
+        elif req[0] == MSGPACKRPC_NOTIFY:
+            if len(req) != 4:
+                raise RPCProtocolError('Invalid protocol')
+            self._execute((MSGPACKRPC_REQUEST, None) + req[1:], self._notified)
+        else:
+            options = req[5] if len(req) == 6 else {}
+            self._execute(req, functools.partial(self._respond, options))
+
+    def _execute(self, req, callback):
+        # Calls callback(msg_id, method, error, result), right away or once
+        # the returned future is done
+        if len(req) not in (5, 6) or req[0] != MSGPACKRPC_REQUEST:
+            raise RPCProtocolError('Invalid protocol')
+        (msg_id, method_name, args, kwargs) = req[1:5]
+        method = None
+        try:
+            method = self._lookup_method(method_name)
+            ret = method(*args, **kwargs)
+        except MethodNotFoundError as e:
+            callback(msg_id, method, str(e), None)
+            return
+        except Exception as e:
+            logging.exception('An error has occurred')
+            callback(msg_id, method, str(e), None)
+            return
+        if _is_awaitable(method, ret):
+            future = asyncio.ensure_future(ret)
+            future.add_done_callback(functools.partial(self._resolved, msg_id, method, callback))
+        else:
+            callback(msg_id, method, None, ret)
+
+    def _notified(self, msg_id, method, error, result):
+        # Notifications get no response
+        if error is not None:
+            logging.warning('A notification failed: %s', error)
+
+    def _resolved(self, msg_id, method, callback, future):
+        if future.cancelled():
+            callback(msg_id, method, 'Cancelled', None)
+        elif future.exception() is not None:
+            logging.error('An error has occurred: %r', future.exception())
+            callback(msg_id, method, str(future.exception()), None)
+        else:
+            callback(msg_id, method, None, future.result())
+
+    def _respond(self, options, msg_id, method, error, result):
+        if error is None and options.get('stream'):
+            if not (isinstance(result, (GeneratorType, list, tuple)) or getattr(method, '_mprpc_stream', False)):
+                result = (result,)
+            self._stream_start(msg_id, result, options['stream'])
+        else:
+            self._write(self._pack_response(msg_id, error, result))
+
+    def _pack_response(self, msg_id, error, result):
+        try:
+            if isinstance(result, GeneratorType):
+                result = list(result)
+            return self._packer.pack((MSGPACKRPC_RESPONSE, msg_id, error, result))
+        except Exception as e:
+            logging.exception('An error has occurred')
+            return self._packer.pack((MSGPACKRPC_RESPONSE, msg_id, str(e), None))
+
+    def _write(self, data):
+        if self._transport is not None:
+            self._transport.write(data)
+
+    def _batch(self, batch):
+        if len(batch) != 2:
+            raise RPCProtocolError('Invalid protocol')
+        data = [None] * len(batch[1])
+        remaining = [len(data)]
+
+        def respond(index, msg_id, method, error, result):
+            data[index] = self._pack_response(msg_id, error, result)
+            remaining[0] -= 1
+            if not remaining[0]:
+                self._write(b''.join(data))
+
+        for (index, req) in enumerate(batch[1]):
+            self._execute(req, functools.partial(respond, index))
+
+    def _stream_start(self, msg_id, items, window):
+        try:
+            items = iter(items)
+        except Exception as e:
+            logging.exception('An error has occurred')
+            self._write(self._pack_response(msg_id, str(e), None))
+            return
+        self._streams[msg_id] = _Stream(items, int(window))
+        self._stream_pump(msg_id)
+
+    def _stream_pump(self, msg_id):
+        # Sends as many items as the credit allows, ending the stream once
+        # the items are exhausted
+        stream = self._streams[msg_id]
+        data = []
+        end = False
+        error = None
+        try:
+            while stream.credit > 0:
+                try:
+                    item = next(stream.items)
+                except StopIteration:
+                    end = True
+                    break
+                data.append(self._packer.pack((MSGPACKRPC_CHUNK, msg_id, item)))
+                stream.credit -= 1
+        except Exception as e:
+            logging.exception('An error has occurred')
+            (end, error) = (True, str(e))
+        if end:
+            self._stream_end(msg_id)
+            data.append(self._packer.pack((MSGPACKRPC_RESPONSE, msg_id, error, None)))
+        self._write(b''.join(data))
+
+    def _stream_end(self, msg_id):
+        stream = self._streams.pop(msg_id)
+        if hasattr(stream.items, 'close'):
+            stream.items.close()
+
+    def _stream_control(self, req):
+        if len(req) != 3:
+            raise RPCProtocolError('Invalid protocol')
+        stream = self._streams.get(req[1])
+        if stream is None:
+            return
+        if req[0] == MSGPACKRPC_CREDIT:
+            stream.credit += req[2]
+            self._stream_pump(req[1])
+        else:
+            self._stream_end(req[1])
+            self._write(self._packer.pack((MSGPACKRPC_RESPONSE, req[1], None, None)))
+
+
+class RPCClient(asyncio.Protocol):
+    """RPC client for asyncio event loops, including uvloop.
+
+    :meth:`call` returns a future, so any number of calls can be in flight on
+    the connection at once. Use :func:`connect` to create a client.
+
+    Usage:
+        >>> from mprpc.aio import connect
+        >>> client = loop.run_until_complete(connect('127.0.0.1', 6000))
+        >>> print loop.run_until_complete(client.call('sum', 1, 2))
+        3
+
+    :param str pack_encoding: (optional) Character encoding used to pack data
+        using Messagepack.
+    :param str unpack_encoding: (optional) Character encoding used to unpack
+        data using Messagepack.
+    :param loop: (optional) Event loop.
+    """
+
+    def __init__(self, pack_encoding='utf-8', unpack_encoding='utf-8', loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._packer = msgpack.Packer(encoding=pack_encoding)
+        self._unpacker = msgpack.Unpacker(encoding=unpack_encoding, use_list=False)
+        self._transport = None
+        self._msg_id = 0
+        self._pending = {}
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def connection_lost(self, exc):
+        self._transport = None
+        futures = list(self._pending.values())
+        self._pending.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc or IOError('Connection closed'))
+
+    def data_received(self, data):
+        self._unpacker.feed(data)
+        for response in self._unpacker:
+            if type(response) is not tuple or len(response) < 2:
+                logging.warning('Dropping a malformed response')
+                continue
+            future = self._pending.pop(response[1], None)
+            if future is None or future.done():
+                continue
+            if len(response) != 4 or response[0] != MSGPACKRPC_RESPONSE:
+                future.set_exception(RPCProtocolError('Invalid protocol'))
+            elif response[2] == SERVER_BUSY_ERROR:
+                future.set_exception(ServerBusyError(response[2]))
+            elif response[2]:
+                future.set_exception(RPCError(str(response[2])))
+            else:
+                future.set_result(response[3])
+
+    def is_connected(self):
+        """Returns whether the connection is open.
+
+        :rtype: bool
+        """
+        return self._transport is not None
+
+    def close(self):
+        """Closes the connection."""
+        if self._transport is not None:
+            self._transport.close()
+
+    def call(self, method, *args, **kwargs):
+        """Calls a RPC method.
+
+        :param str method: Method name.
+        :param args: Method arguments.
+        :param kwargs: method kwargs.
+        :returns: Future for the result.
+        """
+        if self._transport is None:
+            raise IOError('Connection closed')
+        while True:
+            if self._msg_id >= MSGPACKRPC_MAX_MSGID:
+                self._msg_id = 0
+            self._msg_id += 1
+            if self._msg_id not in self._pending:
+                break
+        future = self._pending[self._msg_id] = _create_future(self._loop)
+        req = (MSGPACKRPC_REQUEST, self._msg_id, method, args, kwargs)
+        self._transport.write(b'MSGPACK:' + self._packer.pack(req))
+        return future
+
+    def notify(self, method, *args, **kwargs):
+        """Sends a notification, calling a RPC method without a response.
+
+        :param str method: Method name.
+        :param args: Method arguments.
+        :param kwargs: method kwargs.
+        """
+        if self._transport is None:
+            raise IOError('Connection closed')
+        self._transport.write(b'MSGPACK:' + self._packer.pack((MSGPACKRPC_NOTIFY, method, args, kwargs)))
+
+
+def connect(host, port=None, loop=None, **kwargs):
+    """Opens a connection to a RPC server.
+
+    :param str host: Hostname, or ``unix://`` followed by the path of a Unix
+        domain socket (see :mod:`mprpc.transport`).
+    :param int port: Port number, unused with Unix domain sockets.
+    :param loop: (optional) Event loop.
+    :param kwargs: (optional) Arguments of :class:`RPCClient`.
+    :returns: Future for the :class:`RPCClient`.
+    """
+    loop = loop or asyncio.get_event_loop()
+    client = _create_future(loop)
+
+    def connected(task):
+        if task.cancelled():
+            client.cancel()
+        elif task.exception() is not None:
+            client.set_exception(task.exception())
+        else:
+            client.set_result(task.result()[1])
+
+    path = unix_path(host)
+    if path is None:
+        connection = loop.create_connection(lambda: RPCClient(loop=loop, **kwargs), host, port)
+    else:
+        connection = loop.create_unix_connection(lambda: RPCClient(loop=loop, **kwargs), path)
+    task = asyncio.ensure_future(connection, loop=loop)
+    task.add_done_callback(connected)
+    return client
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import socket
+
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+SENDV_JOIN_SIZE = 64 * 1024
+FILE_CHUNK_SIZE = 256 * 1024
+
+
+class BufferPool(object):
+    """Pool of reusable bytearrays.
+
+    Buffers are handed out by power-of-two size classes, so a buffer released
+    after one large transfer serves the next transfer of a similar size
+    without a new allocation.
+
+    :param int max_bytes: (optional) Total size of the buffers kept for reuse.
+    :param int min_size: (optional) Size of the smallest buffer.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2, min_size=4096):
+        self._max_bytes = max_bytes
+        self._min_size = min_size
+        self._pooled_bytes = 0
+        self._free = {}
+
+    def acquire(self, size):
+        """Returns a bytearray of at least ``size`` bytes.
+
+        :rtype: bytearray
+        """
+        size = max(size, self._min_size)
+        size = 1 << (size - 1).bit_length()
+        buffers = self._free.get(size)
+        if buffers:
+            self._pooled_bytes -= size
+            return buffers.pop()
+        return bytearray(size)
+
+    def release(self, buf):
+        """Returns a buffer obtained by :meth:`acquire` to the pool."""
+        size = len(buf)
+        if self._pooled_bytes + size > self._max_bytes:
+            return
+        self._free.setdefault(size, []).append(buf)
+        self._pooled_bytes += size
+
+
+def sendv(sock, parts):
+    """Sends a sequence of bytes-like objects without concatenating them.
+
+    Uses scatter-gather ``sendmsg`` where the socket supports it. Otherwise
+    small messages are joined into one send, and larger ones are sent part by
+    part with ``MSG_MORE`` so that the kernel does not push a short header
+    segment on its own.
+    """
+    parts = [part for part in parts if len(part)]
+    if hasattr(sock, 'sendmsg'):
+        views = [memoryview(part) for part in parts]
+        while views:
+            sent = sock.sendmsg(views)
+            while sent:
+                if sent >= len(views[0]):
+                    sent -= len(views.pop(0))
+                else:
+                    views[0] = views[0][sent:]
+                    sent = 0
+    elif sum(len(part) for part in parts) <= SENDV_JOIN_SIZE:
+        sock.sendall(b''.join([part if isinstance(part, bytes) else memoryview(part).tobytes()
+                               for part in parts]))
+    elif parts:
+        for part in parts[:-1]:
+            sock.sendall(part, MSG_MORE)
+        sock.sendall(parts[-1])
+
+
+def file_size(fileobj):
+    """Returns the number of bytes left to read from a file-like object, or
+    None if it cannot be told without reading it."""
+    try:
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except Exception:
+        pass
+    try:
+        offset = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell() - offset
+        fileobj.seek(offset)
+        return size
+    except Exception:
+        return None
+
+
+def sendfile(sock, fileobj, count, wait_write=None):
+    """Sends ``count`` bytes of a file-like object from its current position.
+
+    Real files go through the kernel with ``os.sendfile`` where it exists.
+    Anything else is copied through one bounded buffer with ``readinto``.
+
+    :param wait_write: (optional) Called with the socket's file descriptor
+        when a non-blocking socket is not writable, e.g.
+        ``gevent.socket.wait_write``.
+    """
+    sent = 0
+    try:
+        fileno = fileobj.fileno()
+    except Exception:
+        fileno = None
+    if fileno is not None and hasattr(os, 'sendfile'):
+        offset = fileobj.tell()
+        while sent < count:
+            try:
+                size = os.sendfile(sock.fileno(), fileno, offset + sent, count - sent)
+            except OSError as e:
+                if e.errno != errno.EAGAIN or wait_write is None:
+                    raise
+                wait_write(sock.fileno())
+                continue
+            if not size:
+                break
+            sent += size
+        fileobj.seek(offset + sent)
+    else:
+        view = memoryview(bytearray(min(count, FILE_CHUNK_SIZE) or 1))
+        while sent < count:
+            chunk = view[:min(count - sent, len(view))]
+            if hasattr(fileobj, 'readinto'):
+                size = fileobj.readinto(chunk)
+            else:
+                data = fileobj.read(len(chunk))
+                size = len(data)
+                chunk[:size] = data
+            if not size:
+                break
+            sock.sendall(chunk[:size])
+            sent += size
+    if sent < count:
+        raise IOError('File truncated: %d < %d bytes' % (sent, count))
+    return sent
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import OrderedDict
+
+import msgpack
+try:
+    from gevent.event import AsyncResult
+except:
+    pass
+
+_key_packer = msgpack.Packer(encoding='utf-8')
+
+
+def make_key(args, kwargs):
+    """Returns the cache key of a call, the packed arguments. Lists and
+    tuples give the same key, as do str and unicode."""
+    return _key_packer.pack((args, sorted(kwargs.iteritems())))
+
+
+class LRUCache(object):
+    """Least recently used cache with optional expiry.
+
+    :param int maxsize: (optional) Maximum number of entries.
+    :param float ttl: (optional) Seconds an entry is valid for.
+    :param int maxbytes: (optional) Maximum total size of the values.
+    :param getsize: (optional) Function returning the size of a value. Set it
+        to None to cache values other than byte strings, without
+        ``maxbytes``.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, maxbytes=None, getsize=len):
+        assert maxsize > 0, 'Max size must be a positive value'
+        assert getsize is not None or maxbytes is None, 'Max bytes requires getsize'
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._getsize = getsize or (lambda value: 0)
+        self._bytes = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the value cached for ``key``, or None."""
+        entry = self._entries.pop(key, None)
+        if entry is None or (entry[0] is not None and entry[0] <= time.time()):
+            if entry is not None:
+                self._bytes -= self._getsize(entry[1])
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """Caches ``value`` for ``key``.
+
+        :param float ttl: (optional) Seconds the entry is valid for, instead
+            of the cache's ``ttl``.
+        """
+        self.invalidate(key)
+        size = self._getsize(value)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        self._entries[key] = (expires, value)
+        self._bytes += size
+        while len(self._entries) > self.maxsize or (self.maxbytes is not None and self._bytes > self.maxbytes):
+            self._bytes -= self._getsize(self._entries.popitem(last=False)[1][1])
+
+    def invalidate(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= self._getsize(entry[1])
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def info(self):
+        """Returns the hit and miss counters and the current size.
+
+        :rtype: dict
+        """
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries), bytes=self._bytes)
+
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time. Callers arriving while a
+    call is in flight wait for its result, or its exception, instead. If the
+    caller running the call is killed or times out, the others get a
+    ``RuntimeError``.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+
+    def run(self, key, func, *args):
+        waiter = self._in_flight.get(key)
+        if waiter is not None:
+            self.coalesced += 1
+            return waiter.get()
+        self.calls += 1
+        waiter = self._in_flight[key] = AsyncResult()
+        try:
+            value = func(*args)
+        except Exception as e:
+            waiter.set_exception(e)
+            raise
+        except BaseException:
+            # GreenletExit and gevent.Timeout are meant for this caller only
+            waiter.set_exception(RuntimeError('coalesced call aborted'))
+            raise
+        else:
+            waiter.set(value)
+            return value
+        finally:
+            del self._in_flight[key]
+
+    def info(self):
+        """Returns the number of calls run and of callers that waited for
+        another's call instead.
+
+        :rtype: dict
+        """
+        return dict(calls=self.calls, coalesced=self.coalesced, in_flight=len(self._in_flight))
@@ -7,6 +7,7 @@ except:
     pass
 try:
     import msgpack
+    from msgpack import ExtType
 except:
     pass
 import time
@@ -16,15 +17,48 @@ except:
     import pickle
 try:
     import gevent
+    from gevent import socket
+    from gevent.event import AsyncResult
+    from gevent.queue import Queue, Empty
 except:
     pass
+try:
+    from gevent.lock import Semaphore
+except:
+    try:
+        from gevent.coros import Semaphore
+    except:
+        pass
 try:
     from gsocketpool.connection import Connection
 except:
     class Connection:pass
 
-from constants import MSGPACKRPC_REQUEST, MSGPACKRPC_RESPONSE, SOCKET_RECV_SIZE,METHOD_RECV_SIZE,METHOD_STRINGS_SIZE,METHOD_URIHTTP_SIZE
-from exceptions import MethodNotFoundError, RPCProtocolError,RPCError
+from constants import MSGPACKRPC_REQUEST, MSGPACKRPC_RESPONSE, MSGPACKRPC_NOTIFY, MSGPACKRPC_BATCH, MSGPACKRPC_MAX_MSGID, SOCKET_RECV_SIZE,METHOD_RECV_SIZE,METHOD_STRINGS_SIZE,METHOD_URIHTTP_SIZE
+from constants import MSGPACKRPC_CHUNK, MSGPACKRPC_CREDIT, MSGPACKRPC_CANCEL, MSGPACKRPC_RING, COMPRESS_THRESHOLD, COMPRESS_LEVEL
+from constants import SERVER_BUSY_ERROR, DEADLINE_EXCEEDED_ERROR, SHM_THRESHOLD
+from cache import LRUCache, make_key
+from compression import Deflater, Inflater
+from transport import connect, unix_path
+from shm import SharedRing, SharedRegions, export
+from exceptions import MethodNotFoundError, RPCProtocolError,RPCError, ServerBusyError, DeadlineExceededError
+
+class _StreamWaiter(object):
+    # Takes the place of an AsyncResult for a stream, queueing every frame
+    def __init__(self):
+        self._queue = Queue()
+    def set(self, response):
+        self._queue.put(response)
+    def set_exception(self, exc):
+        self._queue.put(exc)
+    def get(self, timeout=None):
+        try:
+            response = self._queue.get(timeout=timeout)
+        except Empty:
+            raise socket.timeout('timed out')
+        if isinstance(response, BaseException):
+            raise response
+        return response
 
 cdef class RPCClient:
     """RPC client.
@@ -35,26 +69,92 @@ cdef class RPCClient:
         >>> print client.call('sum', 1, 2)
         3
 
-    :param str host: Hostname.
-    :param int port: Port number.
-    :param int timeout: (optional) Socket timeout.
+    In multiplexed mode, any number of greenlets may call concurrently over
+    the same connection. Requests are pipelined and a single reader greenlet
+    hands each response to the caller waiting on its message ID.
+
+        >>> import gevent.pool
+        >>> client = RPCClient('127.0.0.1', 6000, multiplex=True)
+        >>> print gevent.pool.Pool(10).map(lambda n: client.call('sum', n, n), xrange(5))
+        [0, 2, 4, 6, 8]
+
+    :param str host: Hostname, or ``unix://`` followed by the path of a Unix
+        domain socket (see :mod:`mprpc.transport`).
+    :param int port: Port number, unused with Unix domain sockets.
+    :param int timeout: (optional) Socket timeout. In multiplexed mode, this is
+        the per-call timeout.
     :param bool lazy: (optional) If set to True, the socket connection is not
         established until you specifically call open()
     :param str pack_encoding: (optional) Character encoding used to pack data
         using Messagepack.
     :param str unpack_encoding: (optional) Character encoding used to unpack
         data using Messagepack.
+    :param bool multiplex: (optional) If set to True, concurrent calls share
+        the connection instead of blocking each other.
+    :param int stream_window: (optional) Number of streamed items the server
+        may send ahead of the consumer in :meth:`call_stream`.
+    :param dict cache: (optional) Maps the names of idempotent methods to the
+        number of seconds their results are cached for. Calls answered from
+        the cache make no round trip. Every request then asks for the
+        server's cache epoch, and the whole cache is dropped when it changes
+        (see :func:`invalidates <mprpc.decorators.invalidates>`). Cached
+        results are shared, so they must not be modified.
+    :param int cache_size: (optional) Maximum number of cached results.
+    :param bool compress: (optional) If set to True, requests and responses
+        of at least ``compress_threshold`` bytes are compressed with zlib.
+        The server has to support the ``MSGZLIB:`` tag.
+    :param int compress_threshold: (optional) Minimum size of the requests
+        to compress, in bytes.
+    :param int compress_level: (optional) zlib compression level.
+    :param bytes compress_dict: (optional) Preset dictionary, which must be
+        the server's.
+    :param float deadline: (optional) Seconds each call may take. Requests
+        carry it as a budget, and the server drops the ones whose budget ran
+        out before they were executed. In multiplexed mode, a call still
+        unanswered by then raises :class:`DeadlineExceededError
+        <mprpc.exceptions.DeadlineExceededError>` and tells the server to
+        cancel it.
+    :param int shared_memory: (optional) Size in bytes of a ring in shared
+        memory that large bytes-like arguments are written to, instead of
+        the socket. The server then writes large results to its own ring,
+        and they are returned as ``memoryview`` objects (see
+        :mod:`mprpc.shm`). The server has to run on the same host with
+        ``shared_memory`` set, and be reached through a Unix domain socket.
+        Not available with ``compress``.
+    :param int shared_memory_threshold: (optional) Minimum size of the
+        arguments and results transferred through shared memory, in bytes.
     """
 
     cdef str _host
-    cdef int _port
+    cdef _port
     cdef int _msg_id
     cdef _timeout
     cdef _socket
     cdef _packer
     cdef _unpacker
+    cdef bint _multiplex
+    cdef dict _pending
+    cdef _reader
+    cdef _send_lock
+    cdef int _stream_window
+    cdef _cache
+    cdef dict _cache_ttls
+    cdef _cache_epoch
+    cdef dict _options
+    cdef bytes _tag
+    cdef _deflater
+    cdef _inflater
+    cdef _deadline
+    cdef _shm_size
+    cdef Py_ssize_t _shm_threshold
+    cdef _shm_ring
+    cdef _shm_regions
+    cdef dict _shm_records
 
-    def __init__(self, host, port, timeout=None, lazy=False, pack_encoding='utf-8', unpack_encoding='utf-8'):
+    def __init__(self, host, port=None, timeout=None, lazy=False, pack_encoding='utf-8', unpack_encoding='utf-8',
+                 multiplex=False, stream_window=64, cache=None, cache_size=1024, compress=False,
+                 compress_threshold=COMPRESS_THRESHOLD, compress_level=COMPRESS_LEVEL, compress_dict=None,
+                 deadline=None, shared_memory=None, shared_memory_threshold=SHM_THRESHOLD):
         self._host = host
         self._port = port
         self._timeout = timeout
@@ -62,6 +162,41 @@ cdef class RPCClient:
         self._socket = None
         self._packer = msgpack.Packer(encoding=pack_encoding)
         self._unpacker = msgpack.Unpacker(encoding=unpack_encoding, use_list=False)
+        if compress:
+            self._tag = b'MSGZLIB:'
+            self._deflater = Deflater(compress_threshold, compress_level, compress_dict)
+            self._inflater = Inflater(unpack_encoding, compress_dict)
+        else:
+            self._tag = b'MSGPACK:'
+            self._deflater = None
+            self._inflater = None
+        self._multiplex = multiplex
+        self._pending = {}
+        self._reader = None
+        self._send_lock = Semaphore()
+        assert stream_window > 0, 'Stream window must be a positive value'
+        self._stream_window = stream_window
+        if cache:
+            self._cache = LRUCache(cache_size, getsize=None)
+            self._cache_ttls = dict(cache)
+            self._options = {'epoch': True}
+        else:
+            self._cache = None
+            self._cache_ttls = None
+            self._options = None
+        self._cache_epoch = None
+        self._deadline = deadline
+        self._shm_size = shared_memory
+        self._shm_threshold = shared_memory_threshold
+        self._shm_ring = None
+        self._shm_regions = None
+        self._shm_records = {}
+        if shared_memory:
+            assert not compress, 'Shared memory cannot be combined with compression'
+            assert unix_path(host) is not None, 'Shared memory requires a Unix domain socket'
+            self._shm_regions = SharedRegions(track=True)
+            self._unpacker = msgpack.Unpacker(encoding=unpack_encoding, use_list=False, ext_hook=self._shm_regions)
+            self._options = dict(self._options or {}, shm=True)
         if not lazy:
             self.open()
 
@@ -69,18 +204,32 @@ cdef class RPCClient:
         """Opens a connection."""
         assert self._socket is None, 'The connection has already been established'
         logging.debug('openning a msgpackrpc connection')
-        self._socket = gevent.socket.create_connection((self._host, self._port))
-        if self._timeout:
+        self._socket = connect(self._host, self._port, socket)
+        if self._shm_size:
+            self._shm_ring = SharedRing(self._shm_size)
+            self._socket.sendall(self._frame(self._shm_ring.announcement()))
+        if self._multiplex:
+            self._reader = gevent.spawn(self._mux_read)
+        elif self._timeout:
             self._socket.settimeout(self._timeout)
     def close(self):
         """Closes the connection."""
         assert self._socket is not None, 'Attempt to close an unopened socket'
         logging.debug('Closing a msgpackrpc connection')
+        if self._reader is not None:
+            self._reader.kill(block=False)
+            self._reader = None
         try:
             self._socket.close()
         except:
             logging.exception('An error has occurred while closing the socket')
         self._socket = None
+        self._mux_fail(IOError('Connection closed'))
+        if self._shm_ring is not None:
+            self._shm_ring.close()
+            self._shm_regions.close()
+            self._shm_ring = None
+            self._shm_records.clear()
     def is_connected(self):
         """Returns whether the connection has already been established.
 
@@ -91,21 +240,98 @@ cdef class RPCClient:
         else:
             return False
 
-    cdef bytes _msgpack_create_request(self, method, tuple args,dict kwargs):
-        self._msg_id += 1
+    def test_connect(self):
+        """Returns whether the server answers on the connection.
+
+        :rtype: bool
+        """
+        if not self._socket:
+            return False
+        return self.call('test_connect') == '1'
+
+    cdef int _next_msg_id(self):
+        while True:
+            if self._msg_id >= MSGPACKRPC_MAX_MSGID:
+                self._msg_id = 0
+            self._msg_id += 1
+            if self._msg_id not in self._pending:
+                return self._msg_id
+
+    cdef bytes _msgpack_create_request(self, method, tuple args,dict kwargs, deadline=None):
         cdef tuple req
-        req = (MSGPACKRPC_REQUEST, self._msg_id, method, args, kwargs)
-        return 'MSGPACK:'+self._packer.pack(req)
-    cdef _msgpack_parse_response(self, tuple response):
+        options = self._options
+        if self._shm_ring is not None:
+            (args, kwargs, options) = self._shm_export(args, kwargs, options)
+        if deadline is not None:
+            options = dict(options or {}, budget=deadline)
+        if options is None:
+            req = (MSGPACKRPC_REQUEST, self._next_msg_id(), method, args, kwargs)
+        else:
+            req = (MSGPACKRPC_REQUEST, self._next_msg_id(), method, args, kwargs, options)
+        if self._shm_ring is not None and self._shm_ring.generation != options['shm']:
+            # Records written for the request, released with its response
+            self._shm_records[self._msg_id] = (options['shm'] + 1, self._shm_ring.generation)
+        return self._frame(req)
+    cdef tuple _shm_export(self, tuple args, dict kwargs, options):
+        ring = self._shm_ring
+        # The generation before the request's records, which also tells the
+        # server that results may be written to its ring
+        options = dict(options, shm=ring.generation)
+        if self._shm_regions.released:
+            options['release'] = self._shm_regions.released
+            self._shm_regions.released = []
+        args = tuple([export(ring, arg, self._shm_threshold) for arg in args])
+        if kwargs:
+            kwargs = dict([(key, export(ring, value, self._shm_threshold)) for (key, value) in kwargs.iteritems()])
+        return (args, kwargs, options)
+    cdef bint _shm_announced(self, response):
+        # Any message from the server follows its mapping of the ring
+        self._shm_ring.unlink()
+        if type(response) is tuple and len(response) == 2 and response[0] == MSGPACKRPC_RING:
+            self._shm_regions.announce(response[1])
+            return True
+        return False
+    cdef _shm_release(self, msg_id):
+        records = self._shm_records.pop(msg_id, None)
+        if records is not None:
+            for generation in xrange(records[0], records[1] + 1):
+                self._shm_ring.release(generation)
+    cdef bytes _frame(self, tuple msg):
+        if self._deflater is None:
+            return self._tag+self._packer.pack(msg)
+        return self._tag+self._deflater.compress(self._packer.pack(msg))
+    cdef _next_response(self):
+        # Raises StopIteration once the buffered data is used up
+        response = self._unpacker.next()
+        if self._inflater is not None and type(response) is ExtType:
+            return self._inflater.inflate(response)
+        while self._shm_ring is not None and self._shm_announced(response):
+            response = self._unpacker.next()
+        return response
+    cdef _msgpack_parse_response(self, tuple response, int expected_id):
         cdef int msg_id
-        if (len(response) != 4 or response[0] != MSGPACKRPC_RESPONSE):
+        if (len(response) not in (4, 5) or response[0] != MSGPACKRPC_RESPONSE):
             raise RPCProtocolError('Invalid protocol')
-        (_, msg_id, error, result) = response
-        if msg_id != self._msg_id:
+        (msg_id, error, result) = response[1:4]
+        if self._shm_records:
+            self._shm_release(msg_id)
+        if len(response) == 5:
+            self._sync_cache_epoch(response[4])
+        if msg_id != expected_id:
             raise RPCError('Invalid Message ID')
         if error:
+            if error == SERVER_BUSY_ERROR:
+                raise ServerBusyError(error)
+            if error == DEADLINE_EXCEEDED_ERROR:
+                raise DeadlineExceededError(error)
             raise RPCError(str(error))
         return result
+    cdef _msgpack_send(self, bytes req):
+        self._send_lock.acquire()
+        try:
+            self._socket.sendall(req)
+        finally:
+            self._send_lock.release()
     def msgpack_call(self, str method, *args, **kwargs):
         """Calls a RPC method.
 
@@ -113,8 +339,27 @@ cdef class RPCClient:
         :param args: Method arguments.
         :param kwargs: method kwargs.
         """
-        cdef bytes req = self._msgpack_create_request(method, args,kwargs)
+        return self._msgpack_call(method, args, kwargs, self._deadline)
+
+    def call_with_deadline(self, deadline, str method, *args, **kwargs):
+        """Calls a RPC method, overriding the client's ``deadline``.
+
+        A server method may pass on what is left of its own budget:
+
+            >>> client.call_with_deadline(self._remaining_budget(), 'lookup', key)
+
+        :param float deadline: Seconds the call may take, or None.
+        :param str method: Method name.
+        :param args: Method arguments.
+        :param kwargs: method kwargs.
+        """
+        return self._msgpack_call(method, args, kwargs, deadline)
+
+    cdef _msgpack_call(self, str method, tuple args, dict kwargs, deadline):
+        cdef bytes req = self._msgpack_create_request(method, args, kwargs, deadline)
         cdef bytes data
+        if self._multiplex:
+            return self._msgpack_mux_call(req, self._msg_id, deadline)
         self._socket.sendall(req)
         while True:
             data = self._socket.recv(SOCKET_RECV_SIZE)
@@ -122,15 +367,263 @@ cdef class RPCClient:
                 raise IOError('Connection closed')
             self._unpacker.feed(data)
             try:
-                response = self._unpacker.next()
+                response = self._next_response()
                 break
             except StopIteration:
                 continue
-        return self._msgpack_parse_response(response)
+        return self._msgpack_parse_response(response, self._msg_id)
 
     def call(self, str method, *args, **kwargs):
+        if self._cache is not None and method in self._cache_ttls:
+            return self._cached_call(method, args, kwargs)
         return self.msgpack_call(method, *args, **kwargs)
 
+    def notify(self, str method, *args, **kwargs):
+        """Sends a notification, calling a RPC method without waiting for it.
+
+        The server writes no response, so errors, including unknown methods,
+        are not reported back. Notifications sent back to back are pipelined
+        on the connection. Arguments are always sent over the socket, even
+        with ``shared_memory``.
+
+        Usage:
+            >>> client.notify('log', 'info', 'user logged in')
+
+        :param str method: Method name.
+        :param args: Method arguments.
+        :param kwargs: method kwargs.
+        """
+        self._msgpack_send(self._frame((MSGPACKRPC_NOTIFY, method, args, kwargs)))
+
+    cdef _cached_call(self, str method, tuple args, dict kwargs):
+        # Results are wrapped in a tuple, so that None can be cached too
+        key = (method, make_key(args, kwargs))
+        entry = self._cache.get(key)
+        if entry is not None:
+            return entry[0]
+        result = self.msgpack_call(method, *args, **kwargs)
+        self._cache.set(key, (result,), self._cache_ttls[method])
+        return result
+    cdef _sync_cache_epoch(self, epoch):
+        if self._cache is not None and epoch != self._cache_epoch:
+            if self._cache_epoch is not None:
+                self._cache.clear()
+            self._cache_epoch = epoch
+    def invalidate_cache(self):
+        """Drops every cached result."""
+        if self._cache is not None:
+            self._cache.clear()
+    def cache_info(self):
+        """Returns the hit and miss counters and the number of cached
+        results, or None when caching is off.
+
+        :rtype: dict
+        """
+        if self._cache is None:
+            return None
+        return self._cache.info()
+
+    def call_many(self, calls):
+        """Calls RPC methods in a single batch.
+
+        All requests are sent in one frame and the server writes all the
+        responses back at once. If any of the calls fails, the first error is
+        raised after the whole batch has been received.
+
+        Usage:
+            >>> client.call_many([('sum', (1, 2)), ('sum', (3, 4), {})])
+            [3, 7]
+
+        :param list calls: Sequence of ``(method, args)`` or
+            ``(method, args, kwargs)`` tuples.
+        :rtype: list
+        """
+        cdef list reqs = []
+        cdef list msg_ids = []
+        cdef dict responses = {}
+        cdef bytes data
+        cdef int msg_id
+        for call in calls:
+            if len(call) == 2:
+                (method, args), kwargs = call, {}
+            else:
+                (method, args, kwargs) = call
+            msg_id = self._next_msg_id()
+            msg_ids.append(msg_id)
+            reqs.append((MSGPACKRPC_REQUEST, msg_id, method, tuple(args), kwargs))
+        if not reqs:
+            return []
+        data = self._frame((MSGPACKRPC_BATCH, reqs))
+        if self._multiplex:
+            responses = self._msgpack_mux_batch(data, msg_ids)
+        else:
+            self._socket.sendall(data)
+            while len(responses) < len(msg_ids):
+                try:
+                    response = self._next_response()
+                except StopIteration:
+                    data = self._socket.recv(SOCKET_RECV_SIZE)
+                    if not data:
+                        raise IOError('Connection closed')
+                    self._unpacker.feed(data)
+                    continue
+                if type(response) is not tuple or len(response) < 2:
+                    raise RPCProtocolError('Invalid protocol')
+                responses[response[1]] = response
+        return [self._msgpack_parse_response(responses.get(msg_id, ()), msg_id) for msg_id in msg_ids]
+
+    def call_stream(self, str method, *args, **kwargs):
+        """Calls a RPC method and iterates over its result as the server
+        streams it.
+
+        Items arrive one chunk at a time, so a generator on the server never
+        has to be built into a list. The server runs at most ``stream_window``
+        items ahead of the consumer. Closing the iterator early cancels the
+        rest of the stream.
+
+        Usage:
+            >>> for row in client.call_stream('scan', 'users'):
+            ...     print row
+
+        :param str method: Method name.
+        :param args: Method arguments.
+        :param kwargs: method kwargs.
+        """
+        cdef int msg_id = self._next_msg_id()
+        cdef int step = max(1, self._stream_window // 2)
+        cdef int consumed = 0
+        cdef bint done = False
+        cdef tuple response
+        waiter = None
+        if self._multiplex:
+            if self._reader is None or self._reader.ready():
+                raise IOError('Connection closed')
+            waiter = self._pending[msg_id] = _StreamWaiter()
+        try:
+            self._msgpack_send(self._frame(
+                (MSGPACKRPC_REQUEST, msg_id, method, args, kwargs, {'stream': self._stream_window})))
+            while True:
+                response = self._stream_recv(waiter)
+                if response[0] != MSGPACKRPC_CHUNK:
+                    done = True
+                    self._msgpack_parse_response(response, msg_id)
+                    return
+                if len(response) != 3 or response[1] != msg_id:
+                    raise RPCProtocolError('Invalid protocol')
+                yield response[2]
+                consumed += 1
+                if consumed >= step:
+                    self._msgpack_send(self._frame((MSGPACKRPC_CREDIT, msg_id, consumed)))
+                    consumed = 0
+        finally:
+            if waiter is not None:
+                self._pending.pop(msg_id, None)
+            if not done:
+                self._stream_cancel(msg_id, waiter)
+    cdef tuple _stream_recv(self, waiter):
+        cdef bytes data
+        if waiter is not None:
+            return waiter.get(timeout=self._timeout)
+        while True:
+            try:
+                return self._next_response()
+            except StopIteration:
+                data = self._socket.recv(SOCKET_RECV_SIZE)
+                if not data:
+                    raise IOError('Connection closed')
+                self._unpacker.feed(data)
+    cdef _stream_cancel(self, int msg_id, waiter):
+        cdef tuple response
+        try:
+            self._msgpack_send(self._frame((MSGPACKRPC_CANCEL, msg_id, None)))
+            if waiter is not None:
+                return
+            # Chunks already in flight precede the end of the stream
+            while True:
+                response = self._stream_recv(None)
+                if response[0] != MSGPACKRPC_CHUNK and response[1] == msg_id:
+                    break
+        except Exception, e:
+            logging.debug('Failed to cancel a stream: %s', e)
+
+    #####################################################
+    cdef _msgpack_mux_call(self, bytes req, int msg_id, deadline):
+        cdef bint by_deadline = deadline is not None and (self._timeout is None or deadline < self._timeout)
+        if self._reader is None or self._reader.ready():
+            raise IOError('Connection closed')
+        waiter = AsyncResult()
+        self._pending[msg_id] = waiter
+        try:
+            self._msgpack_send(req)
+            try:
+                response = waiter.get(timeout=deadline if by_deadline else self._timeout)
+            except gevent.Timeout:
+                self._msgpack_cancel(msg_id)
+                if by_deadline:
+                    raise DeadlineExceededError('Deadline exceeded')
+                raise socket.timeout('timed out')
+        finally:
+            self._pending.pop(msg_id, None)
+        return self._msgpack_parse_response(response, msg_id)
+    cdef _msgpack_cancel(self, int msg_id):
+        # Tells the server that nobody waits for the response anymore
+        try:
+            self._msgpack_send(self._frame((MSGPACKRPC_CANCEL, msg_id, None)))
+        except Exception, e:
+            logging.debug('Failed to cancel a call: %s', e)
+    cdef dict _msgpack_mux_batch(self, bytes data, list msg_ids):
+        cdef dict responses = {}
+        cdef dict waiters = {}
+        if self._reader is None or self._reader.ready():
+            raise IOError('Connection closed')
+        for msg_id in msg_ids:
+            waiters[msg_id] = self._pending[msg_id] = AsyncResult()
+        try:
+            self._msgpack_send(data)
+            timeout = gevent.Timeout.start_new(self._timeout, socket.timeout('timed out'))
+            try:
+                for (msg_id, waiter) in waiters.iteritems():
+                    responses[msg_id] = waiter.get()
+            finally:
+                timeout.cancel()
+        finally:
+            for msg_id in msg_ids:
+                self._pending.pop(msg_id, None)
+        return responses
+    def _mux_read(self):
+        cdef bytes data
+        try:
+            while True:
+                data = self._socket.recv(SOCKET_RECV_SIZE)
+                if not data:
+                    raise IOError('Connection closed')
+                self._unpacker.feed(data)
+                for response in self._unpacker:
+                    self._mux_dispatch(response)
+        except Exception, e:
+            logging.debug('The msgpackrpc reader has stopped: %s', e)
+            self._mux_fail(e)
+    cdef _mux_dispatch(self, response):
+        if self._inflater is not None and type(response) is ExtType:
+            response = self._inflater.inflate(response)
+        if self._shm_ring is not None and self._shm_announced(response):
+            return
+        if type(response) is not tuple or len(response) < 2:
+            logging.warning('Dropping a malformed response')
+            return
+        waiter = self._pending.get(response[1])
+        if waiter is None:
+            if self._shm_records:
+                self._shm_release(response[1])
+            logging.debug('Dropping a response for an unknown message ID: %s', response[1])
+            return
+        waiter.set(response)
+    cdef _mux_fail(self, exc):
+        cdef list waiters = self._pending.values()
+        self._pending.clear()
+        for waiter in waiters:
+            waiter.set_exception(exc)
+
 class RPCPoolClient(RPCClient, Connection):
     """Wrapper class of :class:`RPCClient <mprpc.client.RPCClient>` for `gsocketpool <https://github.com/studio-ousia/gsocketpool>`_.
 
@@ -143,8 +636,8 @@ class RPCPoolClient(RPCClient, Connection):
         ... 
         3
 
-    :param str host: Hostname.
-    :param int port: Port number.
+    :param str host: Hostname, or ``unix://`` followed by a socket path.
+    :param int port: Port number, unused with Unix domain sockets.
     :param int timeout: (optional) Socket timeout.
     :param int lifetime: (optional) Connection lifetime in seconds. Only valid
         when used with `gsocketpool.pool.Pool <http://gsocketpool.readthedocs.org/en/latest/api.html#gsocketpool.pool.Pool>`_.
@@ -154,7 +647,7 @@ class RPCPoolClient(RPCClient, Connection):
         data using Messagepack.
     """
 
-    def __init__(self, host, port, timeout=None, lifetime=None, pack_encoding='utf-8', unpack_encoding='utf-8'):
+    def __init__(self, host, port=None, timeout=None, lifetime=None, pack_encoding='utf-8', unpack_encoding='utf-8'):
         if lifetime:
             assert lifetime > 0, 'Lifetime must be a positive value'
             self._lifetime = time.time() + lifetime
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
 import urllib
 import socket
@@ -12,13 +13,22 @@ try:
 except:
     import pickle
 
+from buffers import sendv, FILE_CHUNK_SIZE
+from cache import LRUCache, make_key
+from codec import get_codec
+from constants import SERVER_BUSY_ERROR
+from transport import connect
+
 MSGPACKRPC_REQUEST = 0
 MSGPACKRPC_RESPONSE = 1
+MSGPACKRPC_NOTIFY = 2
+MSGPACKRPC_BATCH = 3
 SOCKET_RECV_SIZE = 1024 ** 2
 #MSGPACK,STRINGS,PICKLES
 METHOD_RECV_SIZE = 8
 METHOD_STRINGS_SIZE = 30
 METHOD_URIHTTP_SIZE = 512
+BUFFERS_RECV_SIZE = 4096
 
 class RPCProtocolError(Exception):
     pass
@@ -26,10 +36,16 @@ class MethodNotFoundError(Exception):
     pass
 class RPCError(Exception):
     pass
+class ServerBusyError(RPCError):
+    pass
 
 #####################################
 class ClientRPC(object):
-    def __init__(self, host, port, timeout=None, lazy=False,pack_encoding='utf-8', unpack_encoding='utf-8'):
+    _cache = None
+    _options = None
+    def __init__(self, host, port=None, timeout=None, lazy=False,pack_encoding='utf-8', unpack_encoding='utf-8',
+                 cache=None, cache_size=1024):
+        #cache maps idempotent method names to the seconds their results are kept
         self._host = host
         self._port = port
         self._timeout = timeout
@@ -37,6 +53,11 @@ class ClientRPC(object):
         self._socket = None
         self._packer = msgpack.Packer(encoding=pack_encoding)
         self._unpacker = msgpack.Unpacker(encoding=unpack_encoding, use_list=False)
+        if cache:
+            self._cache = LRUCache(cache_size, getsize=None)
+            self._cache_ttls = dict(cache)
+            self._options = {'epoch': True}
+        self._cache_epoch = None
         if not lazy:
             self.open()
     def test_connect(self,*args,**kwargs):
@@ -50,8 +71,7 @@ class ClientRPC(object):
         return result
     def open(self):
         assert self._socket is None, 'The connection has already been established'
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.connect((self._host, self._port))
+        self._socket = connect(self._host, self._port, socket)
         if self._timeout:
             self._socket.settimeout(self._timeout)
     def close(self):
@@ -66,6 +86,22 @@ class ClientRPC(object):
             return True
         else:
             return False
+    def _recv_exact(self, length):
+        data = ''
+        while len(data) < length:
+            chunk = self._socket.recv(length - len(data))
+            if not chunk:
+                raise IOError('Connection closed')
+            data += chunk
+        return data
+    def _recv_into(self, view, length):
+        received = 0
+        while received < length:
+            size = self._socket.recv_into(view[received:length])
+            if not size:
+                raise IOError('Connection closed')
+            received += size
+        return view[:length]
     def msgpack_call(self, method, *args,**kwargs):
         req = self._msgpack_create_request(method, args,kwargs)
         self._socket.sendall(req)
@@ -80,63 +116,235 @@ class ClientRPC(object):
             except StopIteration:
                 continue
         return self._msgpack_parse_response(response)
+    def notify(self, method, *args, **kwargs):
+        #no response is written for notifications
+        self._socket.sendall('MSGPACK:'+self._packer.pack((MSGPACKRPC_NOTIFY, method, args, kwargs)))
     def _msgpack_create_request(self, method, args,kwargs):
         self._msg_id += 1
-        req = (MSGPACKRPC_REQUEST, self._msg_id, method, args,kwargs)
+        if self._options is None:
+            req = (MSGPACKRPC_REQUEST, self._msg_id, method, args,kwargs)
+        else:
+            req = (MSGPACKRPC_REQUEST, self._msg_id, method, args,kwargs, self._options)
         return 'MSGPACK:'+self._packer.pack(req)
-    def _msgpack_parse_response(self,response):
-        if (len(response) != 4 or response[0] != MSGPACKRPC_RESPONSE):
+    def _msgpack_parse_response(self,response,expected_id=None):
+        if (len(response) not in (4, 5) or response[0] != MSGPACKRPC_RESPONSE):
             raise RPCProtocolError('Invalid protocol')
-        (_, msg_id, error, result) = response
-        if msg_id != self._msg_id:
+        (msg_id, error, result) = response[1:4]
+        if len(response) == 5:
+            self._sync_cache_epoch(response[4])
+        if msg_id != (expected_id or self._msg_id):
             raise RPCError('Invalid Message ID')
         if error:
+            if error == SERVER_BUSY_ERROR:
+                raise ServerBusyError(error)
             raise RPCError(str(error))
         return result
     def call(self, method, *args, **kwargs):
+        if self._cache is not None and method in self._cache_ttls:
+            return self._cached_call(method, args, kwargs)
         return self.msgpack_call(method, *args, **kwargs)
+    def _cached_call(self, method, args, kwargs):
+        key = (method, make_key(args, kwargs))
+        entry = self._cache.get(key)
+        if entry is not None:
+            return entry[0]
+        result = self.msgpack_call(method, *args, **kwargs)
+        self._cache.set(key, (result,), self._cache_ttls[method])
+        return result
+    def _sync_cache_epoch(self, epoch):
+        if self._cache is not None and epoch != self._cache_epoch:
+            if self._cache_epoch is not None:
+                self._cache.clear()
+            self._cache_epoch = epoch
+    def invalidate_cache(self):
+        if self._cache is not None:
+            self._cache.clear()
+    def cache_info(self):
+        if self._cache is None:
+            return None
+        return self._cache.info()
+    def call_many(self, calls):
+        reqs=[]
+        msg_ids=[]
+        for call in calls:
+            if len(call)==2:
+                (method, args), kwargs = call, {}
+            else:
+                (method, args, kwargs) = call
+            self._msg_id += 1
+            msg_ids.append(self._msg_id)
+            reqs.append((MSGPACKRPC_REQUEST, self._msg_id, method, tuple(args), kwargs))
+        if not reqs:
+            return []
+        self._socket.sendall('MSGPACK:'+self._packer.pack((MSGPACKRPC_BATCH, reqs)))
+        responses={}
+        while len(responses) < len(msg_ids):
+            try:
+                response = self._unpacker.next()
+            except StopIteration:
+                data = self._socket.recv(SOCKET_RECV_SIZE)
+                if not data:
+                    raise IOError('Connection closed')
+                self._unpacker.feed(data)
+                continue
+            if len(response) < 2:
+                raise RPCProtocolError('Invalid protocol')
+            responses[response[1]] = response
+        return [self._msgpack_parse_response(responses.get(msg_id, ()), msg_id) for msg_id in msg_ids]
 
 #####################################
-class ClientPIK(ClientRPC):
-    def __init__(self, host, port, timeout=None, lazy=False,pack_encoding='utf-8', unpack_encoding='utf-8'):
+class ClientCOD(ClientRPC):
+    tag = None
+    def __init__(self, host, port=None, timeout=None, lazy=False,pack_encoding='utf-8', unpack_encoding='utf-8'):
         self._host = host
         self._port = port
         self._timeout = timeout
         self._msg_id = 0
         self._socket = None
+        self._codec = get_codec(self.tag)
+        self._state = self._codec.new_state()
+        self._buffer = None
         if not lazy:
             self.open()
-    def pickles_call(self, method, *args,**kwargs):
-        req = self._pickles_create_request(method, args,kwargs)
+    def codec_call(self, method, *args,**kwargs):
+        req = self._codec_create_request(method, args,kwargs)
         self._socket.sendall(req)
-        data = self._socket.recv(SOCKET_RECV_SIZE)
-        if not data:
-            raise IOError('Connection closed')
-        try:
-            response = pickle.loads(data)
-        except:
-            raise
-        return self._pickles_parse_response(response)
-    def _pickles_create_request(self, method, args,kwargs):
+        length = self._codec.unpack_header(self._recv_exact(self._codec.header.size), self._state)
+        response = self._codec.decode(self._recv_into(self._frame_view(length), length), self._state)
+        return self._codec_parse_response(tuple(response))
+    def _frame_view(self, length):
+        if length > SOCKET_RECV_SIZE:
+            return memoryview(bytearray(length))
+        if self._buffer is None:
+            self._buffer = memoryview(bytearray(SOCKET_RECV_SIZE))
+        return self._buffer
+    def _codec_create_request(self, method, args,kwargs):
         self._msg_id += 1
         req = (MSGPACKRPC_REQUEST, self._msg_id, method, args,kwargs)
-        return 'PICKLES:'+pickle.dumps(req)
-    def _pickles_parse_response(self,response):
+        return self.tag+self._codec.frame(req, self._state)
+    def _codec_parse_response(self,response):
         if (len(response) != 4 or response[0] != MSGPACKRPC_RESPONSE):
             raise RPCProtocolError('Invalid protocol')
         (_, msg_id, error, result) = response
         if msg_id != self._msg_id:
             raise RPCError('Invalid Message ID')
         if error:
+            if error == SERVER_BUSY_ERROR:
+                raise ServerBusyError(error)
             raise RPCError(str(error))
         return result
     def call(self, method, *args, **kwargs):
-        return self.pickles_call(method, *args, **kwargs)
+        return self.codec_call(method, *args, **kwargs)
+
+class ClientPIK(ClientCOD):
+    tag = 'PICKLES:'
+    def pickles_call(self, method, *args,**kwargs):
+        return self.codec_call(method, *args, **kwargs)
+
+class ClientJSN(ClientCOD):
+    tag = 'JSONSTR:'
+    def jsonstr_call(self, method, *args,**kwargs):
+        return self.codec_call(method, *args, **kwargs)
+
+
+#####################################
+class ClientBUF(ClientRPC):
+    def __init__(self, host, port=None, timeout=None, lazy=False,pack_encoding='utf-8', unpack_encoding='utf-8'):
+        ClientRPC.__init__(self, host, port, timeout=timeout, lazy=lazy,
+                           pack_encoding=pack_encoding, unpack_encoding=unpack_encoding)
+        self._buffer = None
+    def buffers_call(self, method, body, *args,**kwargs):
+        #The result is only valid until the next call
+        length = self._buffers_request(method, body, args, kwargs)
+        if self._buffer is None or len(self._buffer) < length:
+            self._buffer = bytearray(length)
+        return self._buffers_recv(memoryview(self._buffer)[:length])
+    def buffers_call_into(self, out, method, body, *args,**kwargs):
+        length = self._buffers_request(method, body, args, kwargs)
+        view = memoryview(out)
+        if len(view) < length:
+            self._buffers_recv(memoryview(bytearray(length)))
+            raise ValueError('Buffer too small: %d < %d' % (len(view), length))
+        self._buffers_recv(view[:length])
+        return length
+    def _buffers_request(self, method, body, args, kwargs):
+        self._msg_id += 1
+        body = memoryview(b'' if body is None else body)
+        header = self._packer.pack((MSGPACKRPC_REQUEST, self._msg_id, method, args, kwargs, len(body)))
+        sendv(self._socket, ['BUFFERS:'+header, body])
+        while True:
+            try:
+                response = self._unpacker.next()
+                break
+            except StopIteration:
+                data = self._socket.recv(BUFFERS_RECV_SIZE)
+                if not data:
+                    raise IOError('Connection closed')
+                self._unpacker.feed(data)
+        return self._msgpack_parse_response(response)
+    def _buffers_recv(self, view):
+        data = self._unpacker.read_bytes(len(view))
+        view[:len(data)] = data
+        self._recv_into(view[len(data):], len(view) - len(data))
+        return view
+    def call(self, method, *args, **kwargs):
+        return self.buffers_call(method, *args, **kwargs)
+    def test_connect(self,*args,**kwargs):
+        if not  self._socket:
+            return False
+        return self.buffers_call('test_connect', None, *args, **kwargs).tobytes()=='1'
 
+#####################################
+class ClientFIL(ClientBUF):
+    def fileobj_call(self, method, dest, *args,**kwargs):
+        self._msg_id += 1
+        req = (MSGPACKRPC_REQUEST, self._msg_id, method, args, kwargs)
+        self._socket.sendall('FILEOBJ:'+self._packer.pack(req))
+        while True:
+            try:
+                response = self._unpacker.next()
+                break
+            except StopIteration:
+                data = self._socket.recv(BUFFERS_RECV_SIZE)
+                if not data:
+                    raise IOError('Connection closed')
+                self._unpacker.feed(data)
+        length = self._msgpack_parse_response(response)
+        if isinstance(dest, basestring):
+            with open(dest, 'wb') as f:
+                return self._fileobj_recv(f, length)
+        return self._fileobj_recv(dest, length)
+    def _fileobj_recv(self, dest, length):
+        try:
+            dest.flush()
+            fd = dest.fileno()
+        except Exception:
+            fd = None
+        if self._buffer is None or len(self._buffer) < FILE_CHUNK_SIZE:
+            self._buffer = bytearray(FILE_CHUNK_SIZE)
+        view = memoryview(self._buffer)[:FILE_CHUNK_SIZE]
+        received = 0
+        while received < length:
+            size = min(length - received, FILE_CHUNK_SIZE)
+            chunk = self._buffers_recv(view[:size])
+            if fd is None:
+                dest.write(chunk.tobytes())
+            else:
+                written = 0
+                while written < size:
+                    written += os.write(fd, chunk[written:])
+            received += size
+        return received
+    def call(self, method, *args, **kwargs):
+        return self.fileobj_call(method, *args, **kwargs)
+    def test_connect(self,*args,**kwargs):
+        if not  self._socket:
+            return False
+        return self.msgpack_call('test_connect',*args,**kwargs)=='1'
 
 #####################################
 class ClientSTR(ClientRPC):
-    def __init__(self, host, port, timeout=None, lazy=False,pack_encoding='utf-8', unpack_encoding='utf-8'):
+    def __init__(self, host, port=None, timeout=None, lazy=False,pack_encoding='utf-8', unpack_encoding='utf-8'):
         self._host = host
         self._port = port
         self._timeout = timeout
@@ -212,7 +420,7 @@ def encode_urihttp(method=None,args=None,kwargs=None):
     return result
 
 class ClientURI(ClientRPC):
-    def __init__(self, host, port, timeout=None, lazy=False,pack_encoding='utf-8', unpack_encoding='utf-8'):
+    def __init__(self, host, port=None, timeout=None, lazy=False,pack_encoding='utf-8', unpack_encoding='utf-8'):
         self._host = host
         self._port = port
         self._timeout = timeout
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+import time
+import struct
+import bisect
+import hashlib
+import logging
+
+import gevent
+
+from pool import ConnectionPool
+from exceptions import PoolTimeoutError, ServerBusyError
+from transport import format_endpoint
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+CONSISTENT_HASH = 'consistent_hash'
+
+
+def _ring_hash(value):
+    return struct.unpack('>Q', hashlib.md5(value).digest()[:8])[0]
+
+
+class _Endpoint(object):
+    def __init__(self, address, pool):
+        self.address = address
+        self.pool = pool
+        self.outstanding = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = None
+
+
+class RPCClusterClient(object):
+    """RPC client balancing calls over several servers exposing the same
+    methods.
+
+    Each endpoint has its own :class:`ConnectionPool
+    <mprpc.pool.ConnectionPool>`. An endpoint that fails ``max_failures``
+    calls in a row, with an ``IOError`` such as a refused connection or a
+    timeout, is ejected from the rotation for ``eject_time`` seconds, doubled
+    on each further ejection up to ``max_eject_time``. Once that time has
+    passed, it is probed with ``test_connect`` and put back if it answers.
+    If every endpoint is ejected, calls are spread over all of them anyway.
+    Errors raised by the RPC methods themselves do not count as failures.
+    Calls turned away with :class:`ServerBusyError
+    <mprpc.exceptions.ServerBusyError>`, which were not executed, are retried
+    on the other endpoints. Other calls are never retried.
+
+    Usage:
+        >>> from mprpc.cluster import RPCClusterClient
+        >>> client = RPCClusterClient([('10.0.0.1', 6000), ('10.0.0.2', 6000)],
+        ...                           policy='consistent_hash')
+        >>> print client.call('sum', 1, 2)
+        3
+        >>> print client.call_by_key('user:42', 'get_profile', 42)
+
+    :param list endpoints: ``(host, port)`` tuples.
+    :param str policy: (optional) ``'round_robin'``, ``'least_outstanding'``
+        or ``'consistent_hash'``. With consistent hashing, calls made with
+        :meth:`call_by_key` for the same key go to the same endpoint while it
+        is available. Calls without a key are spread round-robin.
+    :param factory: (optional) Client class. Defaults to
+        :class:`RPCClient <mprpc.client.RPCClient>`.
+    :param dict options: (optional) Keyword arguments of the client, besides
+        the host and port.
+    :param dict pool_options: (optional) Keyword arguments of each
+        :class:`ConnectionPool <mprpc.pool.ConnectionPool>`.
+    :param int max_failures: (optional) Consecutive failures ejecting an
+        endpoint.
+    :param float eject_time: (optional) Seconds an endpoint is first ejected
+        for.
+    :param float max_eject_time: (optional) Longest ejection, in seconds.
+    :param float probe_interval: (optional) Seconds between checks for
+        ejected endpoints to probe.
+    :param float probe_timeout: (optional) Seconds a probe may take.
+    :param int replicas: (optional) Points per endpoint on the hash ring.
+    """
+
+    def __init__(self, endpoints, policy=ROUND_ROBIN, factory=None, options=None, pool_options=None,
+                 max_failures=3, eject_time=1.0, max_eject_time=30.0, probe_interval=0.5, probe_timeout=1.0,
+                 replicas=100):
+        assert endpoints, 'At least one endpoint is required'
+        assert policy in (ROUND_ROBIN, LEAST_OUTSTANDING, CONSISTENT_HASH), 'Unknown policy: %s' % policy
+        if factory is None:
+            from client import RPCClient as factory
+        self._policy = policy
+        self._max_failures = max_failures
+        self._eject_time = eject_time
+        self._max_eject_time = max_eject_time
+        self._probe_interval = probe_interval
+        self._probe_timeout = probe_timeout
+        self._endpoints = []
+        for (host, port) in endpoints:
+            client_options = dict(options or {}, host=host, port=port)
+            pool = ConnectionPool(factory, client_options, **(pool_options or {}))
+            self._endpoints.append(_Endpoint((host, port), pool))
+        self._next = 0
+        self._ring = []
+        self._ring_endpoints = []
+        if policy == CONSISTENT_HASH:
+            points = []
+            for endpoint in self._endpoints:
+                for replica in xrange(replicas):
+                    points.append((_ring_hash('%s:%s-%d' % (endpoint.address + (replica,))), endpoint))
+            points.sort(key=lambda point: point[0])
+            self._ring = [point[0] for point in points]
+            self._ring_endpoints = [point[1] for point in points]
+        self._prober = gevent.spawn(self._maintain)
+
+    @property
+    def available(self):
+        """Addresses of the endpoints not ejected."""
+        return [endpoint.address for endpoint in self._endpoints if endpoint.ejected_until is None]
+
+    def call(self, method, *args, **kwargs):
+        """Calls a RPC method on the endpoint chosen by the policy.
+
+        :param str method: Method name.
+        :param args: Method arguments.
+        :param kwargs: method kwargs.
+        """
+        attempts = len(self._candidates())
+        tried = []
+        while True:
+            endpoint = self._choose(tried)
+            try:
+                return self._call(endpoint, method, args, kwargs)
+            except ServerBusyError:
+                tried.append(endpoint)
+                if len(tried) >= attempts:
+                    raise
+
+    def call_by_key(self, key, method, *args, **kwargs):
+        """Calls a RPC method on the endpoint owning ``key`` on the hash ring.
+        Other policies ignore the key.
+
+        :param key: Affinity key, such as a cache key.
+        :param str method: Method name.
+        :param args: Method arguments.
+        :param kwargs: method kwargs.
+        """
+        if self._policy != CONSISTENT_HASH:
+            return self.call(method, *args, **kwargs)
+        return self._call(self._choose_by_key(key), method, args, kwargs)
+
+    def close(self):
+        """Closes every connection."""
+        if self._prober is not None:
+            self._prober.kill(block=False)
+            self._prober = None
+        for endpoint in self._endpoints:
+            endpoint.pool.close()
+
+    def _call(self, endpoint, method, args, kwargs):
+        endpoint.outstanding += 1
+        try:
+            ret = endpoint.pool.call(method, *args, **kwargs)
+        except (IOError, PoolTimeoutError):
+            self._failed(endpoint)
+            raise
+        finally:
+            endpoint.outstanding -= 1
+        endpoint.failures = 0
+        return ret
+
+    def _candidates(self):
+        endpoints = [endpoint for endpoint in self._endpoints if endpoint.ejected_until is None]
+        return endpoints or self._endpoints
+
+    def _choose(self, exclude=()):
+        # Busy endpoints are excluded from the retries of a call
+        endpoints = [endpoint for endpoint in self._candidates() if endpoint not in exclude] or self._candidates()
+        self._next = (self._next + 1) % len(endpoints)
+        if self._policy != LEAST_OUTSTANDING:
+            return endpoints[self._next]
+        # Ties go round-robin rather than to the first endpoint
+        endpoints = endpoints[self._next:] + endpoints[:self._next]
+        return min(endpoints, key=lambda endpoint: endpoint.outstanding)
+
+    def _choose_by_key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        index = bisect.bisect(self._ring, _ring_hash(str(key)))
+        for i in xrange(len(self._ring)):
+            endpoint = self._ring_endpoints[(index + i) % len(self._ring)]
+            if endpoint.ejected_until is None:
+                return endpoint
+        return self._ring_endpoints[index % len(self._ring)]
+
+    def _failed(self, endpoint):
+        endpoint.failures += 1
+        if endpoint.ejected_until is None and endpoint.failures >= self._max_failures:
+            self._eject(endpoint)
+
+    def _eject(self, endpoint):
+        eject_time = min(self._eject_time * 2 ** endpoint.ejections, self._max_eject_time)
+        endpoint.ejections += 1
+        endpoint.ejected_until = time.time() + eject_time
+        logging.warning('Ejected %s for %.1f seconds', format_endpoint(*endpoint.address), eject_time)
+
+    def _maintain(self):
+        while True:
+            gevent.sleep(self._probe_interval)
+            now = time.time()
+            for endpoint in self._endpoints:
+                if endpoint.ejected_until is not None and endpoint.ejected_until <= now:
+                    self._probe(endpoint)
+
+    def _probe(self, endpoint):
+        client = None
+        ok = False
+        timeout = gevent.Timeout.start_new(self._probe_timeout)
+        try:
+            client = endpoint.pool.acquire()
+            ok = client.test_connect()
+        except (Exception, gevent.Timeout), e:
+            logging.debug('Probe of %s failed: %s', format_endpoint(*endpoint.address), e)
+        finally:
+            timeout.cancel()
+            if client is not None:
+                endpoint.pool.release(client, discard=not ok)
+        if ok:
+            logging.info('%s is back', format_endpoint(*endpoint.address))
+            endpoint.ejected_until = None
+            endpoint.failures = 0
+            endpoint.ejections = 0
+        else:
+            self._eject(endpoint)
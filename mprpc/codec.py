@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import json
+import struct
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+#PICKLES frames: highest pickle protocol of the sender, payload length
+PICKLES_HEADER = struct.Struct('!BI')
+PICKLES_PROTOCOL = 2
+
+_codecs = {}
+
+
+class Codec(object):
+    """Wire format selected by an 8-byte mode tag.
+
+    A frame is the tag, a header carrying the payload length and the payload.
+    Requests and responses use the MessagePack RPC envelopes
+    ``(0, msg_id, method, args, kwargs)`` and ``(1, msg_id, error, result)``.
+    Subclasses implement :meth:`encode` and :meth:`decode`, and may override
+    the header to carry per-connection state.
+
+    Usage:
+        >>> import marshal
+        >>> import mprpc
+        >>>
+        >>> class MarshalCodec(mprpc.Codec):
+        ...     tag = 'MARSHAL:'
+        ...     def encode(self, obj, state):
+        ...         return marshal.dumps(obj)
+        ...     def decode(self, data, state):
+        ...         return marshal.loads(data.tobytes())
+        ...
+        >>> mprpc.register_codec(MarshalCodec())
+    """
+
+    tag = None
+    header = struct.Struct('!I')
+
+    def new_state(self):
+        """Returns the state kept by each side of a connection."""
+        return None
+
+    def encode(self, obj, state):
+        """Serializes a request or response envelope.
+
+        :rtype: bytes
+        """
+        raise NotImplementedError
+
+    def decode(self, data, state):
+        """Deserializes a request or response envelope.
+
+        :param memoryview data: Payload. Only valid during the call.
+        """
+        raise NotImplementedError
+
+    def pack_header(self, length, state):
+        return self.header.pack(length)
+
+    def unpack_header(self, header, state):
+        """Returns the payload length."""
+        return self.header.unpack(header)[0]
+
+    def frame(self, obj, state):
+        """Returns the header and payload of a frame."""
+        data = self.encode(obj, state)
+        return self.pack_header(len(data), state) + data
+
+
+class PickleCodec(Codec):
+    """Pickle wire format using the highest protocol both sides support."""
+
+    tag = 'PICKLES:'
+    header = PICKLES_HEADER
+
+    def new_state(self):
+        return [PICKLES_PROTOCOL]
+
+    def encode(self, obj, state):
+        return pickle.dumps(obj, state[0])
+
+    def decode(self, data, state):
+        return pickle.loads(data.tobytes())
+
+    def pack_header(self, length, state):
+        return self.header.pack(pickle.HIGHEST_PROTOCOL, length)
+
+    def unpack_header(self, header, state):
+        (protocol, length) = self.header.unpack(header)
+        state[0] = min(protocol, pickle.HIGHEST_PROTOCOL)
+        return length
+
+
+class JsonCodec(Codec):
+    """JSON wire format."""
+
+    tag = 'JSONSTR:'
+
+    def __init__(self, encoding='utf-8'):
+        self._encoder = json.JSONEncoder(encoding=encoding, separators=(',', ':'))
+        self._decoder = json.JSONDecoder(encoding=encoding)
+
+    def encode(self, obj, state):
+        return self._encoder.encode(obj)
+
+    def decode(self, data, state):
+        return self._decoder.decode(data.tobytes())
+
+
+def register_codec(codec):
+    """Registers a codec for its mode tag, replacing any codec already
+    registered for the tag.
+
+    :param codec: :class:`Codec <mprpc.codec.Codec>` instance.
+    """
+    assert codec.tag and len(codec.tag) == 8, 'A mode tag must be 8 bytes long'
+    _codecs[codec.tag] = codec
+
+
+def get_codec(tag):
+    """Returns the codec registered for a mode tag, or None."""
+    return _codecs.get(tag)
+
+
+register_codec(PickleCodec())
+register_codec(JsonCodec())
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+
+import msgpack
+
+from constants import ZLIB_EXT_TYPE, COMPRESS_THRESHOLD, COMPRESS_LEVEL, MAX_INFLATED_SIZE
+from exceptions import RPCProtocolError
+
+
+def _prime(zdict, level=COMPRESS_LEVEL):
+    # zlib has no preset dictionaries on Python 2, so the dictionary is
+    # compressed into a stream instead and the stream is copied for each
+    # message. Any deflate stream of it primes the receiving side.
+    compressor = zlib.compressobj(level)
+    return (compressor, compressor.compress(zdict) + compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+class Deflater(object):
+    """Compresses packed messages of at least ``threshold`` bytes into
+    MessagePack ext values, which an :class:`Inflater` turns back into the
+    messages. A message that does not shrink is left as is.
+
+    :param int threshold: (optional) Minimum size of the messages to
+        compress, in bytes.
+    :param int level: (optional) zlib compression level, from 1 to 9.
+    :param bytes zdict: (optional) Preset dictionary, such as keys and values
+        common in the payloads. Both sides must use the same one.
+    """
+
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL, zdict=None):
+        assert 1 <= level <= 9, 'Compression level must be between 1 and 9'
+        self.threshold = threshold
+        self.level = level
+        self._primed = _prime(zdict, level)[0] if zdict else None
+        self._packer = msgpack.Packer()
+
+    def compress(self, data):
+        """Returns the ext value holding a packed message, or the message
+        itself."""
+        if len(data) < self.threshold:
+            return data
+        if self._primed is None:
+            body = zlib.compress(data, self.level)
+        else:
+            compressor = self._primed.copy()
+            body = compressor.compress(data) + compressor.flush()
+        if len(body) >= len(data):
+            return data
+        return self._packer.pack(msgpack.ExtType(ZLIB_EXT_TYPE, body))
+
+
+class Inflater(object):
+    """Unpacks the messages compressed by a :class:`Deflater`, which the
+    ``msgpack.Unpacker`` of the connection yields as ``ExtType`` values.
+
+    :param str encoding: (optional) Character encoding of the messages.
+    :param bytes zdict: (optional) Preset dictionary of the sender.
+    :param int max_size: (optional) Maximum size of an inflated message, in
+        bytes. Larger messages are refused with :class:`RPCProtocolError
+        <mprpc.exceptions.RPCProtocolError>` before they are inflated whole.
+    """
+
+    def __init__(self, encoding='utf-8', zdict=None, max_size=MAX_INFLATED_SIZE):
+        self._encoding = encoding
+        self.max_size = max_size
+        self._primed = None
+        if zdict:
+            self._primed = zlib.decompressobj()
+            self._primed.decompress(_prime(zdict)[1])
+
+    def inflate(self, ext):
+        """Returns the message held by an ext value."""
+        if ext.code != ZLIB_EXT_TYPE:
+            raise RPCProtocolError('Unknown ext type: %d' % ext.code)
+        if self._primed is None:
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = self._primed.copy()
+        data = decompressor.decompress(ext.data, self.max_size)
+        if not decompressor.unconsumed_tail:
+            data += decompressor.flush()
+        if decompressor.unconsumed_tail or len(data) > self.max_size:
+            raise RPCProtocolError('Inflated message exceeds %d bytes' % self.max_size)
+        return msgpack.unpackb(data, encoding=self._encoding, use_list=False)
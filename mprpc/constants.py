@@ -3,11 +3,57 @@
 
 MSGPACKRPC_REQUEST = 0
 MSGPACKRPC_RESPONSE = 1
+MSGPACKRPC_NOTIFY = 2
+MSGPACKRPC_BATCH = 3
+MSGPACKRPC_CHUNK = 4
+MSGPACKRPC_CREDIT = 5
+MSGPACKRPC_CANCEL = 6
+MSGPACKRPC_RING = 7
+MSGPACKRPC_MAX_MSGID = 2 ** 31 - 1
 SOCKET_RECV_SIZE = 1024 ** 2
 
 METHOD_RECV_SIZE = 8
 METHOD_STRINGS_SIZE = 30
 
 METHOD_URIHTTP_SIZE = 512
+BUFFERS_RECV_SIZE = 4096
+# Largest request body accepted in BUFFERS mode, in bytes
+MAX_BUFFER_SIZE = 1024 ** 3
 
+# Chunks buffered by a stream are written out after this many seconds
+STREAM_FLUSH_INTERVAL = 0.01
 
+# Reserved RPC method names, mapped to the server attributes serving them
+RESERVED_METHODS = {'mprpc.stats': '_mprpc_stats',
+                    'mprpc.profile.start': '_mprpc_profile_start',
+                    'mprpc.profile.stop': '_mprpc_profile_stop'}
+
+# Error answered to the requests shed by admission control, raised by the
+# clients as ServerBusyError
+SERVER_BUSY_ERROR = 'ServerBusyError: Server busy'
+
+# Error answered to the requests whose deadline passed before they were
+# executed, raised by the clients as DeadlineExceededError
+DEADLINE_EXCEEDED_ERROR = 'DeadlineExceededError: Deadline exceeded'
+
+# Error answered to the requests cancelled while they executed. The client
+# no longer waits for it, and only releases what it held for the request.
+CANCELLED_ERROR = 'CancelledError: Cancelled'
+
+# Mode tags without an implementation yet
+RESERVED_TAGS = ('UNKOWNS:', 'BSONSTR:')
+
+
+
+# MessagePack ext type of zlib-compressed messages
+ZLIB_EXT_TYPE = 1
+# Packed messages smaller than this are sent uncompressed
+COMPRESS_THRESHOLD = 16 * 1024
+COMPRESS_LEVEL = 6
+# Compressed messages inflating beyond this many bytes are refused
+MAX_INFLATED_SIZE = 256 * 1024 ** 2
+
+# MessagePack ext type of the descriptors of shared memory records
+SHM_EXT_TYPE = 2
+# Arguments and results smaller than this are sent over the socket
+SHM_THRESHOLD = 1024 ** 2
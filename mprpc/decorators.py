@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+import functools
+
+from cache import LRUCache, SingleFlight, make_key
+from constants import RESERVED_METHODS
+
+_dispatch_tables = {}
+_cache_epochs = {}
+
+
+def export(func=None, name=None, namespace=None):
+    """Exports a method of :class:`RPCServer <mprpc.server.RPCServer>`.
+
+    Once a server class exports at least one method, only exported methods
+    (and ``test_connect``) can be called. Otherwise every public method is
+    callable, as before.
+
+    Usage:
+        >>> import mprpc
+        >>>
+        >>> class SumServer(mprpc.RPCServer):
+        ...     @mprpc.export
+        ...     def sum(self, x, y):
+        ...         return x + y
+        ...
+        ...     @mprpc.export('math.mul')
+        ...     def mul(self, x, y):
+        ...         return x * y
+        ...
+        ...     @mprpc.export(namespace='math')
+        ...     def div(self, x, y):
+        ...         return x / y
+
+    :param str name: (optional) Name the method is called by. Defaults to the
+        name of the function.
+    :param str namespace: (optional) Prefix joined to the name with a dot.
+    """
+    if isinstance(func, basestring):
+        (func, name) = (None, func)
+
+    def decorate(f):
+        exported = name or f.__name__
+        if namespace:
+            exported = '%s.%s' % (namespace, exported)
+        f._mprpc_export = getattr(f, '_mprpc_export', ()) + (exported,)
+        return f
+
+    if func is None:
+        return decorate
+    return decorate(func)
+
+
+def stream(func):
+    """Marks a method of :class:`RPCServer <mprpc.server.RPCServer>` whose
+    result is streamed to :meth:`RPCClient.call_stream
+    <mprpc.client.RPCClient.call_stream>` item by item.
+
+    Generators are always streamed, so this is only needed for methods that
+    return another kind of iterable, such as a database cursor.
+
+    Usage:
+        >>> import mprpc
+        >>>
+        >>> class ScanServer(mprpc.RPCServer):
+        ...     @mprpc.stream
+        ...     def scan(self, table):
+        ...         return self.db.execute('SELECT * FROM %s' % table)
+    """
+    func._mprpc_stream = True
+    return func
+
+
+def cached(maxsize=1024, ttl=None, maxbytes=None):
+    """Caches the responses of a method of :class:`RPCServer
+    <mprpc.server.RPCServer>`, keyed by its arguments.
+
+    The cache is shared by all connections and holds responses already
+    packed, so a hit costs neither a call nor serialization. Only
+    MessagePack requests go through it, and errors are never cached.
+
+    The decorated function gains ``invalidate(*args, **kwargs)``, which drops
+    the response cached for the arguments, ``invalidate_all()`` and
+    ``cache_info()``, which returns the hit and miss counters.
+
+    Usage:
+        >>> import mprpc
+        >>>
+        >>> class UserServer(mprpc.RPCServer):
+        ...     @mprpc.cached(maxsize=10000, ttl=60)
+        ...     def get_user(self, user_id):
+        ...         return self.db.get_user(user_id)
+        ...
+        ...     def rename_user(self, user_id, name):
+        ...         self.db.rename_user(user_id, name)
+        ...         self.get_user.invalidate(user_id)
+
+    :param int maxsize: (optional) Maximum number of cached responses.
+    :param float ttl: (optional) Seconds a response is cached for.
+    :param int maxbytes: (optional) Maximum total size of the cached
+        responses.
+    """
+    def decorate(f):
+        cache = LRUCache(maxsize, ttl, maxbytes)
+        f._mprpc_cache = cache
+        f.invalidate = lambda *args, **kwargs: cache.invalidate(make_key(args, kwargs))
+        f.invalidate_all = cache.clear
+        f.cache_info = cache.info
+        return f
+
+    return decorate
+
+
+def coalesce(func):
+    """Coalesces identical concurrent calls to a method of
+    :class:`RPCServer <mprpc.server.RPCServer>`.
+
+    While the method runs for some arguments, requests for the same
+    arguments, on any connection of the process, wait for that run and get
+    its response instead of running it again. Only MessagePack requests are
+    coalesced. Combined with :func:`cached`, the run also fills the cache.
+
+    The decorated function gains ``coalesce_info()``, which returns the
+    number of runs and of coalesced requests.
+
+    Usage:
+        >>> import mprpc
+        >>>
+        >>> class ReportServer(mprpc.RPCServer):
+        ...     @mprpc.coalesce
+        ...     @mprpc.cached(ttl=60)
+        ...     def report(self, day):
+        ...         return self.db.build_report(day)
+    """
+    flight = SingleFlight()
+    func._mprpc_coalesce = flight
+    func.coalesce_info = flight.info
+    return func
+
+
+def invalidates(func):
+    """Marks a method of :class:`RPCServer <mprpc.server.RPCServer>` that
+    changes data clients may have cached.
+
+    Once the method has returned, the cache epoch of the server class is
+    bumped. Clients caching results (see the ``cache`` parameter of
+    :class:`RPCClient <mprpc.client.RPCClient>`) learn the new epoch from
+    their next response and drop their whole cache.
+
+    Usage:
+        >>> import mprpc
+        >>>
+        >>> class UserServer(mprpc.RPCServer):
+        ...     def get_user(self, user_id):
+        ...         return self.db.get_user(user_id)
+        ...
+        ...     @mprpc.invalidates
+        ...     def rename_user(self, user_id, name):
+        ...         self.db.rename_user(user_id, name)
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        ret = func(self, *args, **kwargs)
+        bump_cache_epoch(type(self))
+        return ret
+
+    # Its responses carry the epoch read once it has returned
+    wrapper._mprpc_invalidates = True
+    return wrapper
+
+
+def get_cache_epoch(cls):
+    """Returns the cache epoch of a server class, which starts at 0 in each
+    process."""
+    return _cache_epochs.get(cls, 0)
+
+
+def bump_cache_epoch(cls):
+    """Increments the cache epoch of a server class, so that clients drop
+    the results they have cached."""
+    _cache_epochs[cls] = _cache_epochs.get(cls, 0) + 1
+
+
+def get_dispatch_table(cls, hidden=()):
+    """Returns a dict mapping the RPC method names of a server class to
+    attribute names. The table is built once per class.
+
+    :param hidden: (optional) Public attribute names that are never callable,
+        such as the callbacks of a protocol base class.
+    """
+    table = _dispatch_tables.get(cls)
+    if table is not None:
+        return table
+    exported = {}
+    public = {}
+    for attr in dir(cls):
+        value = getattr(cls, attr, None)
+        if not hasattr(value, '__call__'):
+            continue
+        for name in getattr(value, '_mprpc_export', ()):
+            exported[name] = attr
+        if not attr.startswith('_') and attr not in hidden:
+            public[attr] = attr
+    if exported:
+        exported.setdefault('test_connect', 'test_connect')
+        table = exported
+    else:
+        table = public
+    for (name, attr) in RESERVED_METHODS.iteritems():
+        if hasattr(cls, attr):
+            table[name] = attr
+    _dispatch_tables[cls] = table
+    return table
@@ -11,3 +11,16 @@ class MethodNotFoundError(Exception):
 
 class RPCError(Exception):
     pass
+
+
+class ServerBusyError(RPCError):
+    """The server turned the request away without executing it, so it may
+    be retried."""
+
+
+class DeadlineExceededError(RPCError):
+    """The deadline of the call passed before it was answered."""
+
+
+class PoolTimeoutError(Exception):
+    pass
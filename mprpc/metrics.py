@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Request metrics of the RPC servers of a process.
+
+Metrics are off by default and cost a single attribute check per request.
+Connections opened after :func:`enable` record their requests in the
+registry, which is read with the reserved ``mprpc.stats`` RPC:
+
+.. code-block:: python
+
+    >>> import mprpc.metrics
+    >>> mprpc.metrics.enable()
+    >>> # From a client
+    >>> print client.call('mprpc.stats')['methods']['sum']['p99']
+    0.00041
+    >>> print client.call('mprpc.stats', 'prometheus')
+"""
+
+import time
+import bisect
+
+# Upper bounds of the latency buckets, from 50 microseconds to about 105
+# seconds, each twice the previous one
+LATENCY_BUCKETS = tuple(0.00005 * 2 ** i for i in xrange(22))
+
+_registry = None
+
+
+class Histogram(object):
+    """Histogram with fixed buckets.
+
+    :param tuple bounds: Increasing upper bounds of the buckets. Larger
+        values fall in an extra bucket.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Returns an estimate of the ``q`` quantile, interpolated within
+        its bucket, or None if nothing has been observed.
+
+        :param float q: Quantile, between 0 and 1.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[i - 1] if i else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+
+class MethodStats(object):
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram(bounds)
+
+
+class Registry(object):
+    """Request counts and latencies per method, bytes per mode and open
+    connections.
+
+    :param tuple buckets: (optional) Upper bounds of the latency buckets, in
+        seconds.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.methods = {}
+        self.bytes_received = {}
+        self.bytes_sent = {}
+        self.connections = 0
+        self.started = time.time()
+
+    def observe(self, method, seconds, ok=True):
+        """Records a request, from its arrival to its response."""
+        stats = self.methods.get(method)
+        if stats is None:
+            stats = self.methods[method] = MethodStats(self.buckets)
+        stats.calls += 1
+        if not ok:
+            stats.errors += 1
+        stats.latency.observe(seconds)
+
+    def add_bytes(self, mode, received, sent):
+        """Adds to the byte counters of a mode, such as ``'MSGPACK'``."""
+        self.bytes_received[mode] = self.bytes_received.get(mode, 0) + received
+        self.bytes_sent[mode] = self.bytes_sent.get(mode, 0) + sent
+
+    def snapshot(self):
+        """Returns the metrics as a dict. Latencies are in seconds.
+
+        :rtype: dict
+        """
+        methods = {}
+        for (name, stats) in self.methods.iteritems():
+            latency = stats.latency
+            methods[name] = dict(calls=stats.calls, errors=stats.errors,
+                                 mean=latency.sum / latency.count if latency.count else None,
+                                 p50=latency.percentile(0.5), p99=latency.percentile(0.99), max=latency.max)
+        return dict(uptime=time.time() - self.started, connections=self.connections,
+                    bytes_received=dict(self.bytes_received), bytes_sent=dict(self.bytes_sent), methods=methods)
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format.
+
+        :rtype: str
+        """
+        lines = []
+
+        def header(name, kind, doc):
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        methods = sorted(self.methods.iteritems())
+        header('mprpc_requests_total', 'counter', 'Requests handled, by method.')
+        for (name, stats) in methods:
+            lines.append('mprpc_requests_total{method="%s"} %d' % (_escape(name), stats.calls))
+        header('mprpc_errors_total', 'counter', 'Requests answered with an error, by method.')
+        for (name, stats) in methods:
+            lines.append('mprpc_errors_total{method="%s"} %d' % (_escape(name), stats.errors))
+        header('mprpc_request_duration_seconds', 'histogram', 'Time from a request to its response.')
+        for (name, stats) in methods:
+            label = _escape(name)
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + ('+Inf',), stats.latency.counts):
+                cumulative += count
+                le = bound if bound == '+Inf' else repr(bound)
+                lines.append('mprpc_request_duration_seconds_bucket{method="%s",le="%s"} %d' % (label, le, cumulative))
+            lines.append('mprpc_request_duration_seconds_sum{method="%s"} %r' % (label, stats.latency.sum))
+            lines.append('mprpc_request_duration_seconds_count{method="%s"} %d' % (label, stats.latency.count))
+        header('mprpc_received_bytes_total', 'counter', 'Bytes received, by mode.')
+        for (mode, size) in sorted(self.bytes_received.iteritems()):
+            lines.append('mprpc_received_bytes_total{mode="%s"} %d' % (_escape(mode), size))
+        header('mprpc_sent_bytes_total', 'counter', 'Bytes sent, by mode.')
+        for (mode, size) in sorted(self.bytes_sent.iteritems()):
+            lines.append('mprpc_sent_bytes_total{mode="%s"} %d' % (_escape(mode), size))
+        header('mprpc_connections', 'gauge', 'Open connections.')
+        lines.append('mprpc_connections %d' % self.connections)
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def enable(registry=None):
+    """Turns metrics on for the connections opened from now on.
+
+    :param registry: (optional) :class:`Registry` to record into. A new one
+        is created by default.
+    :returns: The registry.
+    """
+    global _registry
+    _registry = registry or Registry()
+    return _registry
+
+
+def disable():
+    """Turns metrics off for the connections opened from now on."""
+    global _registry
+    _registry = None
+
+
+def get_registry():
+    """Returns the registry in use, or None when metrics are off."""
+    return _registry
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+import gevent
+try:
+    from gevent.lock import BoundedSemaphore
+except:
+    from gevent.coros import BoundedSemaphore
+
+from exceptions import PoolTimeoutError
+
+
+class ConnectionPool(object):
+    """Pool of RPC client connections.
+
+    Works with :class:`RPCClient <mprpc.client.RPCClient>` and the clients in
+    :mod:`mprpc.client_simple`. At most ``max_connections`` connections are
+    handed out at once and further callers wait for one to be released. Idle
+    connections are reused most recently used first, so that the ones left
+    over after a burst stay idle and get reaped.
+
+    Usage:
+        >>> from mprpc import RPCClient
+        >>> from mprpc.pool import ConnectionPool
+        >>> pool = ConnectionPool(RPCClient, dict(host='127.0.0.1', port=6000),
+        ...                       min_connections=4, max_connections=20)
+        >>> with pool.connection() as client:
+        ...     print client.call('sum', 1, 2)
+        ...
+        3
+        >>> print pool.call('sum', 1, 2)
+        3
+
+    :param factory: Client class, or any callable returning a connected client.
+    :param dict options: (optional) Keyword arguments of the factory.
+    :param int min_connections: (optional) Number of connections opened up
+        front and kept open while idle.
+    :param int max_connections: (optional) Maximum number of connections in
+        use at once.
+    :param float wait_timeout: (optional) Seconds to wait for a connection
+        before raising :class:`PoolTimeoutError
+        <mprpc.exceptions.PoolTimeoutError>`. Waits forever by default.
+    :param float lifetime: (optional) Seconds after which a connection is
+        closed instead of being reused.
+    :param float idle_timeout: (optional) Seconds after which an idle
+        connection above ``min_connections`` is closed.
+    :param float probe_interval: (optional) Seconds of idleness after which a
+        connection is checked with ``test_connect`` before it is reused.
+    :param float reap_interval: (optional) Seconds between runs of the
+        background greenlet that reaps, probes and refills idle connections.
+    :param bool lazy: (optional) If set to True, ``min_connections`` are not
+        opened until the first maintenance run.
+    """
+
+    def __init__(self, factory, options=None, min_connections=0, max_connections=20, wait_timeout=None,
+                 lifetime=None, idle_timeout=None, probe_interval=None, reap_interval=1.0, lazy=False):
+        assert max_connections > 0, 'Max connections must be a positive value'
+        assert 0 <= min_connections <= max_connections, 'Min connections must be between 0 and max connections'
+        self._factory = factory
+        self._options = options or {}
+        self._min_connections = min_connections
+        self._wait_timeout = wait_timeout
+        self._lifetime = lifetime
+        self._idle_timeout = idle_timeout
+        self._probe_interval = probe_interval
+        self._reap_interval = reap_interval
+        # Idle connections as [client, last used, last checked], most recent last
+        self._idle = deque()
+        self._created = {}
+        self._slots = BoundedSemaphore(max_connections)
+        self._closed = False
+        if not lazy:
+            self.fill()
+        self._reaper = gevent.spawn(self._maintain)
+
+    @property
+    def size(self):
+        """Number of open connections, idle or in use."""
+        return len(self._created)
+
+    @property
+    def idle(self):
+        """Number of idle connections."""
+        return len(self._idle)
+
+    def acquire(self):
+        """Takes a connection out of the pool, opening one if none is idle.
+
+        It must be given back with :meth:`release`.
+        """
+        assert not self._closed, 'The pool has been closed'
+        if not self._slots.acquire(timeout=self._wait_timeout):
+            raise PoolTimeoutError('Timed out waiting for a connection')
+        try:
+            while self._idle:
+                (client, used, checked) = self._idle.pop()
+                now = time.time()
+                if self._is_expired(client, now):
+                    self._discard(client)
+                elif (self._probe_interval is not None and now - checked >= self._probe_interval
+                      and not self._probe(client)):
+                    self._discard(client)
+                else:
+                    return client
+            return self._open()
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, client, discard=False):
+        """Gives a connection back to the pool.
+
+        :param bool discard: (optional) If set to True, the connection is
+            closed instead of being reused.
+        """
+        try:
+            if discard or self._closed or not client.is_connected() or self._is_expired(client, time.time()):
+                self._discard(client)
+            else:
+                now = time.time()
+                self._idle.append([client, now, now])
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager lending a connection. A connection that raises an
+        ``IOError``, including socket errors and timeouts, is closed rather
+        than reused."""
+        client = self.acquire()
+        try:
+            yield client
+        except IOError:
+            self.release(client, discard=True)
+            raise
+        except:
+            self.release(client)
+            raise
+        else:
+            self.release(client)
+
+    def call(self, method, *args, **kwargs):
+        """Calls a RPC method on a pooled connection."""
+        client = self.acquire()
+        try:
+            ret = client.call(method, *args, **kwargs)
+        except IOError:
+            self.release(client, discard=True)
+            raise
+        except:
+            self.release(client)
+            raise
+        self.release(client)
+        return ret
+
+    def fill(self):
+        """Opens connections until ``min_connections`` are open."""
+        missing = self._min_connections - self.size
+        if missing <= 0:
+            return
+        glets = [gevent.spawn(self._try_open) for _ in xrange(missing)]
+        gevent.joinall(glets)
+        now = time.time()
+        for glet in glets:
+            if glet.value is not None:
+                self._created[glet.value] = now
+                self._idle.appendleft([glet.value, now, now])
+
+    def reap(self):
+        """Closes expired idle connections and probes those idle for longer
+        than ``probe_interval``."""
+        kept = []
+        for _ in xrange(len(self._idle)):
+            if not self._idle:
+                break
+            entry = self._idle.popleft()
+            (client, used, checked) = entry
+            now = time.time()
+            if self._is_expired(client, now):
+                self._discard(client)
+            elif (self._idle_timeout is not None and now - used >= self._idle_timeout
+                  and self.size > self._min_connections):
+                self._discard(client)
+            elif self._probe_interval is not None and now - checked >= self._probe_interval:
+                # Probing holds a slot, so that it is never over the limit
+                if not self._slots.acquire(blocking=False):
+                    kept.append(entry)
+                    continue
+                try:
+                    if self._probe(client):
+                        entry[2] = time.time()
+                        kept.append(entry)
+                    else:
+                        self._discard(client)
+                finally:
+                    self._slots.release()
+            else:
+                kept.append(entry)
+        self._idle.extendleft(reversed(kept))
+
+    def close(self):
+        """Closes the idle connections. Connections in use are closed when
+        they are released."""
+        self._closed = True
+        if self._reaper is not None:
+            self._reaper.kill(block=False)
+            self._reaper = None
+        while self._idle:
+            self._discard(self._idle.pop()[0])
+
+    def _maintain(self):
+        while not self._closed:
+            gevent.sleep(self._reap_interval)
+            try:
+                self.reap()
+                self.fill()
+            except Exception:
+                logging.exception('An error has occurred while maintaining the pool')
+
+    def _open(self):
+        client = self._factory(**self._options)
+        self._created[client] = time.time()
+        return client
+
+    def _try_open(self):
+        try:
+            return self._factory(**self._options)
+        except Exception, e:
+            logging.warning('Failed to open a connection: %s', e)
+            return None
+
+    def _probe(self, client):
+        try:
+            return client.test_connect()
+        except Exception, e:
+            logging.debug('A pooled connection failed its probe: %s', e)
+            return False
+
+    def _is_expired(self, client, now):
+        return self._lifetime is not None and now - self._created.get(client, now) >= self._lifetime
+
+    def _discard(self, client):
+        self._created.pop(client, None)
+        try:
+            if client.is_connected():
+                client.close()
+        except Exception:
+            logging.exception('An error has occurred while closing a connection')
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Sampled profiling of the methods of live servers.
+
+Profiling is off until :func:`enable` names the directory reports are
+written to. A session then profiles every Nth call of one method with
+``cProfile`` and, where ``tracemalloc`` is available, accounts for the memory
+the calls allocate. When the session ends, after its duration or on
+:func:`stop`, the aggregated ``pstats`` file and a text report are written.
+
+Sessions are started in process, or remotely with the reserved
+``mprpc.profile.start`` and ``mprpc.profile.stop`` methods:
+
+.. code-block:: python
+
+    >>> import mprpc.profiling
+    >>> mprpc.profiling.enable('/var/tmp/mprpc-profiles')
+    >>> # From a client
+    >>> client.call('mprpc.profile.start', 'search', every=10, duration=60, memory=True)
+    >>> print client.call('mprpc.profile.stop', 'search')
+    ['/var/tmp/mprpc-profiles/search-4242-20240101120000-1.pstats', '/var/tmp/mprpc-profiles/search-4242-20240101120000-1.txt']
+
+While a sampled call runs, other greenlets running meanwhile are profiled
+too. Each process profiles its own calls, so with ``mprpc-serve`` a session
+only covers the worker that received the call.
+"""
+
+import os
+import re
+import time
+import pstats
+import cProfile
+import logging
+import itertools
+from StringIO import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+# Bumped whenever sessions start or end, so that servers look up their
+# methods again
+generation = 0
+
+_directory = None
+_sessions = {}
+_reports = itertools.count(1)
+
+
+class ProfileSession(object):
+    """Profiles the calls of one method.
+
+    :param str name: RPC method name.
+    :param int every: (optional) Profile one call out of this many.
+    :param bool memory: (optional) If set to True, allocations are accounted
+        for with tracemalloc, if available.
+    """
+
+    def __init__(self, name, every=1, memory=False):
+        assert every > 0, 'Sampling interval must be a positive value'
+        self.name = name
+        self.every = every
+        self.memory = memory and tracemalloc is not None
+        self.calls = 0
+        self.sampled = 0
+        self.allocated = 0
+        self.started = time.time()
+        self._profile = cProfile.Profile()
+        self._running = 0
+        self._timer = None
+        self._started_tracing = False
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def wrap(self, method):
+        """Returns a callable standing for the bound method."""
+        return _Profiled(method, self)
+
+    def call(self, method, args, kwargs):
+        self.calls += 1
+        if self.calls % self.every:
+            return method(*args, **kwargs)
+        self.sampled += 1
+        if self.memory:
+            before = tracemalloc.get_traced_memory()[0]
+        self._running += 1
+        if self._running == 1:
+            self._profile.enable()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._running -= 1
+            if not self._running:
+                self._profile.disable()
+            if self.memory:
+                self.allocated += tracemalloc.get_traced_memory()[0] - before
+
+    def dump(self, directory):
+        """Writes the ``pstats`` file and the text report.
+
+        :returns: Paths of the files written.
+        :rtype: list
+        """
+        if self._running:
+            self._profile.disable()
+        base = os.path.join(directory, '%s-%d-%s-%d' % (
+            re.sub(r'[^\w.-]', '_', self.name), os.getpid(), time.strftime('%Y%m%d%H%M%S'), next(_reports)))
+        paths = [base + '.txt']
+        report = StringIO()
+        report.write('Method %s: %d calls, %d profiled over %.1f seconds\n\n' % (
+            self.name, self.calls, self.sampled, time.time() - self.started))
+        if self.sampled:
+            self._profile.dump_stats(base + '.pstats')
+            paths.insert(0, base + '.pstats')
+            stats = pstats.Stats(self._profile, stream=report)
+            stats.sort_stats('cumulative').print_stats(50)
+        if self.memory:
+            report.write('Memory retained by the profiled calls: %d bytes\n\n' % self.allocated)
+            report.write('Largest allocations:\n')
+            for stat in tracemalloc.take_snapshot().statistics('lineno')[:50]:
+                report.write('%s\n' % stat)
+            if self._started_tracing:
+                tracemalloc.stop()
+        with open(base + '.txt', 'w') as f:
+            f.write(report.getvalue())
+        return paths
+
+
+class _Profiled(object):
+    # Forwards attribute lookups, such as decorator markers, to the method
+    def __init__(self, method, session):
+        self._method = method
+        self._session = session
+
+    def __call__(self, *args, **kwargs):
+        return self._session.call(self._method, args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._method, name)
+
+
+def enable(directory):
+    """Allows profiling sessions, writing their reports to ``directory``."""
+    global _directory
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    _directory = directory
+
+
+def disable():
+    """Ends all sessions, writing their reports, and disallows new ones."""
+    global _directory
+    for name in list(_sessions):
+        stop(name)
+    _directory = None
+
+
+def is_enabled():
+    return _directory is not None
+
+
+def start(name, every=1, duration=60.0, memory=False):
+    """Starts profiling a method, replacing any session already profiling it.
+
+    :param str name: RPC method name.
+    :param int every: (optional) Profile one call out of this many.
+    :param float duration: (optional) Seconds after which the session ends
+        and its report is written.
+    :param bool memory: (optional) If set to True, allocations are accounted
+        for with tracemalloc, if available.
+    """
+    global generation
+    if _directory is None:
+        raise RuntimeError('Profiling is disabled')
+    if name in _sessions:
+        stop(name)
+    session = _sessions[name] = ProfileSession(name, every, memory)
+    if duration and gevent is not None:
+        session._timer = gevent.spawn_later(duration, _expire, session)
+    generation += 1
+    return session
+
+
+def stop(name):
+    """Ends the session profiling a method and writes its report.
+
+    :returns: Paths of the files written, or an empty list if the method is
+        not being profiled.
+    :rtype: list
+    """
+    global generation
+    session = _sessions.pop(name, None)
+    if session is None:
+        return []
+    generation += 1
+    if session._timer is not None:
+        session._timer.kill(block=False)
+    return session.dump(_directory)
+
+
+def get_session(name):
+    """Returns the session profiling a method, or None."""
+    return _sessions.get(name)
+
+
+def _expire(session):
+    if _sessions.get(session.name) is session:
+        session._timer = None
+        try:
+            paths = stop(session.name)
+        except Exception:
+            logging.exception('Failed to write the profile of %s', session.name)
+        else:
+            logging.info('Wrote the profile of %s to %s', session.name, ', '.join(paths))
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""Pre-fork launcher for RPC servers.
+
+Usage:
+
+.. code-block:: bash
+
+    $ mprpc-serve myapp.rpc:SumServer --port 6000 --workers 32
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import logging
+import argparse
+import functools
+import importlib
+import multiprocessing
+
+from transport import format_endpoint, listen, unix_path
+
+# Linux value, for Python versions whose socket module does not define it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+# Workers exiting sooner than this after being started are restarted with
+# a growing delay
+MIN_WORKER_UPTIME = 1.0
+MAX_RESTART_DELAY = 10.0
+
+
+def load_server_class(target):
+    """Returns the object named by a ``package.module:ServerClass`` string."""
+    (module_name, _, attr) = target.partition(':')
+    if not module_name or not attr:
+        raise ValueError('Expected package.module:ServerClass, got %r' % target)
+    value = importlib.import_module(module_name)
+    for name in attr.split('.'):
+        value = getattr(value, name)
+    return value
+
+
+def _listen(address, backlog, reuse_port=False, socket_module=socket):
+    if unix_path(address[0]) is not None:
+        if reuse_port:
+            raise RuntimeError('SO_REUSEPORT does not apply to Unix domain sockets')
+        return listen(address[0], backlog=backlog, socket_module=socket_module)
+    sock = socket_module.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if SO_REUSEPORT is None:
+            raise RuntimeError('SO_REUSEPORT is not supported on this platform')
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+def run_worker(handler, address, listener=None, backlog=1024, graceful_timeout=30.0):
+    """Serves ``handler`` in the current process until SIGTERM or SIGINT.
+
+    On either signal, the worker stops accepting, shuts down the read side
+    of every connection so that idle ones end, and gives the requests in
+    flight up to ``graceful_timeout`` seconds to be answered.
+
+    :param handler: :class:`RPCServer <mprpc.server.RPCServer>` subclass,
+        or any StreamServer handler.
+    :param tuple address: ``(host, port)`` to listen on with ``SO_REUSEPORT``
+        when no listener is given. The host may name a Unix domain socket
+        (see :mod:`mprpc.transport`).
+    :param listener: (optional) Listening socket inherited from the parent.
+    """
+    import gevent
+    import gevent.pool
+    from gevent import socket as gsocket
+    from gevent.server import StreamServer
+
+    gevent.reinit()
+    if listener is None:
+        listener = _listen(address, backlog, reuse_port=True, socket_module=gsocket)
+    else:
+        listener = gsocket.fromfd(listener.fileno(), listener.family, socket.SOCK_STREAM)
+    connections = set()
+
+    def handle(sock, address):
+        connections.add(sock)
+        try:
+            handler(sock, address)
+        finally:
+            connections.discard(sock)
+
+    server = StreamServer(listener, handle, spawn=gevent.pool.Pool())
+
+    def stop():
+        logging.info('Worker %d is shutting down', os.getpid())
+        server.close()
+        for sock in list(connections):
+            try:
+                sock.shutdown(socket.SHUT_RD)
+            except socket.error:
+                pass
+
+    signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal_handler(signum, stop)
+    server.serve_forever(stop_timeout=graceful_timeout)
+
+
+class Arbiter(object):
+    """Forks the workers, restarts those that die and stops them all on
+    SIGTERM or SIGINT.
+
+    :param handler: :class:`RPCServer <mprpc.server.RPCServer>` subclass,
+        or any StreamServer handler.
+    :param tuple address: ``(host, port)`` to listen on. The host may name a
+        Unix domain socket (see :mod:`mprpc.transport`), removed on exit.
+    :param int workers: (optional) Number of worker processes. Defaults to
+        the number of CPUs.
+    :param bool reuse_port: (optional) If set to True, each worker binds its
+        own socket with ``SO_REUSEPORT`` and the kernel balances connections
+        between them. Otherwise the workers accept on a socket inherited from
+        the arbiter.
+    :param int backlog: (optional) Listen backlog.
+    :param float graceful_timeout: (optional) Seconds the workers have to
+        answer the requests in flight once asked to stop.
+    :raises ValueError: If ``reuse_port`` is set for a Unix domain socket or
+        on a platform without ``SO_REUSEPORT``, where no worker could start.
+    """
+
+    def __init__(self, handler, address, workers=None, reuse_port=False, backlog=1024, graceful_timeout=30.0):
+        if reuse_port and unix_path(address[0]) is not None:
+            raise ValueError('SO_REUSEPORT does not apply to Unix domain sockets')
+        if reuse_port and SO_REUSEPORT is None:
+            raise ValueError('SO_REUSEPORT is not supported on this platform')
+        self.handler = handler
+        self.address = address
+        self.workers = workers or multiprocessing.cpu_count()
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.graceful_timeout = graceful_timeout
+        self._listener = None
+        self._children = {}
+        self._stopping = None
+
+    def run(self):
+        """Runs until the workers have been stopped.
+
+        :returns: Exit status.
+        """
+        if not self.reuse_port:
+            self._listener = _listen(self.address, self.backlog)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._stop)
+        logging.info('Serving on %s with %d workers', format_endpoint(*self.address), self.workers)
+        delays = [0] * self.workers
+        restart_at = [0] * self.workers
+        while True:
+            for (slot, uptime) in self._reap():
+                if self._stopping is None:
+                    delays[slot] = 0 if uptime >= MIN_WORKER_UPTIME else min(
+                        max(delays[slot] * 2, 0.1), MAX_RESTART_DELAY)
+                    restart_at[slot] = time.time() + delays[slot]
+            if self._stopping is not None:
+                if not self._children:
+                    break
+                if time.time() > self._stopping + self.graceful_timeout + 1:
+                    self._signal_all(signal.SIGKILL)
+            else:
+                running = set(slot for (slot, _) in self._children.itervalues())
+                for slot in xrange(self.workers):
+                    if slot not in running and time.time() >= restart_at[slot]:
+                        self._spawn(slot)
+            time.sleep(0.1)
+        if self._listener is not None:
+            self._listener.close()
+            path = unix_path(self.address[0])
+            if path is not None and not path.startswith('\0') and os.path.exists(path):
+                os.unlink(path)
+        logging.info('All workers have exited')
+        return 0
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = (slot, time.time())
+            return
+        status = 0
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            run_worker(self.handler, self.address, listener=self._listener, backlog=self.backlog,
+                       graceful_timeout=self.graceful_timeout)
+        except BaseException:
+            logging.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _reap(self):
+        # Returns the slots and uptimes of the workers that exited
+        exited = []
+        while self._children:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+            if not pid:
+                break
+            if pid not in self._children:
+                continue
+            (slot, started) = self._children.pop(pid)
+            if self._stopping is None:
+                logging.warning('Worker %d exited with status %d, restarting it', pid, status)
+            exited.append((slot, time.time() - started))
+        return exited
+
+    def _stop(self, signum, frame):
+        if self._stopping is None:
+            logging.info('Stopping the workers')
+            self._stopping = time.time()
+            self._signal_all(signal.SIGTERM)
+
+    def _signal_all(self, signum):
+        for pid in self._children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+
+def main(argv=None):
+    """Entry point of the ``mprpc-serve`` command."""
+    parser = argparse.ArgumentParser(prog='mprpc-serve', description='Runs a RPC server in pre-forked workers.')
+    parser.add_argument('server', help='Server class, as package.module:ServerClass')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on, or unix:///path/to.sock for a Unix domain socket '
+                        '(default: %(default)s)')
+    parser.add_argument('--port', type=int, default=6000, help='Port to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of workers (default: number of CPUs)')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='Let each worker bind the port with SO_REUSEPORT instead of sharing one socket')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Requests executed concurrently per connection')
+    parser.add_argument('--backlog', type=int, default=1024, help='Listen backlog (default: %(default)s)')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help='Seconds given to requests in flight on shutdown (default: %(default)s)')
+    parser.add_argument('--log-level', default='INFO', help='Logging level (default: %(default)s)')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Record request metrics in each worker, served by the mprpc.stats method')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='Requests executed at once in each worker, others waiting or being turned away')
+    parser.add_argument('--max-queue', type=int, default=0,
+                        help='Requests waiting in each worker before others are turned away (default: %(default)s)')
+    parser.add_argument('--queue-timeout', type=float, default=None,
+                        help='Seconds a request waits before being turned away')
+    parser.add_argument('--max-per-connection', type=int, default=None,
+                        help='Requests waiting or executing at once per connection')
+    parser.add_argument('--profile-dir', default=None,
+                        help='Allow the mprpc.profile.start method, writing reports to this directory')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s [%(process)d] %(levelname)s %(message)s')
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    handler = load_server_class(args.server)
+    if args.metrics:
+        from mprpc import metrics
+        metrics.enable()
+    if args.max_in_flight:
+        from mprpc import admission
+        admission.enable(args.max_in_flight, args.max_queue, args.queue_timeout, args.max_per_connection)
+    if args.profile_dir:
+        from mprpc import profiling
+        profiling.enable(args.profile_dir)
+    if args.concurrency:
+        handler = functools.partial(handler, concurrency=args.concurrency)
+    try:
+        arbiter = Arbiter(handler, (args.host, args.port), workers=args.workers, reuse_port=args.reuse_port,
+                          backlog=args.backlog, graceful_timeout=args.graceful_timeout)
+    except ValueError as e:
+        parser.error(str(e))
+    return arbiter.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
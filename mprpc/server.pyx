@@ -1,17 +1,43 @@
 # cython: profile=False
 # -*- coding: utf-8 -*-
 
+import time
 import urllib
 import logging
 import msgpack
-import cPickle as pickle
+from msgpack import ExtType
+from socket import AF_UNIX
+from types import GeneratorType
 try:
-    from gevent.coros import Semaphore
+    from gevent.lock import Semaphore
 except:
-    pass
+    try:
+        from gevent.coros import Semaphore
+    except:
+        pass
+try:
+    import gevent
+    from gevent.event import Event
+    from gevent import getcurrent
+    from gevent.pool import Pool
+    from gevent.socket import wait_write
+except:
+    wait_write = None
 
+from buffers import BufferPool, file_size, sendfile, sendv, SENDV_JOIN_SIZE
+from cache import make_key
+from codec import get_codec
+from compression import Deflater, Inflater
+from decorators import get_cache_epoch, get_dispatch_table
+from metrics import get_registry
+from admission import get_control
+from shm import SharedRing, SharedRegions, SHARED_TYPES, export, refusing_ext_hook
+import profiling
 from exceptions import MethodNotFoundError, RPCProtocolError
-from constants import MSGPACKRPC_REQUEST, MSGPACKRPC_RESPONSE, SOCKET_RECV_SIZE,METHOD_RECV_SIZE,METHOD_STRINGS_SIZE,METHOD_URIHTTP_SIZE
+from constants import MSGPACKRPC_REQUEST, MSGPACKRPC_RESPONSE, MSGPACKRPC_NOTIFY, MSGPACKRPC_BATCH, SOCKET_RECV_SIZE,METHOD_RECV_SIZE,METHOD_STRINGS_SIZE,METHOD_URIHTTP_SIZE
+from constants import MSGPACKRPC_CHUNK, MSGPACKRPC_CREDIT, MSGPACKRPC_CANCEL, MSGPACKRPC_RING, STREAM_FLUSH_INTERVAL
+from constants import RESERVED_METHODS, RESERVED_TAGS, SERVER_BUSY_ERROR, DEADLINE_EXCEEDED_ERROR, BUFFERS_RECV_SIZE, COMPRESS_THRESHOLD, COMPRESS_LEVEL
+from constants import SHM_THRESHOLD, CANCELLED_ERROR, MAX_BUFFER_SIZE
 
 #####################################################
 cdef tuple decode_urihttp(url):
@@ -51,6 +77,39 @@ cdef tuple decode_urihttp(url):
     result=method,tuple(args),kwargs
     return result
 
+#####################################################
+cdef object _buffer_pool = BufferPool()
+
+#####################################################
+class _Cancelled(BaseException):
+    # Thrown into a request cancelled by the client. Like GreenletExit, it
+    # is not caught by ``except Exception``.
+    pass
+
+class _Stream(object):
+    # Credit left to a streamed response and the event its sender waits on,
+    # along with the chunks not sent yet and the timer that flushes them
+    def __init__(self, window):
+        self.credit = max(1, window)
+        self.cancelled = False
+        self.closed = False
+        self.buffered = []
+        self.size = 0
+        self.timer = None
+        # Whether it holds an admission slot
+        self.controlled = False
+        self._ready = Event()
+    def grant(self, credit):
+        self.credit += credit
+        self._ready.set()
+    def cancel(self, closed=False):
+        self.cancelled = True
+        self.closed = closed
+        self._ready.set()
+    def wait(self):
+        self._ready.clear()
+        self._ready.wait()
+
 #####################################################
 cdef class RPCServer:
     """RPC server.
@@ -63,6 +122,83 @@ cdef class RPCServer:
         using Messagepack.
     :param str unpack_encoding: (optional) Character encoding used to unpack
         data using Messagepack.
+    :param int concurrency: (optional) If set, MessagePack requests on the
+        connection are executed concurrently, up to this many at a time, and
+        responses are sent in completion order.
+    :param int compress_threshold: (optional) Minimum size of the MessagePack
+        messages compressed for clients that accept compression.
+    :param int compress_level: (optional) zlib compression level.
+    :param bytes compress_dict: (optional) Preset dictionary shared with the
+        clients.
+    :param int shared_memory: (optional) Size in bytes of the ring in shared
+        memory that large results are written to for clients asking for it.
+        Unless set, requests referring to shared memory are refused.
+    :param int shared_memory_threshold: (optional) Minimum size of the
+        results transferred through shared memory, in bytes.
+    :param int max_buffer_size: (optional) Largest request body accepted in
+        BUFFERS mode, in bytes.
+
+    Clients sending their MessagePack requests under the ``MSGZLIB:`` tag
+    accept compressed messages. Every response to them above the threshold
+    is compressed with zlib and sent as a MessagePack ext value, and their
+    requests may be compressed alike.
+
+    In BUFFERS mode, the request body is passed to the method as a
+    ``memoryview`` over a pooled buffer, valid only until the method returns.
+    The method returns a bytes-like object, which is sent back as is.
+
+    In FILEOBJ mode and in STRINGS/URIHTTP modes, a method may return a
+    file-like object. It is streamed to the client with ``os.sendfile`` where
+    available, or through a bounded buffer otherwise. In FILEOBJ mode the
+    file is closed once it has been sent.
+
+    When a MessagePack request asks for a stream (see
+    :meth:`RPCClient.call_stream <mprpc.client.RPCClient.call_stream>`) and
+    the method returns a generator, a list or tuple, or is marked with
+    :func:`stream <mprpc.decorators.stream>`, each item is sent as its own
+    chunk under the request's message ID, followed by the response. The
+    client grants credit for the chunks it consumes, and the generator is not
+    advanced while the credit is used up. Without a stream request, a
+    generator is sent as a list.
+
+    Clients on the same host may pass large bytes-like arguments through
+    shared memory (see :mod:`mprpc.shm`). The method gets a ``memoryview``
+    of each, valid only until it returns. With ``shared_memory``, a large
+    bytes-like result is written to shared memory for them in turn. Shared
+    memory is refused on connections other than Unix domain sockets.
+
+    Once :func:`mprpc.metrics.enable` has been called, connections record
+    their requests, and the reserved ``mprpc.stats`` method returns the
+    metrics of the process, as a dict or, given ``'prometheus'``, as text.
+
+    Once :func:`mprpc.admission.enable` has been called, connections limit
+    the requests executing and waiting at once, and answer the requests
+    beyond those limits right away with a busy error, raised by the clients
+    as :class:`ServerBusyError <mprpc.exceptions.ServerBusyError>`.
+
+    MessagePack requests may carry a ``budget``, in seconds, or an absolute
+    ``deadline``, as a UNIX time. Requests whose deadline passes before they
+    are executed are answered with an error, raised by the clients as
+    :class:`DeadlineExceededError <mprpc.exceptions.DeadlineExceededError>`.
+    While a method executes, ``self._remaining_budget()`` returns the seconds
+    left, or None. With ``concurrency``, a cancel message from the client
+    kills the greenlet executing the request, unless its result is shared
+    through :func:`cached <mprpc.decorators.cached>` or :func:`coalesce
+    <mprpc.decorators.coalesce>`, and answers it with an error that the
+    client discards. A request whose method has already returned is
+    answered as usual. While ``concurrency`` requests are
+    executing, the connection is not read, so cancel messages only take
+    effect once one of them is done.
+
+    MessagePack notifications, sent with :meth:`RPCClient.notify
+    <mprpc.client.RPCClient.notify>`, are executed like requests, but no
+    response is written for them. Their errors are only logged, and they are
+    dropped when admission control sheds them.
+
+    MessagePack requests may ask for the server's cache epoch, which is then
+    appended to the response. Methods marked with :func:`invalidates
+    <mprpc.decorators.invalidates>` bump it, telling caching clients to drop
+    their results.
 
     Usage:
         >>> from gevent.server import StreamServer
@@ -75,22 +211,80 @@ cdef class RPCServer:
         >>> 
         >>> server = StreamServer(('127.0.0.1', 6000), SumServer)
         >>> server.serve_forever()
+
+    To run up to 10 requests per connection concurrently:
+
+        >>> import functools
+        >>> server = StreamServer(('127.0.0.1', 6000), functools.partial(SumServer, concurrency=10))
     """
 
     cdef _socket
     cdef _packer
     cdef _unpacker
     cdef _send_lock
+    cdef _pool
+    cdef dict _codec_states
+    cdef _frame_buffer
+    cdef dict _dispatch
+    cdef dict _methods
+    cdef Py_ssize_t _methods_generation
+    cdef dict _streams
+    cdef dict _running
+    cdef dict _deadlines
+    cdef tuple _compress_options
+    cdef _deflater
+    cdef _inflater
+    cdef _metrics
+    cdef _admission
+    cdef Py_ssize_t _admitted
+    cdef Py_ssize_t _bytes_in
+    cdef Py_ssize_t _bytes_out
+    cdef Py_ssize_t _shm_size
+    cdef Py_ssize_t _shm_threshold
+    cdef _shm_ring
+    cdef _shm_regions
+    cdef Py_ssize_t _max_buffer_size
 
     #####################################################
-    def __init__(self, sock, address, pack_encoding='utf-8',unpack_encoding='utf-8'):
+    def __init__(self, sock, address, pack_encoding='utf-8',unpack_encoding='utf-8', concurrency=None,
+                 compress_threshold=COMPRESS_THRESHOLD, compress_level=COMPRESS_LEVEL, compress_dict=None,
+                 shared_memory=None, shared_memory_threshold=SHM_THRESHOLD, max_buffer_size=MAX_BUFFER_SIZE):
         self._socket = sock
+        if sock.family != AF_UNIX:
+            shared_memory = None
+        self._shm_regions = SharedRegions() if shared_memory else None
         self._packer = msgpack.Packer(encoding=pack_encoding)
-        self._unpacker = msgpack.Unpacker(encoding=unpack_encoding,use_list=False)
+        self._unpacker = msgpack.Unpacker(encoding=unpack_encoding,use_list=False,
+                                          ext_hook=self._shm_regions if shared_memory else refusing_ext_hook)
+        self._compress_options = (unpack_encoding, compress_threshold, compress_level, compress_dict)
+        self._deflater = None
+        self._inflater = None
         try:
             self._send_lock = Semaphore()
         except:
             self._send_lock = None
+        if concurrency:
+            assert concurrency > 0, 'Concurrency must be a positive value'
+            self._pool = Pool(concurrency)
+        else:
+            self._pool = None
+        self._codec_states = {}
+        self._frame_buffer = None
+        self._dispatch = get_dispatch_table(type(self))
+        self._methods = {}
+        self._methods_generation = profiling.generation
+        self._streams = {}
+        self._running = {}
+        self._deadlines = {}
+        self._metrics = get_registry()
+        self._admission = get_control()
+        self._admitted = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._shm_size = shared_memory or 0
+        self._shm_threshold = shared_memory_threshold
+        self._max_buffer_size = max_buffer_size
+        self._shm_ring = None
         self._run()
     def __del__(self):
         try:
@@ -102,183 +296,848 @@ cdef class RPCServer:
     def _run(self):
         cdef bytes rpc_type
         cdef int result=0
-        while True:
-            rpc_type = self._socket.recv(METHOD_RECV_SIZE)
-            if not rpc_type:
-                logging.debug('Client disconnected')
-                break
-            if rpc_type == 'MSGPACK:':
-                result=self._msgpack_run()
-            elif rpc_type=='STRINGS:':
-                result=self._strings_run()
-            elif rpc_type=='PICKLES:':
-                result=self._pickles_run()
-            elif rpc_type=='URIHTTP:':
-                result=self._urihttp_run()
-            elif rpc_type=='UNKOWNS:':
-                raise
-            elif rpc_type=='FILEOBJ:':
-                raise
-            elif rpc_type=='BUFFERS:':
-                raise
-            elif rpc_type=='JSONSTR:':
-                raise
-            elif rpc_type=='BSONSTR:':
-                raise
-            else:
-                self._unpacker.feed(rpc_type)
-                result=self._msgpack_run()
-            if result==-1:
-                logging.debug('Client disconnected')
-                break
+        cdef bytes mode = b'MSGPACK:'
+        if self._metrics is not None:
+            self._metrics.connections += 1
+        try:
+            while True:
+                rpc_type = self._read_exact(METHOD_RECV_SIZE)
+                if not rpc_type:
+                    logging.debug('Client disconnected')
+                    break
+                mode = rpc_type
+                if rpc_type == 'MSGPACK:':
+                    result=self._msgpack_run()
+                elif rpc_type == 'MSGZLIB:':
+                    if self._deflater is None:
+                        (encoding, threshold, level, zdict) = self._compress_options
+                        self._deflater = Deflater(threshold, level, zdict)
+                        self._inflater = Inflater(encoding, zdict)
+                    result=self._msgpack_run()
+                elif rpc_type=='STRINGS:':
+                    result=self._strings_run()
+                elif rpc_type=='URIHTTP:':
+                    result=self._urihttp_run()
+                elif rpc_type=='BUFFERS:':
+                    result=self._buffers_run()
+                elif rpc_type=='FILEOBJ:':
+                    result=self._fileobj_run()
+                else:
+                    codec = get_codec(rpc_type)
+                    if codec is not None:
+                        result=self._codec_run(codec)
+                    elif rpc_type in RESERVED_TAGS:
+                        raise RPCProtocolError('Unsupported rpc type: %s' % rpc_type)
+                    else:
+                        mode = b'MSGPACK:'
+                        self._unpacker.feed(rpc_type+self._unpacker.read_bytes(SOCKET_RECV_SIZE))
+                        result=self._msgpack_run()
+                if self._metrics is not None:
+                    self._metrics_flush(mode)
+                if result==-1:
+                    logging.debug('Client disconnected')
+                    break
+            for stream in self._streams.values():
+                stream.cancel(closed=True)
+            if self._pool is not None:
+                self._pool.join()
+        finally:
+            if self._metrics is not None:
+                self._metrics.connections -= 1
+                self._metrics_flush(mode)
+            if self._shm_ring is not None:
+                self._shm_ring.close()
+            if self._shm_regions is not None:
+                self._shm_regions.close()
+
+    cdef _metrics_flush(self, bytes mode):
+        # Bytes are counted per connection and added to the registry after
+        # each request, under the mode tag without its colon
+        self._metrics.add_bytes(mode[:-1], self._bytes_in, self._bytes_out)
+        self._bytes_in = 0
+        self._bytes_out = 0
+    cdef _observe(self, name, double started, bint ok):
+        self._metrics.observe(name, time.time() - started, ok)
+    cdef bint _admit(self):
+        # Reserves a place in the queue for a request, without blocking.
+        # Returns False if the request must be shed instead.
+        if self._admission.per_connection and self._admitted >= self._admission.per_connection:
+            self._admission.shed += 1
+            return False
+        if not self._admission.admit():
+            return False
+        self._admitted += 1
+        return True
+    cdef bint _acquire_slot(self):
+        # Waits for an admitted request's turn
+        if self._admission.acquire():
+            return True
+        self._admitted -= 1
+        return False
+    cdef bint _enter(self):
+        return self._admit() and self._acquire_slot()
+    cdef bint _controlled(self, name):
+        # Reserved methods answer even when the server is saturated
+        return self._admission is not None and name not in RESERVED_METHODS
+    cdef _release_slot(self):
+        self._admitted -= 1
+        self._admission.release()
+    cdef bytes _read_exact(self, int length):
+        # Pipelined requests leave the next frame in the unpacker's buffer
+        cdef bytes value = self._unpacker.read_bytes(length)
+        cdef bytes data
+        while len(value) < length:
+            data = self._socket.recv(length - len(value))
+            if not data:
+                return data
+            self._bytes_in += len(data)
+            value += data
+        return value
+    cdef bint _recv_into(self, view, Py_ssize_t length):
+        cdef bytes data = self._unpacker.read_bytes(length)
+        cdef Py_ssize_t received = len(data)
+        cdef Py_ssize_t size
+        view[:received] = data
+        while received < length:
+            size = self._socket.recv_into(view[received:length])
+            if not size:
+                return False
+            self._bytes_in += size
+            received += size
+        return True
+
+    cdef _lookup_method(self, method_name):
+        if self._methods_generation != profiling.generation:
+            # Profiling sessions started or ended
+            self._methods.clear()
+            self._methods_generation = profiling.generation
+        method = self._methods.get(method_name)
+        if method is None:
+            attr = self._dispatch.get(method_name)
+            if attr is None:
+                raise MethodNotFoundError('Method not found: %s' % method_name)
+            method = getattr(self, attr)
+            session = profiling.get_session(method_name)
+            if session is not None:
+                method = session.wrap(method)
+            self._methods[method_name] = method
+        return method
 
     #####################################################
     def test_connect(self,*args,**kwargs):
         return '1'
+    def _mprpc_stats(self, format='json'):
+        # Served as the reserved mprpc.stats method
+        registry = get_registry()
+        control = get_control()
+        if registry is None and control is None:
+            raise RuntimeError('Metrics are disabled')
+        if format == 'prometheus':
+            return ((registry.prometheus() if registry is not None else '')
+                    + (control.prometheus() if control is not None else ''))
+        stats = registry.snapshot() if registry is not None else {}
+        if control is not None:
+            stats['admission'] = control.info()
+        return stats
+    def _mprpc_profile_start(self, method, every=1, duration=60.0, memory=False):
+        # Served as the reserved mprpc.profile.start method
+        if method not in self._dispatch or method in RESERVED_METHODS:
+            raise MethodNotFoundError('Method not found: %s' % method)
+        session = profiling.start(method, every, duration, memory)
+        return dict(method=method, every=session.every, duration=duration, memory=session.memory)
+    def _mprpc_profile_stop(self, method):
+        # Served as the reserved mprpc.profile.stop method
+        if not profiling.is_enabled():
+            raise RuntimeError('Profiling is disabled')
+        return profiling.stop(method)
+    def _remaining_budget(self):
+        # Seconds left before the deadline of the request executing in the
+        # calling greenlet, or None if it has none
+        deadline = self._deadlines.get(getcurrent())
+        if deadline is None:
+            return None
+        return max(deadline - time.time(), 0.0)
+    def _cache_epoch(self):
+        # Processes of the same service each count their own epoch. Override
+        # this to share one, e.g. a version kept in a database.
+        return get_cache_epoch(type(self))
 
     #####################################################
     def _get_handle(self):
         return self._socket
     cdef bytes _handle_read(self,int length):
-        return self._socket.recv(length)
+        cdef bytes data = self._socket.recv(length)
+        self._bytes_in += len(data)
+        return data
     cdef bytes _handle_write(self,bytes value):
         if self._send_lock:
             self._send_lock.acquire()
         try:
             self._socket.sendall(value)
+            self._bytes_out += len(value)
         finally:
             if self._send_lock:
                 self._send_lock.release()
         return True
     def _system_read(self,length):
-        return self._socket.recv(length)
+        cdef bytes data = self._socket.recv(length)
+        self._bytes_in += len(data)
+        return data
     def _system_write(self,value):
         if self._send_lock:
             self._send_lock.acquire()
         try:
             self._socket.sendall(value)
+            self._bytes_out += len(value)
         finally:
             if self._send_lock:
                 self._send_lock.release()
         return True
 
     #####################################################
-    cdef int  _msgpack_run(self):
+    cdef int _msgpack_run(self) except? -2:
         cdef bytes data
         cdef tuple req, args
-        cdef dict kwargs
+        cdef dict kwargs, options
         cdef int msg_id=0
         cdef int result=0
+        cdef double started = 0
+        cdef bint controlled
         while True:
-            data = self._socket.recv(SOCKET_RECV_SIZE)
-            if not data:
-                logging.debug('Client disconnected')
-                result=-1
-                break
-            self._unpacker.feed(data)
             try:
-                req = self._unpacker.next()
+                msg = self._unpacker.next()
             except StopIteration:
+                data = self._socket.recv(SOCKET_RECV_SIZE)
+                if not data:
+                    logging.debug('Client disconnected')
+                    result=-1
+                    break
+                self._bytes_in += len(data)
+                self._unpacker.feed(data)
                 continue
-            (msg_id, method, args, kwargs) = self._msgpack_parse_request(req)
-            try:
-                ret = method(*args,**kwargs)
-            except Exception, e:
-                logging.exception('An error has occurred')
-                self._msgpack_send_error(str(e), msg_id)
+            if self._inflater is not None and type(msg) is ExtType:
+                msg = self._inflater.inflate(msg)
+            req = msg
+            if req and req[0] in (MSGPACKRPC_CREDIT, MSGPACKRPC_CANCEL):
+                self._stream_control(req)
                 result=0
                 break
-            else:
-                self._msgpack_send_result(ret, msg_id)
+            if req and req[0] == MSGPACKRPC_NOTIFY:
+                self._msgpack_notify(req)
+                result=0
+                break
+            if req and req[0] == MSGPACKRPC_RING:
+                if len(req) != 2 or not isinstance(req[1], basestring):
+                    raise RPCProtocolError('Invalid protocol')
+                # Ignored without shared memory, whose records are refused
+                if self._shm_regions is not None:
+                    self._shm_regions.announce(req[1])
                 result=0
                 break
+            if req and req[0] == MSGPACKRPC_BATCH:
+                if self._admission is not None and not self._admit():
+                    self._msgpack_batch_busy(req)
+                elif self._pool is not None:
+                    self._pool.spawn(self._msgpack_batch_spawned, req)
+                else:
+                    self._msgpack_batch(req)
+                result=0
+                break
+            try:
+                (msg_id, method, args, kwargs, options) = self._msgpack_parse_request(req)
+            except MethodNotFoundError, e:
+                self._msgpack_send_error(str(e), req[1])
+                result=0
+                break
+            if options and options.get('release') and self._shm_ring is not None:
+                # The client has mapped the ring to have released records
+                self._shm_ring.unlink()
+                for generation in options['release']:
+                    self._shm_ring.release(generation)
+            controlled = self._controlled(req[2])
+            if options and self._msgpack_expired(options):
+                self._msgpack_send_error(DEADLINE_EXCEEDED_ERROR, msg_id)
+            elif controlled and not self._admit():
+                self._msgpack_send_error(SERVER_BUSY_ERROR, msg_id)
+            elif self._pool is not None:
+                self._pool.spawn(self._msgpack_spawned, msg_id, method, args, kwargs, options, req[2],
+                                 time.time() if self._metrics is not None else 0, controlled)
+            elif self._metrics is None:
+                self._msgpack_execute(msg_id, method, args, kwargs, options, controlled)
+            else:
+                started = time.time()
+                self._observe(req[2], started, self._msgpack_execute(msg_id, method, args, kwargs, options, controlled))
+            result=0
+            break
         return result
+    cdef _msgpack_execute(self, int msg_id, method, tuple args, dict kwargs, dict options, bint controlled):
+        # Returns whether the method succeeded. The epoch is read before the
+        # method runs, so that a result computed while another call bumps
+        # it is not tagged with the new one, except for methods bumping it
+        # themselves. Admitted requests, which are controlled, take a slot
+        # here.
+        cdef bint with_epoch = options.get('epoch', False)
+        cdef bint shared
+        cdef bint failed = False
+        cdef bint holding
+        deadline = options.get('deadline')
+        if controlled and not self._acquire_slot():
+            self._msgpack_send_error(SERVER_BUSY_ERROR, msg_id)
+            return False
+        try:
+            if deadline is not None and deadline <= time.time():
+                # Expired while waiting for its turn
+                self._msgpack_send_error(DEADLINE_EXCEEDED_ERROR, msg_id)
+                return False
+            epoch = None
+            if with_epoch and not getattr(method, '_mprpc_invalidates', False):
+                epoch = self._cache_epoch()
+            cache = getattr(method, '_mprpc_cache', None)
+            flight = getattr(method, '_mprpc_coalesce', None)
+            shared = (cache is not None or flight is not None) and not options.get('stream')
+            # Only requests running in their own greenlet can be cancelled,
+            # and shared results are computed for other callers too
+            current = getcurrent() if deadline is not None or (self._pool is not None and not shared) else None
+            if current is not None:
+                if deadline is not None:
+                    self._deadlines[current] = deadline
+                if self._pool is not None and not shared:
+                    self._running[msg_id] = current
+            try:
+                if shared:
+                    ret = self._msgpack_shared_body(method, args, kwargs, cache, flight)
+                else:
+                    ret = method(*args,**kwargs)
+                    if options.get('stream'):
+                        if not (isinstance(ret, (GeneratorType, list, tuple)) or getattr(method, '_mprpc_stream', False)):
+                            ret = (ret,)
+                    elif isinstance(ret, GeneratorType):
+                        ret = list(ret)
+            except Exception, e:
+                logging.exception('An error has occurred')
+                failed = True
+                ret = str(e)
+            except _Cancelled:
+                # Still answered, for the client to release the shared
+                # memory records of the request
+                failed = True
+                ret = CANCELLED_ERROR
+            finally:
+                # Cancelling stops here, as a response must not be cut
+                if current is not None:
+                    self._deadlines.pop(current, None)
+                    self._running.pop(msg_id, None)
+            if with_epoch and epoch is None:
+                epoch = self._cache_epoch()
+            if failed:
+                self._msgpack_send_error(ret, msg_id, epoch)
+                return False
+            if self._shm_size and 'shm' in options and not shared and not options.get('stream'):
+                ret = self._shm_export(ret)
+            if shared:
+                if not with_epoch:
+                    self._msgpack_write_parts(self._msgpack_response_header(msg_id, False), ret, b'')
+                else:
+                    self._msgpack_write_parts(self._msgpack_response_header(msg_id, True), ret,
+                                              self._packer.pack(epoch))
+            elif options.get('stream'):
+                window = int(options['stream'])
+                # The stream holds the slot until it ends
+                (holding, controlled) = (controlled, False)
+                self._stream_start(msg_id, ret, window, holding)
+            elif not with_epoch:
+                self._msgpack_send_result(ret, msg_id, None)
+            else:
+                self._msgpack_send_result(ret, msg_id, epoch)
+            return True
+        finally:
+            if controlled:
+                self._release_slot()
+    def _msgpack_cancel(self, msg_id):
+        # Run by the hub, while the greenlet is suspended. It may have left
+        # the method meanwhile, and is only killed if it has not, as a kill
+        # delivered later would cut its response.
+        running = self._running.get(msg_id)
+        if running is not None:
+            running.throw(_Cancelled)
+    def _msgpack_spawned(self, int msg_id, method, tuple args, dict kwargs, dict options, name, double started,
+                         bint controlled):
+        ok = self._msgpack_execute(msg_id, method, args, kwargs, options, controlled)
+        if self._metrics is not None:
+            self._observe(name, started, ok)
+    cdef _msgpack_notify(self, tuple req):
+        # (type, method, args, kwargs), answered by nothing
+        if len(req) != 4:
+            raise RPCProtocolError('Invalid protocol')
+        try:
+            method = self._lookup_method(req[1])
+        except MethodNotFoundError, e:
+            logging.warning('Dropping a notification: %s', e)
+            return
+        if self._admission is not None and not self._admit():
+            logging.debug('Dropping a notification of %s: server busy', req[1])
+        elif self._pool is not None:
+            self._pool.spawn(self._msgpack_notify_spawned, method, req[2], req[3], req[1],
+                             time.time() if self._metrics is not None else 0)
+        else:
+            self._msgpack_notify_spawned(method, req[2], req[3], req[1],
+                                         time.time() if self._metrics is not None else 0)
+    def _msgpack_notify_spawned(self, method, tuple args, dict kwargs, name, double started):
+        cdef bint ok = True
+        if self._admission is not None and not self._acquire_slot():
+            logging.debug('Dropping a notification of %s: server busy', name)
+            return
+        try:
+            ret = method(*args,**kwargs)
+            if isinstance(ret, GeneratorType):
+                for _ in ret:
+                    pass
+        except Exception, e:
+            logging.exception('An error has occurred')
+            ok = False
+        finally:
+            if self._admission is not None:
+                self._release_slot()
+        if self._metrics is not None:
+            self._observe(name, started, ok)
+    cdef _msgpack_batch(self, tuple batch):
+        cdef tuple req, args
+        cdef dict kwargs
+        cdef int msg_id=0
+        cdef list data=[]
+        cdef double started = 0
+        if len(batch) != 2:
+            raise RPCProtocolError('Invalid protocol')
+        if self._admission is not None and not self._acquire_slot():
+            self._msgpack_batch_busy(batch)
+            return
+        try:
+            for req in batch[1]:
+                try:
+                    (msg_id, method, args, kwargs, _) = self._msgpack_parse_request(req)
+                except MethodNotFoundError, e:
+                    data.append(self._msgpack_pack((MSGPACKRPC_RESPONSE, req[1], str(e), None)))
+                    continue
+                if self._metrics is not None:
+                    started = time.time()
+                cache = getattr(method, '_mprpc_cache', None)
+                flight = getattr(method, '_mprpc_coalesce', None)
+                try:
+                    if cache is not None or flight is not None:
+                        body = self._msgpack_shared_body(method, args, kwargs, cache, flight)
+                        data.append(self._msgpack_compress(self._msgpack_response_header(msg_id, False) + body))
+                        ok = True
+                    else:
+                        ret = method(*args,**kwargs)
+                        if isinstance(ret, GeneratorType):
+                            ret = list(ret)
+                        data.append(self._msgpack_pack((MSGPACKRPC_RESPONSE, msg_id, None, ret)))
+                        ok = True
+                except Exception, e:
+                    logging.exception('An error has occurred')
+                    data.append(self._msgpack_pack((MSGPACKRPC_RESPONSE, msg_id, str(e), None)))
+                    ok = False
+                if self._metrics is not None:
+                    self._observe(req[2], started, ok)
+            self._msgpack_write(b''.join(data))
+        finally:
+            if self._admission is not None:
+                self._release_slot()
+    cdef _shm_export(self, value):
+        if type(value) not in SHARED_TYPES or len(value) < self._shm_threshold:
+            return value
+        if self._shm_ring is None:
+            self._shm_ring = SharedRing(self._shm_size)
+            # Written ahead of the response referring to the ring
+            self._msgpack_write(self._msgpack_pack(self._shm_ring.announcement()))
+        return export(self._shm_ring, value, self._shm_threshold)
+    cdef bint _msgpack_expired(self, dict options):
+        # A budget, in seconds, becomes a deadline on arrival
+        budget = options.get('budget')
+        if budget is not None:
+            options['deadline'] = time.time() + budget
+        deadline = options.get('deadline')
+        return deadline is not None and deadline <= time.time()
+    def _msgpack_batch_spawned(self, tuple batch):
+        self._msgpack_batch(batch)
+    cdef _msgpack_batch_busy(self, tuple batch):
+        self._msgpack_write(b''.join([self._msgpack_pack((MSGPACKRPC_RESPONSE, req[1], SERVER_BUSY_ERROR, None))
+                                      for req in batch[1]]))
     cdef tuple _msgpack_parse_request(self, tuple req):
-        if (len(req) != 5 or req[0] != MSGPACKRPC_REQUEST):
+        # An optional sixth element carries request options
+        if (len(req) not in (5, 6) or req[0] != MSGPACKRPC_REQUEST):
             raise RPCProtocolError('Invalid protocol')
         cdef tuple args
         cdef dict kwargs
+        cdef dict options = req[5] if len(req) == 6 else {}
         cdef int msg_id=0
-        (_, msg_id, method_name, args ,kwargs) = req
-        if method_name.startswith('_'):
-            raise MethodNotFoundError('Method not callow: %s', method_name)
-        if not hasattr(self, method_name):
-            raise MethodNotFoundError('Method not found: %s', method_name)
-        method = getattr(self, method_name)
-        if not hasattr(method, '__call__'):
-            raise MethodNotFoundError('Method is not callable: %s', method_name)
-        return (msg_id, method, args, kwargs)
-    cdef _msgpack_send_result(self, object result, int msg_id):
-        msg = (MSGPACKRPC_RESPONSE, msg_id, None, result)
+        (msg_id, method_name, args ,kwargs) = req[1:5]
+        method = self._lookup_method(method_name)
+        return (msg_id, method, args, kwargs, options)
+    cdef _msgpack_send_result(self, object result, int msg_id, epoch=None):
+        # Responses to requests asking for it carry the cache epoch last
+        if epoch is None:
+            msg = (MSGPACKRPC_RESPONSE, msg_id, None, result)
+        else:
+            msg = (MSGPACKRPC_RESPONSE, msg_id, None, result, epoch)
         self._msgpack_send(msg)
-    cdef _msgpack_send_error(self, str error, int msg_id):
-        msg = (MSGPACKRPC_RESPONSE, msg_id, error, None)
+    cdef _msgpack_send_error(self, str error, int msg_id, epoch=None):
+        if epoch is None:
+            msg = (MSGPACKRPC_RESPONSE, msg_id, error, None)
+        else:
+            msg = (MSGPACKRPC_RESPONSE, msg_id, error, None, epoch)
         self._msgpack_send(msg)
+    cdef bytes _msgpack_shared_body(self, method, tuple args, dict kwargs, cache, flight):
+        # Responses shared between requests are packed without their header,
+        # which carries the message ID: the error (nil) followed by the result
+        cdef bytes key = make_key(args, kwargs)
+        cdef bytes body
+        if cache is not None:
+            body = cache.get(key)
+            if body is not None:
+                return body
+        if flight is not None:
+            return flight.run(key, self._msgpack_body, method, args, kwargs, cache, key)
+        return self._msgpack_body(method, args, kwargs, cache, key)
+    def _msgpack_body(self, method, tuple args, dict kwargs, cache, bytes key):
+        cdef bytes body
+        ret = method(*args,**kwargs)
+        if isinstance(ret, GeneratorType):
+            ret = list(ret)
+        body = b'\xc0' + self._packer.pack(ret)
+        if cache is not None:
+            cache.set(key, body)
+        return body
+    cdef bytes _msgpack_response_header(self, int msg_id, bint with_epoch):
+        # A fixarray of 4 elements, or 5 with the epoch after the body, then
+        # the response type and message ID
+        return ((b'\x95' if with_epoch else b'\x94') + self._packer.pack(MSGPACKRPC_RESPONSE)
+                + self._packer.pack(msg_id))
+    cdef _msgpack_write_parts(self, bytes header, bytes body, bytes trailer):
+        if self._deflater is not None:
+            self._msgpack_write(self._deflater.compress(header + body + trailer))
+            return
+        if len(body) <= SENDV_JOIN_SIZE:
+            self._msgpack_write(header + body + trailer)
+            return
+        if self._send_lock:
+            self._send_lock.acquire()
+        try:
+            sendv(self._socket, [header, body, trailer] if trailer else [header, body])
+            self._bytes_out += len(header) + len(body) + len(trailer)
+        finally:
+            if self._send_lock:
+                self._send_lock.release()
     cdef _msgpack_send(self,tuple  msg):
+        self._msgpack_write(self._msgpack_pack(msg))
+    cdef bytes _msgpack_pack(self, tuple msg):
+        return self._msgpack_compress(self._packer.pack(msg))
+    cdef bytes _msgpack_compress(self, bytes data):
+        # Each message is compressed on its own, so that messages written by
+        # different greenlets need no ordering
+        if self._deflater is None:
+            return data
+        return self._deflater.compress(data)
+    cdef _msgpack_write(self, bytes data):
         if self._send_lock:
             self._send_lock.acquire()
         try:
-            self._socket.sendall(self._packer.pack(msg))
+            self._socket.sendall(data)
+            self._bytes_out += len(data)
         finally:
             if self._send_lock:
                 self._send_lock.release()
 
     #####################################################
-    cdef int _pickles_run(self):
-        cdef bytes data
+    cdef _stream_start(self, int msg_id, items, int window, bint controlled):
+        stream = self._streams[msg_id] = _Stream(window)
+        stream.controlled = controlled
+        if self._pool is not None:
+            self._stream_spawned(msg_id, items, stream)
+        else:
+            # The reading greenlet has to stay free to receive credit
+            gevent.spawn(self._stream_spawned, msg_id, items, stream)
+    def _stream_spawned(self, int msg_id, items, stream):
+        error = None
+        try:
+            items = iter(items)
+            while not stream.cancelled:
+                if stream.credit <= 0:
+                    self._stream_flush(stream)
+                    stream.wait()
+                    continue
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                chunk = self._msgpack_pack((MSGPACKRPC_CHUNK, msg_id, item))
+                stream.buffered.append(chunk)
+                stream.size += len(chunk)
+                stream.credit -= 1
+                if stream.size >= SENDV_JOIN_SIZE:
+                    self._stream_flush(stream)
+                elif stream.timer is None:
+                    # Sends the chunks while the generator works on the next
+                    # items, however long it takes
+                    stream.timer = gevent.spawn_later(STREAM_FLUSH_INTERVAL, self._stream_flush_later, stream)
+        except Exception, e:
+            logging.exception('An error has occurred')
+            error = str(e)
+        finally:
+            self._streams.pop(msg_id, None)
+            self._stream_cancel_flush(stream)
+            if stream.controlled:
+                self._release_slot()
+            if hasattr(items, 'close'):
+                items.close()
+        if stream.closed:
+            return
+        stream.buffered.append(self._msgpack_pack((MSGPACKRPC_RESPONSE, msg_id, error, None)))
+        try:
+            self._stream_flush(stream)
+        except Exception, e:
+            logging.debug('Failed to end a stream: %s', e)
+    cdef _stream_flush(self, stream):
+        self._stream_cancel_flush(stream)
+        if stream.buffered:
+            data = b''.join(stream.buffered)
+            (stream.buffered, stream.size) = ([], 0)
+            self._msgpack_write(data)
+    cdef _stream_cancel_flush(self, stream):
+        # The timer is cleared as soon as it runs, so this only ever cancels a
+        # timer that has not started writing
+        if stream.timer is not None:
+            stream.timer.kill(block=False)
+            stream.timer = None
+    def _stream_flush_later(self, stream):
+        stream.timer = None
+        try:
+            self._stream_flush(stream)
+        except Exception, e:
+            logging.debug('Failed to flush a stream: %s', e)
+    cdef _stream_control(self, tuple req):
+        if len(req) != 3:
+            raise RPCProtocolError('Invalid protocol')
+        stream = self._streams.get(req[1])
+        if stream is None:
+            if req[0] == MSGPACKRPC_CANCEL and req[1] in self._running:
+                gevent.get_hub().loop.run_callback(self._msgpack_cancel, req[1])
+            return
+        if req[0] == MSGPACKRPC_CREDIT:
+            stream.grant(req[2])
+        else:
+            stream.cancel()
+
+    #####################################################
+    cdef int _codec_run(self, codec) except? -2:
+        cdef bytes header
         cdef tuple req, args
         cdef dict kwargs
         cdef int msg_id=0
         cdef int result=0
-        data = self._socket.recv(SOCKET_RECV_SIZE)
-        if not data:
+        cdef Py_ssize_t length
+        cdef double started = 0
+        cdef bint controlled
+        if codec.tag in self._codec_states:
+            state = self._codec_states[codec.tag]
+        else:
+            state = self._codec_states[codec.tag] = codec.new_state()
+        header = self._read_exact(codec.header.size)
+        if not header:
+            logging.debug('Client disconnected')
+            result=-1
+            return result
+        length = codec.unpack_header(header, state)
+        view = self._frame_view(length)
+        if not self._recv_into(view, length):
             logging.debug('Client disconnected')
             result=-1
             return result
         try:
-            req = pickle.loads(data)
+            req = tuple(codec.decode(view, state))
         except Exception, e:
             logging.exception('An error has occurred')
-            self._pickles_send_error(str(e), msg_id)
-            result=0
+            self._codec_send(codec, state, (MSGPACKRPC_RESPONSE, msg_id, str(e), None))
+            return result
+        try:
+            (msg_id, method, args, kwargs) = self._codec_parse_request(req)
+        except MethodNotFoundError, e:
+            self._codec_send(codec, state, (MSGPACKRPC_RESPONSE, req[1], str(e), None))
+            return result
+        if self._metrics is not None:
+            started = time.time()
+        controlled = self._controlled(req[2])
+        if controlled and not self._enter():
+            self._codec_send(codec, state, (MSGPACKRPC_RESPONSE, msg_id, SERVER_BUSY_ERROR, None))
             return result
-        (msg_id, method, args, kwargs) = self._pickles_parse_request(req)
         try:
             ret = method(*args,**kwargs)
         except Exception, e:
             logging.exception('An error has occurred')
-            self._pickles_send_error(str(e), msg_id)
-            result=0
+            self._codec_send(codec, state, (MSGPACKRPC_RESPONSE, msg_id, str(e), None))
+            ok = False
         else:
-            self._pickles_send_result(ret, msg_id)
-            result=0
+            self._codec_send(codec, state, (MSGPACKRPC_RESPONSE, msg_id, None, ret))
+            ok = True
+        finally:
+            if controlled:
+                self._release_slot()
+        if self._metrics is not None:
+            self._observe(req[2], started, ok)
         return result
-    cdef tuple _pickles_parse_request(self, tuple req):
+    cdef _frame_view(self, Py_ssize_t length):
+        # Payloads up to SOCKET_RECV_SIZE reuse one buffer per connection
+        if length > SOCKET_RECV_SIZE:
+            return memoryview(bytearray(length))[:length]
+        if self._frame_buffer is None:
+            self._frame_buffer = memoryview(bytearray(SOCKET_RECV_SIZE))
+        return self._frame_buffer[:length]
+    cdef tuple _codec_parse_request(self, tuple req):
         if (len(req) != 5 or req[0] != MSGPACKRPC_REQUEST):
             raise RPCProtocolError('Invalid protocol')
-        cdef tuple args
-        cdef dict kwargs
         cdef int msg_id=0
         (_, msg_id, method_name, args ,kwargs) = req
-        if method_name.startswith('_'):
-            raise MethodNotFoundError('Method not callow: %s', method_name)
-        if not hasattr(self, method_name):
-            raise MethodNotFoundError('Method not found: %s', method_name)
-        method = getattr(self, method_name)
-        if not hasattr(method, '__call__'):
-            raise MethodNotFoundError('Method is not callable: %s', method_name)
-        return (msg_id, method, args, kwargs)
-    cdef _pickles_send_result(self, object result, int msg_id):
-        msg = (MSGPACKRPC_RESPONSE, msg_id, None, result)
-        self._pickles_send(msg)
-    cdef _pickles_send_error(self, str error, int msg_id):
-        msg = (MSGPACKRPC_RESPONSE, msg_id, error, None)
-        self._pickles_send(msg)
-    cdef _pickles_send(self, tuple msg):
+        method = self._lookup_method(method_name)
+        return (msg_id, method, tuple(args), dict(kwargs))
+    cdef _codec_send(self, codec, state, tuple msg):
+        cdef bytes data = codec.frame(msg, state)
         if self._send_lock:
             self._send_lock.acquire()
         try:
-            self._socket.sendall(pickle.dumps(msg))
+            self._socket.sendall(data)
+            self._bytes_out += len(data)
+        finally:
+            if self._send_lock:
+                self._send_lock.release()
+
+    #####################################################
+    cdef tuple _read_envelope(self):
+        # Small reads keep the raw body that follows out of the unpacker
+        cdef bytes data
+        while True:
+            try:
+                return self._unpacker.next()
+            except StopIteration:
+                data = self._socket.recv(BUFFERS_RECV_SIZE)
+                if not data:
+                    return None
+                self._bytes_in += len(data)
+                self._unpacker.feed(data)
+    cdef int _buffers_run(self) except? -2:
+        cdef tuple req, args
+        cdef dict kwargs
+        cdef int msg_id=0
+        cdef int result=0
+        cdef double started = 0
+        cdef Py_ssize_t length
+        req = self._read_envelope()
+        if req is None:
+            logging.debug('Client disconnected')
+            result=-1
+            return result
+        if (len(req) != 6 or req[0] != MSGPACKRPC_REQUEST):
+            raise RPCProtocolError('Invalid protocol')
+        (_, msg_id, method_name, args, kwargs, size) = req
+        if type(size) not in (int, long) or not 0 <= size <= self._max_buffer_size:
+            raise RPCProtocolError('Invalid body length: %r' % (size,))
+        length = size
+        if self._metrics is not None:
+            started = time.time()
+        buf = _buffer_pool.acquire(length)
+        try:
+            view = memoryview(buf)[:length]
+            if not self._recv_into(view, length):
+                logging.debug('Client disconnected')
+                result=-1
+                return result
+            if self._admission is not None and not self._enter():
+                self._buffers_send(msg_id, SERVER_BUSY_ERROR, b'')
+                return result
+            try:
+                method = self._lookup_method(method_name)
+                ret = method(view, *args, **kwargs)
+                body = memoryview(b'' if ret is None else ret)
+            except Exception, e:
+                logging.exception('An error has occurred')
+                self._buffers_send(msg_id, str(e), b'')
+                ok = False
+            else:
+                self._buffers_send(msg_id, None, body)
+                ok = True
+            finally:
+                if self._admission is not None:
+                    self._release_slot()
+        finally:
+            _buffer_pool.release(buf)
+        if self._metrics is not None:
+            self._observe(method_name, started, ok)
+        return result
+    cdef _buffers_send(self, int msg_id, error, body):
+        cdef bytes header = self._packer.pack((MSGPACKRPC_RESPONSE, msg_id, error, len(body)))
+        if self._send_lock:
+            self._send_lock.acquire()
+        try:
+            sendv(self._socket, [header, body])
+            self._bytes_out += len(header) + len(body)
+        finally:
+            if self._send_lock:
+                self._send_lock.release()
+
+    #####################################################
+    cdef int _fileobj_run(self) except? -2:
+        cdef tuple req, args
+        cdef dict kwargs
+        cdef int msg_id=0
+        cdef int result=0
+        cdef double started = 0
+        req = self._read_envelope()
+        if req is None:
+            logging.debug('Client disconnected')
+            result=-1
+            return result
+        if (len(req) != 5 or req[0] != MSGPACKRPC_REQUEST):
+            raise RPCProtocolError('Invalid protocol')
+        (_, msg_id, method_name, args, kwargs) = req
+        if self._metrics is not None:
+            started = time.time()
+        if self._admission is not None and not self._enter():
+            self._fileobj_send(msg_id, SERVER_BUSY_ERROR, b'', 0)
+            return result
+        try:
+            method = self._lookup_method(method_name)
+            ret = method(*args, **kwargs)
+            length = file_size(ret) if hasattr(ret, 'read') else None
+            if length is None:
+                ret = memoryview(ret.read() if hasattr(ret, 'read') else ret or b'')
+                length = len(ret)
+        except Exception, e:
+            logging.exception('An error has occurred')
+            self._fileobj_send(msg_id, str(e), b'', 0)
+            ok = False
+        else:
+            try:
+                self._fileobj_send(msg_id, None, ret, length)
+            finally:
+                if hasattr(ret, 'close'):
+                    ret.close()
+            ok = True
+        finally:
+            if self._admission is not None:
+                self._release_slot()
+        if self._metrics is not None:
+            self._observe(method_name, started, ok)
+        return result
+    cdef _fileobj_send(self, int msg_id, error, body, Py_ssize_t length):
+        cdef bytes header = self._packer.pack((MSGPACKRPC_RESPONSE, msg_id, error, length))
+        if self._send_lock:
+            self._send_lock.acquire()
+        try:
+            if hasattr(body, 'read'):
+                self._socket.sendall(header)
+                sendfile(self._socket, body, length, wait_write)
+            else:
+                sendv(self._socket, [header, body])
+            self._bytes_out += len(header) + length
         finally:
             if self._send_lock:
                 self._send_lock.release()
@@ -290,22 +1149,29 @@ cdef class RPCServer:
         cdef dict kwargs
         cdef int msg_id=0
         cdef int result=0
+        cdef double started = 0
         data = self._socket.recv(METHOD_STRINGS_SIZE)
         if not data:
             logging.debug('Client disconnected')
             result=-1
             return result
+        self._bytes_in += len(data)
         req=data[0:1],data[1:9],data[9:METHOD_STRINGS_SIZE]
         (msg_id, method, args, kwargs) = self._strings_parse_request(req)
+        if self._metrics is not None:
+            started = time.time()
         try:
             ret = method(*args,**kwargs)
         except Exception, e:
             logging.exception('An error has occurred')
             self._strings_send_error(str(e), msg_id)
-            result=0
+            ok = False
         else:
             self._strings_send_result(ret, msg_id)
-            result=0
+            ok = True
+        if self._metrics is not None:
+            self._observe(req[2].lstrip(), started, ok)
+        result=0
         return result
     cdef tuple _strings_parse_request(self, tuple req):
         if (len(req) != 3 or int(req[0]) != MSGPACKRPC_REQUEST):
@@ -315,13 +1181,7 @@ cdef class RPCServer:
         cdef int msg_id=0
         msg_id=int(req[1].lstrip())
         method_name=req[2].lstrip()
-        if method_name.startswith('_'):
-            raise MethodNotFoundError('Method not callow: %s', method_name)
-        if not hasattr(self, method_name):
-            raise MethodNotFoundError('Method not found: %s', method_name)
-        method = getattr(self, method_name)
-        if not hasattr(method, '__call__'):
-            raise MethodNotFoundError('Method is not callable: %s', method_name)
+        method = self._lookup_method(method_name)
         return (msg_id, method, args, kwargs)
     cdef _strings_send_result(self, object result, int msg_id):
         msg = (MSGPACKRPC_RESPONSE, msg_id,'', result)
@@ -330,13 +1190,23 @@ cdef class RPCServer:
         msg = (MSGPACKRPC_RESPONSE, msg_id, error, '')
         self._strings_send(msg)
     cdef _strings_send(self, tuple msg):
+        header = '%1d%8d%21s'%(msg[0],msg[1],msg[2])
+        body = msg[3]
+        if hasattr(body,'read'):
+            length = file_size(body)
+            if length is None:
+                body = body.read()
         if self._send_lock:
             self._send_lock.acquire()
         try:
-            if hasattr(msg[3],'read'):
-                self._socket.sendall('%1d%8d%21s'%(msg[0],msg[1],msg[2])+msg[3].read())
+            if hasattr(body,'read'):
+                self._socket.sendall(header)
+                sendfile(self._socket, body, length, wait_write)
+            elif len(body) > SENDV_JOIN_SIZE:
+                sendv(self._socket, [header, body])
             else:
-                self._socket.sendall('%1d%8d%21s'%(msg[0],msg[1],msg[2])+msg[3])
+                self._socket.sendall(header+body)
+            self._bytes_out += len(header) + (length if hasattr(body,'read') else len(body))
         finally:
             if self._send_lock:
                 self._send_lock.release()
@@ -348,22 +1218,29 @@ cdef class RPCServer:
         cdef dict kwargs
         cdef int msg_id=0
         cdef int result=0
+        cdef double started = 0
         data = self._socket.recv(METHOD_URIHTTP_SIZE)
         if not data:
             logging.debug('Client disconnected')
             result=-1
             return result
+        self._bytes_in += len(data)
         req=decode_urihttp(url=data)
         (msg_id, method, args, kwargs) = self._urihttp_parse_request(req)
+        if self._metrics is not None:
+            started = time.time()
         try:
             ret = method(*args,**kwargs)
         except Exception, e:
             logging.exception('An error has occurred')
             self._urihttp_send_error(str(e), msg_id)
-            result=0
+            ok = False
         else:
             self._urihttp_send_result(ret, msg_id)
-            result=0
+            ok = True
+        if self._metrics is not None:
+            self._observe(req[0], started, ok)
+        result=0
         return result
     cdef tuple _urihttp_parse_request(self, tuple req):
         if len(req) != 3:
@@ -374,13 +1251,7 @@ cdef class RPCServer:
         method_name=req[0]
         args=req[1]
         kwargs=req[2]
-        if method_name.startswith('_'):
-            raise MethodNotFoundError('Method not callow: %s', method_name)
-        if not hasattr(self, method_name):
-            raise MethodNotFoundError('Method not found: %s', method_name)
-        method = getattr(self, method_name)
-        if not hasattr(method, '__call__'):
-            raise MethodNotFoundError('Method is not callable: %s', method_name)
+        method = self._lookup_method(method_name)
         if kwargs.has_key('msgsysid'):
             msg_id=int(kwargs.get('msgsysid'))
             del kwargs['msgsysid']
@@ -392,13 +1263,23 @@ cdef class RPCServer:
         msg = (MSGPACKRPC_RESPONSE, msg_id, error, '')
         self._urihttp_send(msg)
     cdef _urihttp_send(self, tuple msg):
+        header = '%1d%8d%21s'%(msg[0],msg[1],msg[2])
+        body = msg[3]
+        if hasattr(body,'read'):
+            length = file_size(body)
+            if length is None:
+                body = body.read()
         if self._send_lock:
             self._send_lock.acquire()
         try:
-            if hasattr(msg[3],'read'):
-                self._socket.sendall('%1d%8d%21s'%(msg[0],msg[1],msg[2])+msg[3].read())
+            if hasattr(body,'read'):
+                self._socket.sendall(header)
+                sendfile(self._socket, body, length, wait_write)
+            elif len(body) > SENDV_JOIN_SIZE:
+                sendv(self._socket, [header, body])
             else:
-                self._socket.sendall('%1d%8d%21s'%(msg[0],msg[1],msg[2])+msg[3])
+                self._socket.sendall(header+body)
+            self._bytes_out += len(header) + (length if hasattr(body,'read') else len(body))
         finally:
             if self._send_lock:
                 self._send_lock.release()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""Shared memory transfer of large payloads between local processes.
+
+A client created with ``shared_memory`` writes its large ``bytes``,
+``bytearray`` and ``memoryview`` arguments to a ring of records in a file
+under ``/dev/shm``, and asks the server to do the same for large results.
+The socket then only carries a small descriptor of each record, a MessagePack
+ext value holding its offset, length and generation and the path of the
+ring, and the receiver gets a ``memoryview`` over the record without a copy:
+
+.. code-block:: python
+
+    >>> server = StreamServer(listen('unix:///run/features.sock'),
+    ...                       functools.partial(FeatureServer, shared_memory=1024 ** 3))
+    >>> client = RPCClient('unix:///run/features.sock', shared_memory=256 * 1024 ** 2)
+    >>> view = client.call('features', 'user-embeddings')
+
+A record is reused once its reader is done with it. The server is done with
+an argument when the call returns, so views of arguments are valid only until
+the method returns, as in BUFFERS mode. A result is released once the client
+has dropped every view of it. Records that do not fit in the ring are sent
+over the socket as usual.
+
+Only the arguments, keyword argument values and results of plain
+MessagePack calls are transferred this way, not batches, streams or shared
+results of :func:`cached <mprpc.decorators.cached>` methods. Both processes
+must run on the same host under the same user, connected over a Unix domain
+socket: servers ignore ``shared_memory`` on other connections.
+
+Each end announces its ring on the connection before referring to it, and
+only maps the ring its peer announced, once it has checked that the file is
+a regular file of the same user. The ring file is removed as soon as the
+peer has mapped it. Rings left behind by processes that were killed are
+named after their process ID and removed by :func:`remove_stale_rings`.
+"""
+
+import os
+import mmap
+import stat
+import errno
+import ctypes
+import struct
+import weakref
+import tempfile
+from collections import deque
+
+import msgpack
+
+from constants import SHM_EXT_TYPE, MSGPACKRPC_RING
+from exceptions import RPCProtocolError
+
+DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+PREFIX = 'mprpc-'
+
+# Offset, length and generation of a record, followed by the ring path
+_DESCRIPTOR = struct.Struct('!QQQ')
+# Records start with their generation, and their data is cache line aligned
+_HEADER = struct.Struct('!Q')
+_ALIGNMENT = 64
+
+SHARED_TYPES = (bytes, bytearray, memoryview)
+
+
+class SharedRing(object):
+    """Ring of records written by one process and read by its peer.
+
+    Records are allocated in order and reclaimed in order once released, so
+    a record released early waits for the ones written before it.
+
+    :param int size: Size of the ring in bytes.
+    """
+
+    def __init__(self, size):
+        (fd, self.path) = tempfile.mkstemp(prefix='%s%d-' % (PREFIX, os.getpid()), suffix='.ring', dir=DIRECTORY)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.size = size
+        # Whether the ring file still exists
+        self.linked = True
+        # Generation of the last record written
+        self.generation = 0
+        # (generation, start, end) of the records in use, oldest first
+        self._records = deque()
+        self._released = set()
+
+    def announcement(self):
+        """Returns the message announcing the ring to the peer."""
+        return (MSGPACKRPC_RING, self.path)
+
+    def write(self, data):
+        """Copies a bytes-like object to a new record.
+
+        :returns: The descriptor of the record as an ext value, or None if
+            the ring has no room for it.
+        """
+        length = len(data)
+        start = self._allocate(_ALIGNMENT + length)
+        if start is None:
+            return None
+        self.generation += 1
+        self._records.append((self.generation, start, start + _ALIGNMENT + length))
+        _HEADER.pack_into(self._map, start, self.generation)
+        if length:
+            memoryview((ctypes.c_char * length).from_buffer(self._map, start + _ALIGNMENT))[:] = data
+        return msgpack.ExtType(SHM_EXT_TYPE, _DESCRIPTOR.pack(start, length, self.generation) + self.path)
+
+    def release(self, generation):
+        """Marks a record as no longer read, so that it can be reused."""
+        self._released.add(generation)
+        while self._records and self._records[0][0] in self._released:
+            self._released.discard(self._records.popleft()[0])
+
+    def unlink(self):
+        """Removes the ring file, once the peer has mapped it."""
+        if self.linked:
+            self.linked = False
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def close(self):
+        """Removes the ring file. Peers keep the records they have mapped."""
+        self.unlink()
+        self._records.clear()
+        self._map = None
+
+    def _allocate(self, size):
+        size += -size % _ALIGNMENT
+        if not self._records:
+            return 0 if size <= self.size else None
+        (head, tail) = (self._records[-1][2], self._records[0][1])
+        if head > tail:
+            if head + size <= self.size:
+                return head
+            # Wrap around, leaving the end of the ring unused
+            return 0 if size <= tail else None
+        return head if head + size <= tail else None
+
+
+class SharedRegions(object):
+    """Views of the records of the ring of a peer.
+
+    Instances unpack ext values, as the ``ext_hook`` of a
+    ``msgpack.Unpacker``, which does not keep a reference to it: the
+    instance must be kept for as long as the unpacker.
+
+    :param bool track: (optional) If set to True, the generations of the
+        records whose views have all been dropped are collected in
+        :attr:`released`.
+    """
+
+    def __init__(self, track=False):
+        self.released = []
+        self._track = track
+        self._maps = {}
+        self._views = {}
+
+    def announce(self, path):
+        """Maps the ring the peer announced on the connection."""
+        if path in self._maps:
+            return
+        if self._maps:
+            raise RPCProtocolError('A shared memory ring has already been announced')
+        self._maps[path] = self._open(path)
+
+    def view(self, data):
+        """Returns a ``memoryview`` of the record an ext value describes."""
+        (offset, length, generation) = _DESCRIPTOR.unpack_from(data)
+        path = data[_DESCRIPTOR.size:]
+        shared = self._maps.get(path)
+        if shared is None:
+            raise RPCProtocolError('Unknown shared memory ring: %s' % path)
+        if offset + _ALIGNMENT + length > len(shared) or _HEADER.unpack_from(shared, offset)[0] != generation:
+            raise RPCProtocolError('Invalid shared memory record')
+        region = (ctypes.c_char * length).from_buffer(shared, offset + _ALIGNMENT)
+        if self._track:
+            ref = weakref.ref(region, self._collect)
+            # ctypes arrays are unhashable, and so are references to them
+            self._views[id(ref)] = (ref, generation)
+        return memoryview(region)
+
+    def __call__(self, code, data):
+        if code == SHM_EXT_TYPE:
+            return self.view(data)
+        return msgpack.ExtType(code, data)
+
+    def close(self):
+        """Forgets the rings mapped so far. Views still in use stay valid."""
+        # Mappings are freed along with the last view of them
+        self._maps.clear()
+        self._views.clear()
+        self.released = []
+
+    def _open(self, path):
+        # Only mprpc rings may be mapped
+        if os.path.dirname(path) != DIRECTORY or not os.path.basename(path).startswith(PREFIX):
+            raise RPCProtocolError('Invalid shared memory path: %s' % path)
+        # The directory is writable by other users, who may plant links or
+        # files of their own there
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_NOFOLLOW)
+        except OSError, e:
+            raise RPCProtocolError('Invalid shared memory path: %s (%s)' % (path, e.strerror))
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid() or not st.st_size:
+                raise RPCProtocolError('Invalid shared memory path: %s' % path)
+            return mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+    def _collect(self, ref):
+        view = self._views.pop(id(ref), None)
+        if view is not None:
+            self.released.append(view[1])
+
+
+def remove_stale_rings():
+    """Removes the ring files of this user left behind by processes that
+    are no longer running.
+
+    :returns: The number of files removed.
+    """
+    removed = 0
+    for name in os.listdir(DIRECTORY):
+        if not name.startswith(PREFIX):
+            continue
+        path = os.path.join(DIRECTORY, name)
+        try:
+            pid = int(name[len(PREFIX):].split('-', 1)[0])
+            if os.lstat(path).st_uid != os.geteuid():
+                continue
+            os.kill(pid, 0)
+        except ValueError:
+            continue
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                continue
+            try:
+                os.unlink(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def refusing_ext_hook(code, data):
+    """Unpacks ext values for connections without shared memory."""
+    if code == SHM_EXT_TYPE:
+        raise RPCProtocolError('Shared memory is disabled')
+    return msgpack.ExtType(code, data)
+
+
+def export(ring, value, threshold):
+    """Returns an ext value describing a large bytes-like value written to
+    the ring, or the value itself."""
+    if type(value) not in SHARED_TYPES or len(value) < threshold:
+        return value
+    ext = ring.write(value)
+    if ext is not None:
+        return ext
+    # Sent over the socket, which takes bytes only
+    if type(value) is memoryview:
+        return value.tobytes()
+    return value if type(value) is bytes else bytes(value)
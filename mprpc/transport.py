@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Connections to TCP and Unix domain socket endpoints.
+
+Clients and servers take a host and a port. A host of the form
+``unix:///run/svc.sock`` names a Unix domain socket instead, and the port is
+ignored. On Linux, ``unix://@name`` names a socket in the abstract namespace.
+
+.. code-block:: python
+
+    >>> from gevent.server import StreamServer
+    >>> from mprpc.transport import listen
+    >>> server = StreamServer(listen('unix:///run/svc.sock'), SumServer)
+    >>> client = RPCClient('unix:///run/svc.sock')
+"""
+
+import os
+import stat
+import socket
+
+try:
+    string_types = basestring
+except NameError:
+    # Python 3, for mprpc.aio
+    string_types = str
+
+UNIX_SCHEME = 'unix://'
+
+
+def unix_path(host):
+    """Returns the socket path named by a ``unix://`` host, or None for
+    other hosts."""
+    if not isinstance(host, string_types) or not host.startswith(UNIX_SCHEME):
+        return None
+    path = host[len(UNIX_SCHEME):]
+    if path.startswith('@'):
+        return '\0' + path[1:]
+    return path
+
+
+def format_endpoint(host, port=None):
+    if unix_path(host) is not None:
+        return host
+    return '%s:%s' % (host, port)
+
+
+def connect(host, port=None, socket_module=socket):
+    """Returns a socket connected to an endpoint.
+
+    :param socket_module: (optional) Module providing the socket classes,
+        such as ``gevent.socket``.
+    """
+    path = unix_path(host)
+    if path is None:
+        return socket_module.create_connection((host, port))
+    sock = socket_module.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+def listen(host, port=None, backlog=1024, socket_module=None):
+    """Returns a socket listening on an endpoint, to be passed to
+    ``StreamServer``. A socket file left by a previous process is replaced.
+
+    :param socket_module: (optional) Module providing the socket classes.
+        Defaults to ``gevent.socket``.
+    """
+    if socket_module is None:
+        from gevent import socket as socket_module
+    path = unix_path(host)
+    if path is None:
+        sock = socket_module.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        address = (host, port)
+    else:
+        if not path.startswith('\0') and os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        sock = socket_module.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = path
+    try:
+        sock.bind(address)
+        sock.listen(backlog)
+    except:
+        sock.close()
+        raise
+    return sock
@@ -16,6 +16,9 @@ setup(
     ext_modules=cythonize('mprpc/*.pyx'),
     license=open('LICENSE').read(),
     include_package_data=True,
+    entry_points={
+        'console_scripts': ['mprpc-serve = mprpc.serve:main'],
+    },
     keywords=['rpc', 'msgpack', 'messagepack', 'msgpackrpc', 'messagepackrpc',
               'messagepack rpc', 'gevent'],
     classifiers=(
@@ -1,22 +1,58 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import time
+import signal
+import functools
+import tempfile
+import threading
+import subprocess
+from StringIO import StringIO
+
 import gevent
 from gevent import socket
+from gevent.event import Event
 from gevent.server import StreamServer
 
 from nose.tools import *
+from nose.plugins.skip import SkipTest
 from mock import Mock, patch
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
 
 from mprpc.client import RPCClient
+from mprpc import client_simple
+from mprpc.client_simple import ClientBUF, ClientFIL, ClientJSN, ClientPIK
 from mprpc.server import RPCServer
-from mprpc.exceptions import RPCError
+from mprpc.decorators import cached, coalesce, export, invalidates
+from mprpc.exceptions import DeadlineExceededError, PoolTimeoutError, RPCError, RPCProtocolError, ServerBusyError
+from mprpc.pool import ConnectionPool
+from mprpc.cache import SingleFlight
+from mprpc.cluster import RPCClusterClient
+from mprpc.compression import Deflater, Inflater
+from mprpc import admission, metrics, profiling, serve, shm
+from mprpc.transport import listen
 
 HOST = 'localhost'
 PORT = 6000
 
 
+class PidServer(RPCServer):
+    def pid(self, delay=0):
+        gevent.sleep(delay)
+        return os.getpid()
+
+
 class TestRPC(object):
     def setUp(self):
+        produced = self._produced = []
+
         class TestServer(RPCServer):
             def echo(self, msg):
                 return msg
@@ -28,6 +64,26 @@ class TestRPC(object):
             def raise_error(self):
                 raise Exception('error msg')
 
+            def reverse(self, body, times=1):
+                return body.tobytes()[::-1] * times
+
+            def open_file(self, path):
+                return open(path, 'rb')
+
+            def open_string(self, msg):
+                return StringIO(msg.encode('utf-8'))
+
+            def count(self, n):
+                for i in xrange(n):
+                    produced.append(i)
+                    yield i
+
+            def count_slowly(self, n, interval):
+                for i in xrange(n):
+                    yield i
+                    gevent.sleep(interval)
+
+        self._server_class = TestServer
         self._server = StreamServer((HOST, PORT), TestServer)
         self._glet = gevent.spawn(self._server.serve_forever)
 
@@ -86,3 +142,1085 @@ class TestRPC(object):
         client = RPCClient(HOST, PORT, timeout=0.1)
 
         client.call('echo_delayed', 'message', 1)
+
+    def test_call_multiplexed(self):
+        client = RPCClient(HOST, PORT, multiplex=True)
+
+        glets = [gevent.spawn(client.call, 'echo_delayed', n, 0.01 * (5 - n))
+                 for n in xrange(5)]
+        gevent.joinall(glets, raise_error=True)
+        eq_(range(5), [glet.value for glet in glets])
+
+        client.close()
+
+    @raises(socket.timeout)
+    def test_call_multiplexed_timeout(self):
+        client = RPCClient(HOST, PORT, timeout=0.1, multiplex=True)
+
+        client.call('echo_delayed', 'message', 1)
+
+    def test_call_concurrent_server(self):
+        server = StreamServer((HOST, PORT + 1),
+                              functools.partial(self._server_class, concurrency=2))
+        server.start()
+        try:
+            client = RPCClient(HOST, PORT + 1, multiplex=True)
+
+            slow = gevent.spawn(client.call, 'echo_delayed', 'slow', 0.2)
+            gevent.sleep(0.01)
+            eq_('fast', client.call('echo', 'fast'))
+            ok_(not slow.ready())
+            eq_('slow', slow.get())
+        finally:
+            server.stop()
+
+    def test_call_many(self):
+        client = RPCClient(HOST, PORT)
+
+        ret = client.call_many([('echo', ('a',)), ('echo', ('b',), {}),
+                                ('echo', (), {'msg': 'c'})])
+        eq_(['a', 'b', 'c'], ret)
+        eq_([], client.call_many([]))
+        eq_('message', client.call('echo', 'message'))
+
+    @raises(RPCError)
+    def test_call_many_server_side_exception(self):
+        client = RPCClient(HOST, PORT)
+
+        try:
+            client.call_many([('echo', ('a',)), ('raise_error', ())])
+        finally:
+            eq_('message', client.call('echo', 'message'))
+
+    def test_call_many_multiplexed(self):
+        client = RPCClient(HOST, PORT, multiplex=True)
+
+        glet = gevent.spawn(client.call, 'echo_delayed', 'x', 0.05)
+        eq_(['a', 'b'], client.call_many([('echo', ('a',)), ('echo', ('b',))]))
+        eq_('x', glet.get())
+
+    def test_call_stream(self):
+        client = RPCClient(HOST, PORT, stream_window=4)
+
+        items = client.call_stream('count', 100)
+        eq_(0, next(items))
+        gevent.sleep(0.05)
+        eq_(4, len(self._produced))
+        eq_(range(1, 100), list(items))
+
+        eq_(['message'], list(client.call_stream('echo', 'message')))
+        eq_((0, 1, 2), client.call('count', 3))
+        assert_raises(RPCError, list, client.call_stream('raise_error'))
+
+        items = client.call_stream('count', 100)
+        eq_([0, 1, 2], [next(items) for _ in xrange(3)])
+        items.close()
+        eq_('message', client.call('echo', 'message'))
+
+    def test_call_stream_slow_generator(self):
+        client = RPCClient(HOST, PORT)
+
+        start = time.time()
+        items = client.call_stream('count_slowly', 2, 0.5)
+        eq_(0, next(items))
+        ok_(time.time() - start < 0.2)
+        eq_([1], list(items))
+        ok_(time.time() - start >= 1.0)
+
+    def test_call_stream_multiplexed(self):
+        client = RPCClient(HOST, PORT, multiplex=True, stream_window=4)
+
+        glets = [gevent.spawn(list, client.call_stream('count', n)) for n in (50, 60)]
+        eq_('message', client.call('echo', 'message'))
+        gevent.joinall(glets, raise_error=True)
+        eq_([range(50), range(60)], [glet.value for glet in glets])
+
+        items = client.call_stream('count', 100)
+        next(items)
+        items.close()
+        eq_('message', client.call('echo', 'message'))
+
+    def test_connection_pool(self):
+        pool = ConnectionPool(RPCClient, dict(host=HOST, port=PORT), min_connections=2,
+                              max_connections=3, wait_timeout=0.05, idle_timeout=0, reap_interval=60)
+        eq_((2, 2), (pool.size, pool.idle))
+        eq_('message', pool.call('echo', 'message'))
+        eq_((2, 2), (pool.size, pool.idle))
+
+        clients = [pool.acquire() for _ in xrange(3)]
+        eq_((3, 0), (pool.size, pool.idle))
+        assert_raises(PoolTimeoutError, pool.acquire)
+        pool.release(clients[0])
+        pool.release(clients[1], discard=True)
+        ok_(not clients[1].is_connected())
+        eq_((2, 1), (pool.size, pool.idle))
+        ok_(pool.acquire() is clients[0])
+        pool.release(clients[0])
+        pool.release(clients[2])
+
+        try:
+            with pool.connection() as client:
+                raise socket.timeout('timed out')
+        except socket.timeout:
+            pass
+        ok_(not client.is_connected())
+        eq_(1, pool.size)
+
+        pool.fill()
+        [pool.release(client) for client in [pool.acquire() for _ in xrange(3)]]
+        eq_(3, pool.size)
+        pool.reap()
+        eq_((2, 2), (pool.size, pool.idle))
+        pool.close()
+        eq_(0, pool.size)
+
+    @patch('mprpc.client_simple.socket', socket)
+    def test_connection_pool_probe(self):
+        pool = ConnectionPool(client_simple.ClientRPC, dict(host=HOST, port=PORT),
+                              min_connections=1, probe_interval=0, reap_interval=60)
+        with pool.connection() as client:
+            eq_('message', client.call('echo', 'message'))
+        client._socket.close()
+
+        with pool.connection() as other:
+            ok_(other is not client)
+            eq_('message', other.call('echo', 'message'))
+        eq_(1, pool.size)
+
+        pool.close()
+
+        pool = ConnectionPool(client_simple.ClientRPC, dict(host=HOST, port=PORT), lifetime=0)
+        eq_('message', pool.call('echo', 'message'))
+        eq_(0, pool.size)
+
+    def _start_named_server(self, port):
+        def name(self, delay=0):
+            gevent.sleep(delay)
+            return port
+        server_class = type('NamedServer', (self._server_class,), {'name': name})
+        server = StreamServer((HOST, port), server_class)
+        server.start()
+        return server
+
+    def test_cluster_client(self):
+        servers = [self._start_named_server(port) for port in (PORT + 1, PORT + 3)]
+        try:
+            client = RPCClusterClient([(HOST, PORT + 1), (HOST, PORT + 3)])
+            eq_([PORT + 1, PORT + 1, PORT + 3, PORT + 3],
+                sorted(client.call('name') for _ in xrange(4)))
+            client.close()
+
+            client = RPCClusterClient([(HOST, PORT + 1), (HOST, PORT + 3)], policy='least_outstanding')
+            slow = gevent.spawn(client.call, 'name', 0.1)
+            gevent.sleep(0.01)
+            names = [client.call('name') for _ in xrange(3)]
+            eq_(set([PORT + 1, PORT + 3]), set(names + [slow.get()]))
+            eq_(1, len(set(names)))
+
+            # A busy endpoint is not chosen again for the same call
+            (busy, other) = client._endpoints
+            other.outstanding += 5
+            call = client._call
+
+            def shed(endpoint, method, args, kwargs):
+                if endpoint is busy:
+                    raise ServerBusyError('busy')
+                return call(endpoint, method, args, kwargs)
+
+            with patch.object(client, '_call', shed):
+                eq_(PORT + 3, client.call('name'))
+            other.outstanding -= 5
+            client.close()
+
+            client = RPCClusterClient([(HOST, PORT + 1), (HOST, PORT + 3)], policy='consistent_hash')
+            names = dict((key, client.call_by_key(key, 'name')) for key in xrange(20))
+            eq_(set([PORT + 1, PORT + 3]), set(names.values()))
+            eq_(names, dict((key, client.call_by_key(key, 'name')) for key in xrange(20)))
+            client.close()
+        finally:
+            [server.stop() for server in servers]
+
+    def test_cluster_client_ejection(self):
+        server = self._start_named_server(PORT + 1)
+        try:
+            client = RPCClusterClient([(HOST, PORT + 1), (HOST, PORT + 3)], policy='consistent_hash',
+                                      max_failures=1, eject_time=0.05, probe_interval=0.01)
+            keys = [key for key in xrange(20) if client._choose_by_key(key).address[1] == PORT + 3]
+            assert_raises(IOError, client.call_by_key, keys[0], 'name')
+            eq_([(HOST, PORT + 1)], client.available)
+            eq_([PORT + 1] * len(keys), [client.call_by_key(key, 'name') for key in keys])
+
+            gevent.sleep(0.1)
+            eq_([(HOST, PORT + 1)], client.available)
+            other = self._start_named_server(PORT + 3)
+            try:
+                gevent.sleep(0.3)
+                eq_([(HOST, PORT + 1), (HOST, PORT + 3)], client.available)
+                eq_(PORT + 3, client.call_by_key(keys[0], 'name'))
+            finally:
+                other.stop()
+            client.close()
+        finally:
+            server.stop()
+
+    def _wait_for_workers(self, master, count):
+        for _ in xrange(100):
+            ps = subprocess.Popen(['ps', '-o', 'pid=', '--ppid', str(master.pid)], stdout=subprocess.PIPE)
+            workers = ps.communicate()[0].split()
+            if len(workers) == count:
+                try:
+                    RPCClient(HOST, PORT + 4).call('pid')
+                    return sorted(int(pid) for pid in workers)
+                except IOError:
+                    pass
+            gevent.sleep(0.05)
+        raise AssertionError('The workers did not start')
+
+    def test_serve(self):
+        for reuse_port in ([], ['--reuse-port']):
+            master = subprocess.Popen(
+                [sys.executable, '-m', 'mprpc.serve', 'tests.test_rpc:PidServer', '--host', HOST,
+                 '--port', str(PORT + 4), '--workers', '2', '--log-level', 'ERROR'] + reuse_port)
+            try:
+                workers = self._wait_for_workers(master, 2)
+                client = RPCClient(HOST, PORT + 4)
+                pid = client.call('pid')
+                ok_(pid in workers)
+
+                os.kill(pid, signal.SIGKILL)
+                gevent.sleep(0.2)
+                restarted = self._wait_for_workers(master, 2)
+                ok_(pid not in restarted)
+
+                client = RPCClient(HOST, PORT + 4)
+                slow = gevent.spawn(client.call, 'pid', 0.3)
+                gevent.sleep(0.1)
+                master.send_signal(signal.SIGTERM)
+                ok_(slow.get() in restarted)
+                for _ in xrange(100):
+                    if master.poll() is not None:
+                        break
+                    gevent.sleep(0.05)
+                eq_(0, master.returncode)
+            finally:
+                if master.poll() is None:
+                    master.kill()
+
+        # Workers that could not bind are not restarted forever
+        master = subprocess.Popen(
+            [sys.executable, '-m', 'mprpc.serve', 'tests.test_rpc:PidServer', '--host', 'unix:///tmp/mprpc.sock',
+             '--reuse-port'], stderr=subprocess.PIPE)
+        ok_('SO_REUSEPORT does not apply' in master.communicate()[1])
+        eq_(2, master.returncode)
+        with patch('mprpc.serve.SO_REUSEPORT', None):
+            assert_raises(ValueError, serve.Arbiter, PidServer, (HOST, PORT + 4), reuse_port=True)
+
+    @patch('mprpc.client_simple.socket', socket)
+    def test_pickles_call(self):
+        client = ClientPIK(HOST, PORT)
+
+        eq_({'key': [1, 2]}, client.call('echo', {'key': [1, 2]}))
+        eq_([2], client._state)
+
+        msg = 'message' * 500000
+        eq_(msg, client.call('echo', msg))
+        eq_('message', client.call('echo', 'message'))
+
+    def test_call_exported(self):
+        class ExportServer(RPCServer):
+            @export
+            def echo(self, msg):
+                return msg
+
+            @export('math.sum')
+            @export(namespace='math')
+            def add(self, x, y):
+                return x + y
+
+            def hidden(self):
+                return 'hidden'
+
+        server = StreamServer((HOST, PORT + 1), ExportServer)
+        server.start()
+        try:
+            client = RPCClient(HOST, PORT + 1)
+
+            eq_('message', client.call('echo', 'message'))
+            eq_(3, client.call('math.sum', 1, 2))
+            eq_(3, client.call('math.add', 1, 2))
+            eq_('1', client.call('test_connect'))
+            for name in ('hidden', 'add', '_run'):
+                assert_raises(RPCError, client.call, name)
+            eq_('message', client.call('echo', 'message'))
+        finally:
+            server.stop()
+
+    def test_call_cached(self):
+        calls = []
+
+        class CacheServer(RPCServer):
+            @cached(maxsize=2)
+            def square(self, x):
+                calls.append(x)
+                return x * x
+
+            @cached(ttl=0.1)
+            def payload(self, n):
+                calls.append(n)
+                if n < 0:
+                    raise ValueError('negative')
+                return 'x' * n
+
+            def forget(self, x):
+                self.square.invalidate(x)
+
+        server = StreamServer((HOST, PORT + 1), CacheServer)
+        server.start()
+        try:
+            client = RPCClient(HOST, PORT + 1)
+
+            eq_([4, 4], [client.call('square', 2), client.call('square', 2)])
+            eq_([4, 9], client.call_many([('square', (2,)), ('square', (3,))]))
+            eq_([2, 3], calls)
+            eq_((2, 2), (CacheServer.square.cache_info()['hits'], CacheServer.square.cache_info()['misses']))
+
+            client.call('forget', 2)
+            eq_(4, client.call('square', 2))
+            eq_(16, client.call('square', 4))
+            eq_(9, client.call('square', 3))
+            eq_([2, 3, 2, 4, 3], calls)
+
+            del calls[:]
+            eq_(['x' * 100000] * 2, [client.call('payload', 100000) for _ in xrange(2)])
+            assert_raises(RPCError, client.call, 'payload', -1)
+            assert_raises(RPCError, client.call, 'payload', -1)
+            gevent.sleep(0.1)
+            eq_('x' * 100000, client.call('payload', 100000))
+            eq_([100000, -1, -1, 100000], calls)
+        finally:
+            server.stop()
+
+    def test_call_coalesced(self):
+        calls = []
+
+        class CoalesceServer(RPCServer):
+            @coalesce
+            def slow_square(self, x, delay=0.05):
+                calls.append(x)
+                gevent.sleep(delay)
+                if x < 0:
+                    raise ValueError('negative')
+                return x * x
+
+        server = StreamServer((HOST, PORT + 1), CoalesceServer)
+        server.start()
+        try:
+            glets = [gevent.spawn(RPCClient(HOST, PORT + 1).call, 'slow_square', x)
+                     for x in (2, 2, 2, 3)]
+            gevent.joinall(glets, raise_error=True)
+            eq_([4, 4, 4, 9], [glet.value for glet in glets])
+            eq_([2, 3], sorted(calls))
+            eq_(dict(calls=2, coalesced=2, in_flight=0), CoalesceServer.slow_square.coalesce_info())
+
+            glets = [gevent.spawn(RPCClient(HOST, PORT + 1).call, 'slow_square', -1) for _ in xrange(2)]
+            gevent.joinall(glets)
+            eq_([RPCError, RPCError], [type(glet.exception) for glet in glets])
+            eq_(4, RPCClient(HOST, PORT + 1).call('slow_square', 2, 0))
+            eq_([-1, 2, 2, 3], sorted(calls))
+
+            # The callers waiting for a killed caller get an ordinary error
+            flight = SingleFlight()
+            leader = gevent.spawn(flight.run, 'key', gevent.sleep, 1)
+            gevent.sleep(0)
+            follower = gevent.spawn(flight.run, 'key', gevent.sleep, 1)
+            gevent.sleep(0.01)
+            leader.kill()
+            follower.join()
+            eq_(RuntimeError, type(follower.exception))
+            eq_(dict(calls=1, coalesced=1, in_flight=0), flight.info())
+        finally:
+            server.stop()
+
+    @patch('mprpc.client_simple.socket', socket)
+    def test_call_client_cache(self):
+        lookups = []
+        values = {}
+
+        class LookupServer(RPCServer):
+            def lookup(self, key):
+                lookups.append(key)
+                return None if key == 'none' else key.upper()
+
+            def read(self, key, delay=0):
+                value = values.get(key)
+                gevent.sleep(delay)
+                return value
+
+            @invalidates
+            def update(self, key, value=None):
+                values[key] = value
+                return True
+
+        server = StreamServer((HOST, PORT + 1), LookupServer)
+        server.start()
+        try:
+            for client_class in (RPCClient, client_simple.ClientRPC):
+                del lookups[:]
+                client = client_class(HOST, PORT + 1, cache={'lookup': 10})
+                other = client_class(HOST, PORT + 1)
+                eq_('A', client.call('lookup', 'a'))
+                eq_('A', client.call('lookup', 'a'))
+                eq_(None, client.call('lookup', 'none'))
+                eq_(None, client.call('lookup', 'none'))
+                eq_(['a', 'none'], lookups)
+                eq_(2, client.cache_info()['hits'])
+
+                # Another client's write shows in the next response
+                ok_(other.call('update', 'a'))
+                eq_('1', client.call('test_connect'))
+                eq_('A', client.call('lookup', 'a'))
+                eq_(['a', 'none', 'a'], lookups)
+
+                ok_(client.call('update', 'a'))
+                eq_('A', client.call('lookup', 'a'))
+                eq_(['a', 'none', 'a', 'a'], lookups)
+                client.close()
+                other.close()
+
+            # A result read before another client's write is cached under the
+            # epoch it was read in, and dropped with it
+            client = RPCClient(HOST, PORT + 1, cache={'read': 10})
+            other = RPCClient(HOST, PORT + 1)
+            ok_(other.call('update', 'c', 'old'))
+            reading = gevent.spawn(client.call, 'read', 'c', 0.05)
+            gevent.sleep(0.01)
+            ok_(other.call('update', 'c', 'new'))
+            eq_('old', reading.get())
+            eq_('1', client.call('test_connect'))
+            eq_('new', client.call('read', 'c', 0.05))
+            client.close()
+            other.close()
+
+            client = RPCClient(HOST, PORT + 1, cache={'lookup': 0.01})
+            eq_('B', client.call('lookup', 'b'))
+            gevent.sleep(0.02)
+            eq_('B', client.call('lookup', 'b'))
+            eq_(2, lookups.count('b'))
+            eq_(None, RPCClient(HOST, PORT + 1).cache_info())
+        finally:
+            server.stop()
+
+    def test_compression(self):
+        import msgpack
+
+        rows = [{'name': 'user%d' % i, 'status': 'active'} for i in xrange(1000)]
+        data = msgpack.packb(rows)
+        eq_('small', Deflater(threshold=100).compress('small'))
+        for zdict in (None, msgpack.packb({'name': 'user', 'status': 'active'})):
+            compressed = Deflater(threshold=100, zdict=zdict).compress(data)
+            ok_(len(compressed) < len(data) / 4)
+            unpacker = msgpack.Unpacker(use_list=False)
+            unpacker.feed(compressed + msgpack.packb('next'))
+            ext = unpacker.next()
+            eq_(tuple(rows), Inflater(zdict=zdict).inflate(ext))
+            eq_(tuple(rows), Inflater(zdict=zdict, max_size=len(data)).inflate(ext))
+            assert_raises(RPCProtocolError, Inflater(zdict=zdict, max_size=len(data) - 1).inflate, ext)
+            eq_('next', unpacker.next())
+
+        client = RPCClient(HOST, PORT, compress=True, compress_threshold=100)
+        eq_('message', client.call('echo', 'message'))
+        eq_('message' * 10000, client.call('echo', 'message' * 10000))
+        eq_(['a' * 1000, 'b'], client.call_many([('echo', ('a' * 1000,)), ('echo', ('b',))]))
+        eq_(range(10000), list(client.call_stream('count', 10000)))
+
+        zdict = 'message' * 10
+        server = StreamServer((HOST, PORT + 1), functools.partial(self._server_class, compress_dict=zdict))
+        server.start()
+        try:
+            client = RPCClient(HOST, PORT + 1, compress=True, compress_dict=zdict, multiplex=True)
+            eq_('message' * 10000, client.call('echo', 'message' * 10000))
+            eq_('message', client.call('echo', 'message'))
+        finally:
+            server.stop()
+
+    @patch('mprpc.client_simple.socket', socket)
+    def test_metrics(self):
+        import msgpack
+
+        histogram = metrics.Histogram((0.1, 0.2, 0.4))
+        eq_(None, histogram.percentile(0.5))
+        for value in (0.05, 0.15, 0.15, 0.3, 1.0):
+            histogram.observe(value)
+        eq_([1, 2, 1, 1], histogram.counts)
+        ok_(0.1 < histogram.percentile(0.5) <= 0.2)
+        eq_(1.0, histogram.percentile(1))
+
+        registry = metrics.enable()
+        server = StreamServer((HOST, PORT + 1), self._server_class)
+        server.start()
+        try:
+            client = RPCClient(HOST, PORT + 1)
+            for _ in xrange(3):
+                client.call('echo', 'message')
+            assert_raises(RPCError, client.call, 'raise_error')
+            assert_raises(RPCError, client.call_many, [('echo', ('a',)), ('raise_error', ())])
+            buffers_client = ClientBUF(HOST, PORT + 1)
+            eq_('cba', buffers_client.call('reverse', 'abc').tobytes())
+
+            stats = client.call('mprpc.stats')
+            eq_(4, stats['methods']['echo']['calls'])
+            eq_(0, stats['methods']['echo']['errors'])
+            eq_(2, stats['methods']['raise_error']['errors'])
+            eq_(1, stats['methods']['reverse']['calls'])
+            ok_(0 < stats['methods']['echo']['p50'] <= stats['methods']['echo']['p99'])
+            ok_(stats['bytes_received']['MSGPACK'] > 0 and stats['bytes_sent']['MSGPACK'] > 0)
+            eq_(len('BUFFERS:') + len(msgpack.packb((0, 1, 'reverse', (), {}, 3))) + 3,
+                stats['bytes_received']['BUFFERS'])
+            eq_(2, stats['connections'])
+
+            text = client.call('mprpc.stats', 'prometheus')
+            ok_('mprpc_requests_total{method="echo"} 4\n' in text)
+            ok_('mprpc_request_duration_seconds_bucket{method="echo",le="+Inf"} 4\n' in text)
+            ok_('mprpc_connections 2\n' in text)
+
+            client.close()
+            buffers_client.close()
+            gevent.sleep(0.05)
+            eq_(0, registry.connections)
+        finally:
+            metrics.disable()
+            server.stop()
+        assert_raises(RPCError, RPCClient(HOST, PORT).call, 'mprpc.stats')
+
+    def test_admission(self):
+        control = admission.enable(1, max_queue=1)
+        server = StreamServer((HOST, PORT + 1), functools.partial(self._server_class, concurrency=4))
+        server.start()
+        try:
+            client = RPCClient(HOST, PORT + 1, multiplex=True)
+            running = gevent.spawn(client.call, 'echo_delayed', 'running', 0.1)
+            gevent.sleep(0.01)
+            queued = gevent.spawn(client.call, 'echo_delayed', 'queued', 0)
+            gevent.sleep(0.01)
+            eq_(dict(max_in_flight=1, max_queue=1, in_flight=1, queued=1, admitted=1, shed=0), control.info())
+            assert_raises(ServerBusyError, client.call, 'echo', 'shed')
+            other = RPCClient(HOST, PORT + 1)
+            assert_raises(ServerBusyError, other.call_many, [('echo', ('a',)), ('echo', ('b',))])
+            eq_('running', running.get())
+            eq_('queued', queued.get())
+            eq_(['a', 'b'], other.call_many([('echo', ('a',)), ('echo', ('b',))]))
+            # Reserved methods are not limited
+            eq_(dict(max_in_flight=1, max_queue=1, in_flight=0, queued=0, admitted=3, shed=2),
+                client.call('mprpc.stats')['admission'])
+            ok_('mprpc_shed_requests_total 2\n' in client.call('mprpc.stats', 'prometheus'))
+            running = gevent.spawn(client.call, 'echo_delayed', 'running', 0.1)
+            queued = gevent.spawn(client.call, 'echo_delayed', 'queued', 0)
+            gevent.sleep(0.01)
+            eq_(dict(max_in_flight=1, max_queue=1, in_flight=1, queued=1, admitted=4, shed=2),
+                client.call('mprpc.stats')['admission'])
+            eq_(['running', 'queued'], [running.get(), queued.get()])
+            client.close()
+            other.close()
+
+            # Streams hold their slot until they end, also when sent from
+            # their own greenlet
+            admission.enable(1)
+            client = RPCClient(HOST, PORT, stream_window=1)
+            other = RPCClient(HOST, PORT)
+            items = client.call_stream('count', 10)
+            eq_(0, next(items))
+            assert_raises(ServerBusyError, other.call, 'echo', 'shed')
+            eq_(range(1, 10), list(items))
+            eq_('other', other.call('echo', 'other'))
+            client.close()
+            other.close()
+
+            admission.enable(1, max_queue=1, queue_timeout=0.02)
+            client = RPCClient(HOST, PORT + 1, multiplex=True)
+            running = gevent.spawn(client.call, 'echo_delayed', 'running', 0.1)
+            gevent.sleep(0.01)
+            assert_raises(ServerBusyError, client.call, 'echo', 'timed out')
+            eq_('running', running.get())
+            client.close()
+
+            admission.enable(10, per_connection=1)
+            client = RPCClient(HOST, PORT + 1, multiplex=True)
+            other = RPCClient(HOST, PORT + 1)
+            running = gevent.spawn(client.call, 'echo_delayed', 'running', 0.1)
+            gevent.sleep(0.01)
+            assert_raises(ServerBusyError, client.call, 'echo', 'shed')
+            eq_('other', other.call('echo', 'other'))
+            eq_('running', running.get())
+            client.close()
+            other.close()
+        finally:
+            admission.disable()
+            server.stop()
+
+    def test_deadline(self):
+        finished = []
+
+        class DeadlineServer(self._server_class):
+            def budget(self):
+                return self._remaining_budget()
+
+            def sleep(self, delay):
+                gevent.sleep(delay)
+                finished.append(delay)
+                return delay
+
+        server = StreamServer((HOST, PORT + 1), functools.partial(DeadlineServer, concurrency=1))
+        server.start()
+        try:
+            client = RPCClient(HOST, PORT + 1)
+            eq_(None, client.call('budget'))
+            ok_(0 < client.call_with_deadline(1.0, 'budget') <= 1.0)
+            assert_raises(DeadlineExceededError, client.call_with_deadline, 0, 'echo', 'expired')
+            eq_('message', client.call('echo', 'message'))
+            client.close()
+
+            client = RPCClient(HOST, PORT + 1, multiplex=True, deadline=0.05)
+            ok_(0 < client.call('budget') <= 0.05)
+            # The second call expires while the first one runs
+            running = gevent.spawn(client.call_with_deadline, None, 'sleep', 0.1)
+            gevent.sleep(0.01)
+            assert_raises(DeadlineExceededError, client.call, 'sleep', 0.01)
+            eq_(0.1, running.get())
+            # The third one is cancelled while it runs
+            assert_raises(DeadlineExceededError, client.call, 'sleep', 0.2)
+            gevent.sleep(0.25)
+            eq_([0.1], finished)
+            eq_('message', client.call('echo', 'message'))
+            client.close()
+        finally:
+            server.stop()
+
+    def test_cancel_race(self):
+        handlers = []
+        ready = Event()
+
+        class RacingServer(self._server_class):
+            def wait(self, size):
+                handlers.append(self)
+                ready.wait()
+                return 'x' * size
+
+        server = StreamServer((HOST, PORT + 1), functools.partial(RacingServer, concurrency=2))
+        server.start()
+        try:
+            client = RPCClient(HOST, PORT + 1, timeout=5, multiplex=True)
+            running = gevent.spawn(client.call, 'wait', 8 * 1024 ** 2)
+            gevent.sleep(0.01)
+            # The method resumes before the cancel is handled, as when both
+            # are due at once, and its response is not cut
+            ready.set()
+            gevent.get_hub().loop.run_callback(handlers[0]._msgpack_cancel, 1)
+            eq_(8 * 1024 ** 2, len(running.get()))
+            eq_('message', client.call('echo', 'message'))
+            client.close()
+        finally:
+            server.stop()
+
+    @patch('mprpc.client_simple.socket', socket)
+    def test_unix_socket(self):
+        directory = tempfile.mkdtemp()
+        endpoint = 'unix://' + os.path.join(directory, 'mprpc.sock')
+        server = StreamServer(listen(endpoint), self._server_class)
+        server.start()
+        try:
+            client = RPCClient(endpoint)
+            eq_('message', client.call('echo', 'message'))
+            client.close()
+
+            client = RPCClient(endpoint, multiplex=True)
+            eq_(['a', 'b'], [g.get() for g in [gevent.spawn(client.call, 'echo', msg) for msg in ('a', 'b')]])
+            client.close()
+
+            client = ClientPIK(endpoint)
+            eq_({'key': [1, 2]}, client.call('echo', {'key': [1, 2]}))
+            client.close()
+        finally:
+            server.stop()
+        # A socket file left behind is replaced
+        listen(endpoint).close()
+        os.unlink(endpoint[len('unix://'):])
+        os.rmdir(directory)
+
+    def test_shared_memory(self):
+        class SharedServer(self._server_class):
+            def describe(self, data, extra=None):
+                return (type(data).__name__, len(data), type(extra).__name__)
+
+            def blob(self, size):
+                return 'x' * size
+
+            def hold(self, data, delay):
+                gevent.sleep(delay)
+                return len(data)
+
+        rings = set(os.listdir(shm.DIRECTORY))
+        directory = tempfile.mkdtemp()
+        endpoint = 'unix://' + os.path.join(directory, 'mprpc.sock')
+        server = StreamServer(listen(endpoint), functools.partial(
+            SharedServer, concurrency=4, shared_memory=64 * 1024, shared_memory_threshold=1024))
+        server.start()
+        try:
+            client = RPCClient(endpoint, shared_memory=64 * 1024, shared_memory_threshold=1024)
+            eq_(('unicode', 10, 'NoneType'), client.call('describe', 'x' * 10))
+            # Records are reused once released
+            for i in xrange(10):
+                eq_(('memoryview', 20000, 'memoryview'),
+                    client.call('describe', 'x' * 20000, extra=bytearray(2000)))
+                result = client.call('blob', 20000)
+                eq_(memoryview, type(result))
+                eq_('x' * 20000, result.tobytes())
+            del result
+            eq_('message', client.call('echo', 'message'))
+            eq_('y' * 2000, client.call('echo', 'y' * 2000).tobytes())
+            # Results still in use take up the ring, and the next ones are
+            # sent over the socket
+            held = [client.call('blob', 20000) for _ in xrange(4)]
+            eq_([memoryview, memoryview, memoryview, unicode], map(type, held))
+            del held
+            eq_(memoryview, type(client.call('blob', 20000)))
+            client.close()
+
+            client = RPCClient(endpoint, multiplex=True, shared_memory=64 * 1024, shared_memory_threshold=1024)
+            glets = [gevent.spawn(client.call, 'echo', str(i) * 5000) for i in xrange(5)]
+            eq_([str(i) * 5000 for i in xrange(5)], [glet.get().tobytes() for glet in glets])
+            # The records of a cancelled call are released too
+            assert_raises(DeadlineExceededError, client.call_with_deadline, 0.05, 'hold', 'x' * 20000, 0.2)
+            gevent.sleep(0.05)
+            for i in xrange(10):
+                eq_(('memoryview', 20000, 'NoneType'), client.call('describe', 'x' * 20000))
+            client.close()
+        finally:
+            server.stop()
+        # Rings are removed once the connections are closed on both ends
+        gevent.sleep(0.1)
+        eq_(rings, set(os.listdir(shm.DIRECTORY)))
+
+        server = StreamServer(listen(endpoint), self._server_class)
+        server.start()
+        try:
+            client = RPCClient(endpoint, shared_memory=64 * 1024, shared_memory_threshold=1024)
+            eq_('message', client.call('echo', 'message'))
+            assert_raises(IOError, client.call, 'echo', 'x' * 2000)
+            client.close()
+        finally:
+            server.stop()
+        os.unlink(endpoint[len('unix://'):])
+        os.rmdir(directory)
+
+    def test_shared_memory_checks(self):
+        import msgpack
+
+        def send(sock, *msgs):
+            sock.sendall(''.join(['MSGPACK:' + msgpack.packb(msg) for msg in msgs]))
+            sock.settimeout(1)
+            return sock.recv(4096)
+
+        shm.remove_stale_rings()
+        rings = set(os.listdir(shm.DIRECTORY))
+        directory = tempfile.mkdtemp()
+        endpoint = 'unix://' + os.path.join(directory, 'mprpc.sock')
+        server = StreamServer(listen(endpoint), functools.partial(
+            self._server_class, shared_memory=64 * 1024, shared_memory_threshold=1024))
+        server.start()
+        tcp_server = StreamServer((HOST, PORT + 1), functools.partial(
+            self._server_class, shared_memory=64 * 1024, shared_memory_threshold=1024))
+        tcp_server.start()
+        ring = shm.SharedRing(64 * 1024)
+        try:
+            # Rings are removed once the peer has mapped them
+            client = RPCClient(endpoint, shared_memory=64 * 1024, shared_memory_threshold=1024)
+            eq_('x' * 2000, client.call('echo', 'x' * 2000).tobytes())
+            # The server learns it from the client releasing a result
+            eq_('message', client.call('echo', 'message'))
+            eq_(rings | set([os.path.basename(ring.path)]), set(os.listdir(shm.DIRECTORY)))
+            client.close()
+            assert_raises(AssertionError, RPCClient, HOST, PORT + 1, shared_memory=64 * 1024)
+
+            # Records of a ring the connection did not announce are refused
+            record = ring.write('x' * 2000)
+            request = (0, 1, 'echo', (record,), {}, {'shm': 0})
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(endpoint[len('unix://'):])
+            eq_('', send(sock, request))
+            sock = socket.create_connection((HOST, PORT + 1))
+            eq_('', send(sock, (7, ring.path), request))
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(endpoint[len('unix://'):])
+            ok_(send(sock, (7, ring.path), request))
+            sock.close()
+        finally:
+            server.stop()
+            tcp_server.stop()
+            ring.close()
+        gevent.sleep(0.1)
+        os.unlink(endpoint[len('unix://'):])
+        os.rmdir(directory)
+
+        # Only regular files of the same user are mapped
+        link = tempfile.mktemp(prefix=shm.PREFIX, dir=shm.DIRECTORY)
+        os.symlink(os.devnull, link)
+        try:
+            assert_raises(RPCProtocolError, shm.SharedRegions().announce, link)
+        finally:
+            os.unlink(link)
+        assert_raises(RPCProtocolError, shm.SharedRegions().announce, '/etc/passwd')
+
+        # Rings of processes that have exited are removed
+        process = subprocess.Popen(['true'])
+        process.wait()
+        stale = os.path.join(shm.DIRECTORY, '%s%d-stale.ring' % (shm.PREFIX, process.pid))
+        open(stale, 'w').close()
+        ok_(shm.remove_stale_rings() >= 1)
+        ok_(not os.path.exists(stale))
+        eq_(rings, set(os.listdir(shm.DIRECTORY)))
+
+    @patch('mprpc.client_simple.socket', socket)
+    def test_notify(self):
+        notified = []
+
+        class NotifyServer(self._server_class):
+            def record(self, value, delay=0):
+                gevent.sleep(delay)
+                notified.append(value)
+                return value
+
+            def fail(self):
+                raise ValueError('fail')
+
+        server = StreamServer((HOST, PORT + 1), NotifyServer)
+        server.start()
+        try:
+            client = RPCClient(HOST, PORT + 1)
+            for i in xrange(3):
+                client.notify('record', i)
+            client.notify('not_found')
+            client.notify('fail')
+            # No response was written for the notifications
+            eq_('message', client.call('echo', 'message'))
+            eq_([0, 1, 2], notified)
+            client.close()
+
+            client = client_simple.ClientRPC(HOST, PORT + 1)
+            client.notify('record', value='simple')
+            eq_('message', client.call('echo', 'message'))
+            eq_('simple', notified[-1])
+            client.close()
+        finally:
+            server.stop()
+
+        del notified[:]
+        server = StreamServer((HOST, PORT + 1), functools.partial(NotifyServer, concurrency=2))
+        server.start()
+        try:
+            client = RPCClient(HOST, PORT + 1, multiplex=True)
+            client.notify('record', 'slow', delay=0.05)
+            client.notify('record', 'fast')
+            eq_('message', client.call('echo', 'message'))
+            gevent.sleep(0.1)
+            eq_(['fast', 'slow'], notified)
+            client.close()
+        finally:
+            server.stop()
+
+    def test_profiling(self):
+        import pstats
+        import shutil
+
+        client = RPCClient(HOST, PORT)
+        eq_('message', client.call('echo', 'message'))
+        assert_raises(RPCError, client.call, 'mprpc.profile.start', 'echo')
+
+        directory = tempfile.mkdtemp()
+        profiling.enable(directory)
+        try:
+            assert_raises(RPCError, client.call, 'mprpc.profile.start', 'not_found')
+            assert_raises(RPCError, client.call, 'mprpc.profile.start', 'mprpc.stats')
+            info = client.call('mprpc.profile.start', 'echo', every=2, memory=True)
+            eq_(2, info['every'])
+            for i in xrange(5):
+                eq_(i, client.call('echo', i))
+            session = profiling.get_session('echo')
+            eq_((5, 2), (session.calls, session.sampled))
+
+            paths = client.call('mprpc.profile.stop', 'echo')
+            eq_(['.pstats', '.txt'], [os.path.splitext(path)[1] for path in paths])
+            ok_(pstats.Stats(paths[0]).total_calls > 0)
+            with open(paths[1]) as f:
+                ok_(f.read().startswith('Method echo: 5 calls, 2 profiled'))
+            eq_(None, profiling.get_session('echo'))
+            eq_((), client.call('mprpc.profile.stop', 'echo'))
+            eq_('message', client.call('echo', 'message'))
+
+            profiling.start('echo', duration=0.05)
+            client.call('echo', 'message')
+            gevent.sleep(0.1)
+            eq_(None, profiling.get_session('echo'))
+            eq_(4, len(os.listdir(directory)))
+        finally:
+            profiling.disable()
+            shutil.rmtree(directory)
+        client.close()
+
+    def test_call_method_not_found(self):
+        client = RPCClient(HOST, PORT)
+
+        assert_raises(RPCError, client.call, 'not_found')
+        assert_raises(RPCError, client.call, '_run')
+        eq_('message', client.call('echo', 'message'))
+
+    @patch('mprpc.client_simple.socket', socket)
+    def test_jsonstr_call(self):
+        client = ClientJSN(HOST, PORT)
+
+        eq_({'key': [1, 2]}, client.call('echo', {'key': [1, 2]}))
+        eq_('message', client.call('echo', msg='message'))
+        assert_raises(client_simple.RPCError, client.call, 'raise_error')
+        assert_raises(client_simple.RPCError, client.call, 'not_found')
+        eq_('message', client.call('echo', 'message'))
+
+    @patch('mprpc.client_simple.socket', socket)
+    def test_buffers_call(self):
+        client = ClientBUF(HOST, PORT)
+
+        body = bytearray('0123456789' * 300000)
+        eq_(body[::-1], client.call('reverse', body).tobytes())
+        eq_('cbacba', client.call('reverse', 'abc', times=2).tobytes())
+        ok_(client.test_connect())
+
+        out = bytearray(10)
+        eq_(3, client.buffers_call_into(out, 'reverse', 'abc'))
+        eq_('cba', out[:3])
+        assert_raises(ValueError, client.buffers_call_into, out, 'reverse', 'abc', times=4)
+        assert_raises(client_simple.RPCError, client.call, 'raise_error', '')
+        eq_('cba', client.call('reverse', 'abc').tobytes())
+
+    @patch('mprpc.client_simple.socket', socket)
+    def test_buffers_length(self):
+        import msgpack
+
+        server = StreamServer((HOST, PORT + 1), functools.partial(self._server_class, max_buffer_size=100))
+        server.start()
+        try:
+            # Connections sending an invalid body length are closed
+            for length in (-1, 101, 2 ** 40, 'abc'):
+                sock = socket.create_connection((HOST, PORT + 1))
+                sock.settimeout(1)
+                sock.sendall('BUFFERS:' + msgpack.packb((0, 1, 'reverse', (), {}, length)))
+                eq_('', sock.recv(4096))
+                sock.close()
+            client = ClientBUF(HOST, PORT + 1)
+            eq_('x' * 100, client.call('reverse', 'x' * 100).tobytes())
+        finally:
+            server.stop()
+
+    @patch('mprpc.client_simple.socket', socket)
+    def test_fileobj_call(self):
+        client = ClientFIL(HOST, PORT)
+
+        src = tempfile.NamedTemporaryFile()
+        src.write('0123456789' * 100000)
+        src.flush()
+        dest = tempfile.NamedTemporaryFile()
+        eq_(1000000, client.call('open_file', dest.name, src.name))
+        eq_('0123456789' * 100000, open(dest.name).read())
+
+        out = StringIO()
+        eq_(7, client.call('open_string', out, 'message'))
+        eq_('message', out.getvalue())
+        assert_raises(client_simple.RPCError, client.call, 'raise_error', out)
+        assert_raises(client_simple.RPCError, client.call, 'echo', out, u'message')
+        ok_(client.test_connect())
+
+    def _aio_server_class(self):
+        from mprpc import aio
+
+        class AioServer(aio.RPCServer):
+            def echo(self, msg):
+                return msg
+
+            def echo_later(self, msg, delay):
+                future = asyncio.Future()
+                asyncio.get_event_loop().call_later(delay, future.set_result, msg)
+                return future
+
+            def raise_error(self):
+                raise Exception('error msg')
+
+            def count(self, n):
+                for i in xrange(n):
+                    yield i
+
+            def record(self, msg):
+                notified.append(msg)
+
+        notified = self._aio_notified = []
+        return AioServer
+
+    def test_aio_call(self):
+        if asyncio is None:
+            raise SkipTest('asyncio is not available')
+        from mprpc import aio
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                server = loop.run_until_complete(
+                    loop.create_server(self._aio_server_class(), HOST, PORT + 2))
+                client = loop.run_until_complete(aio.connect(HOST, PORT + 2, loop=loop))
+                futures = [client.call('echo_later', n, 0.01 * (5 - n)) for n in xrange(5)]
+                eq_([0, 1, 2, 3, 4], loop.run_until_complete(asyncio.gather(*futures)))
+                eq_((0, 1, 2), loop.run_until_complete(client.call('count', 3)))
+                assert_raises(RPCError, loop.run_until_complete, client.call('raise_error'))
+                assert_raises(RPCError, loop.run_until_complete, client.call('connection_made'))
+                client.close()
+
+                # The asyncio client against the gevent server
+                client = loop.run_until_complete(aio.connect(HOST, PORT, loop=loop))
+                eq_('message', loop.run_until_complete(client.call('echo', 'message')))
+                client.close()
+                server.close()
+            finally:
+                loop.close()
+
+        gevent.get_hub().threadpool.apply(run)
+
+    def test_aio_server(self):
+        if asyncio is None:
+            raise SkipTest('asyncio is not available')
+
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(
+            loop.create_server(self._aio_server_class(), HOST, PORT + 2))
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_forever()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        try:
+            client = RPCClient(HOST, PORT + 2, multiplex=True, stream_window=4)
+
+            glets = [gevent.spawn(client.call, 'echo_later', n, 0.01 * (5 - n))
+                     for n in xrange(5)]
+            gevent.joinall(glets, raise_error=True)
+            eq_(range(5), [glet.value for glet in glets])
+            eq_(['a', 'b'], client.call_many([('echo', ('a',)), ('echo', ('b',))]))
+            eq_(range(20), list(client.call_stream('count', 20)))
+            assert_raises(RPCError, client.call, 'raise_error')
+            client.notify('record', 'a')
+            client.notify('not_found')
+            eq_('message', client.call('echo', 'message'))
+            eq_(['a'], self._aio_notified)
+            client.close()
+        finally:
+            loop.call_soon_threadsafe(server.close)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()